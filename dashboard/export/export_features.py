@@ -0,0 +1,29 @@
+import logging
+import os
+from datetime import datetime
+
+from dashboard.logic import cache
+from dashboard.models import CsvData
+
+logger = logging.getLogger(__name__)
+
+
+def export_all_x_data():
+    """
+    Exports the cached epoch features of all the csv data into excel files next to the feature store.
+
+    :return: True if all the existing feature stores were exported
+    """
+    start = datetime.now()
+    result = True
+    data = CsvData.objects.all()
+    for d in data:
+        if not os.path.exists(d.x_data_path):
+            continue
+        try:
+            cache.export_features_to_excel(d.x_data_path, d.x_data_excel_path)
+        except Exception:
+            result = False
+            logger.exception(f'Export of features failed for {d.filename}')
+    logger.info(f'Features of {len(data)} csv data exported to excel in {datetime.now() - start}')
+    return result
@@ -1,5 +1,17 @@
+import json
+import os
 import pickle
 
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from dashboard.logic.machine_learning.settings import scale_name, prediction_name
+
+COVERAGE_VERSION = 1
+# consecutive epochs further apart split the coverage of the recording
+COVERAGE_GAP = np.timedelta64(60, 's')
+
 
 def save_obj(obj, path):
     with open(path, 'wb+') as f:
@@ -9,3 +21,165 @@ def save_obj(obj, path):
 def load_obj(path):
     with open(path, 'rb') as f:
         return pickle.load(f)
+
+
+def save_features(df, path):
+    """
+    Saves the epoch features into the columnar (parquet) feature store.
+
+    The features are stored as float32 columns, the label column as small integers and the index as datetime.
+
+    :param df: pandas dataframe of features with datetime index
+    :param path: path of the feature store
+    """
+    df = df.astype({c: np.float32 for c in df.columns if c != scale_name})
+    if scale_name in df.columns and df[scale_name].notna().all():
+        df[scale_name] = df[scale_name].astype(np.int8)
+    df.index = pd.DatetimeIndex(df.index, name=df.index.name or 'Date')
+    tmp_path = f'{path}.tmp'
+    df.to_parquet(tmp_path, index=True)
+    os.replace(tmp_path, path)
+
+
+def load_features(path, columns=None):
+    """
+    Loads the epoch features from the feature store, legacy excel files are still supported.
+
+    :param path: path of the feature store
+    :param columns: list of columns to load, all the columns are loaded if None
+    :return: pandas dataframe of features with datetime index
+    """
+    if path.endswith('.xlsx'):
+        df = pd.read_excel(path, index_col=0)
+        return df if columns is None else df[columns]
+    return pd.read_parquet(path, columns=columns)
+
+
+def load_feature_columns(path):
+    """
+    :param path: path of the feature store
+    :return: list of the stored columns, the features are not loaded
+    """
+    return [c for c in pq.read_schema(path).names if not c.startswith('__index_level_') and c != 'Date']
+
+
+def export_features_to_excel(path, excel_path):
+    """
+    Exports the epoch features from the feature store into excel, used only on explicit export.
+
+    :param path: path of the feature store
+    :param excel_path: path of the exported excel file
+    """
+    load_features(path).to_excel(excel_path)
+
+
+def save_predictions(df, path):
+    """
+    Saves the predictions of one recording into the columnar (parquet) prediction store.
+
+    Only the epoch time index, the label and the predicted sleep probability are kept,
+    the features are stored in the feature store already.
+
+    :param df: pandas dataframe with the prediction column and datetime index
+    :param path: path of the prediction store
+    """
+    columns = [c for c in (scale_name, prediction_name) if c in df.columns]
+    save_features(df[columns], path)
+    _save_coverage(df.index, path)
+
+
+def load_predictions(path, columns=None):
+    """
+    :param path: path of the prediction store
+    :param columns: list of columns to load, all the columns are loaded if None
+    :return: pandas dataframe of the predictions with datetime index
+    """
+    return pd.read_parquet(path, columns=columns)
+
+
+def load_coverage(path):
+    """
+    Returns the time intervals covered by the predicted epochs,
+    the intervals are saved next to the prediction store, so the predictions do not have to be loaded.
+
+    :param path: path of the prediction store
+    :return: tuple of datetime64 arrays with the starts and the ends of the covered intervals
+    """
+    coverage_path = get_coverage_path(path)
+    if os.path.exists(coverage_path):
+        with open(coverage_path, 'r') as coverage_file:
+            coverage = json.load(coverage_file)
+        if coverage.get('version') == COVERAGE_VERSION and coverage.get('key') == _file_key(path):
+            return (np.array(coverage['starts'], dtype='datetime64[ns]'),
+                    np.array(coverage['ends'], dtype='datetime64[ns]'))
+    # the predictions saved before the coverage was introduced or changed outside of save_predictions
+    return _save_coverage(pd.read_parquet(path, columns=[]).index, path)
+
+
+def get_coverage_path(path):
+    return f'{os.path.splitext(path)[0]}.coverage.json'
+
+
+def export_predictions_to_excel(path, excel_path, features_path=None):
+    """
+    Exports the predictions into excel, used only when the excel file is requested.
+
+    :param path: path of the prediction store
+    :param excel_path: path of the exported excel file
+    :param features_path: path of the feature store, the features are exported next to the predictions if given
+    """
+    df = load_predictions(path)
+    if features_path is not None and os.path.exists(features_path):
+        features = load_features(features_path)
+        df = features.drop(columns=[c for c in df.columns if c in features.columns]).join(df, how='right')
+    tmp_path = f'{excel_path}.tmp.xlsx'
+    df.to_excel(tmp_path)
+    os.replace(tmp_path, excel_path)
+
+
+def save_night_intervals(df, path):
+    """
+    Saves the binary predictions of the nights in bed of one recording into the columnar (parquet) store.
+
+    :param df: pandas dataframe with the prediction and the diary_day id columns and datetime index
+    :param path: path of the night intervals store
+    """
+    df = df.astype({'diary_day': np.int64, prediction_name: np.int8})
+    df.index = pd.DatetimeIndex(df.index, name=df.index.name or 'Date')
+    tmp_path = f'{path}.tmp'
+    df.to_parquet(tmp_path, index=True)
+    os.replace(tmp_path, path)
+
+
+def load_night_intervals(path, diary_day=None):
+    """
+    :param path: path of the night intervals store
+    :param diary_day: id of the sleep diary day to load, all the nights are loaded if None
+    :return: pandas dataframe with the prediction and the diary_day id columns and datetime index
+    """
+    filters = None if diary_day is None else [('diary_day', '==', diary_day)]
+    return pd.read_parquet(path, filters=filters)
+
+
+def _save_coverage(index, path):
+    times = np.sort(np.asarray(index, dtype='datetime64[ns]'))
+    breaks = np.flatnonzero(np.diff(times) > COVERAGE_GAP)
+    starts = times[np.concatenate(([0], breaks + 1))] if len(times) else times
+    ends = times[np.concatenate((breaks, [len(times) - 1]))] if len(times) else times
+    coverage = {
+        'version': COVERAGE_VERSION,
+        'key': _file_key(path),
+        'starts': starts.astype(np.int64).tolist(),
+        'ends': ends.astype(np.int64).tolist(),
+    }
+    coverage_path = get_coverage_path(path)
+    tmp_path = f'{coverage_path}.tmp'
+    with open(tmp_path, 'w') as coverage_file:
+        json.dump(coverage, coverage_file)
+    os.replace(tmp_path, coverage_path)
+    return starts, ends
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
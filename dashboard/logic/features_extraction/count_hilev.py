@@ -1,11 +1,15 @@
 import logging
-from datetime import timedelta
+from collections import defaultdict
+from datetime import timedelta, datetime, timezone
 from os import path
 
+import pandas as pd
 import pytz
-from pandas import DataFrame
+from django.db import transaction
+from pandas import DataFrame, read_excel
 
 from dashboard.logic import cache
+from dashboard.logic.features_extraction.night_runs import NightRuns
 from dashboard.logic.machine_learning.predict import predict
 from dashboard.logic.machine_learning.settings import prediction_name
 from dashboard.logic.sleep_diary.structure import create_structure_all
@@ -14,15 +18,31 @@ from dashboard.models import CsvData, SleepDiaryDay, SleepNight, WakeInterval
 logger = logging.getLogger(__name__)
 
 SLEEP_PROBABILITY_THRESHOLD = 0.5
+# nights saved by one query in the bulk mode
+BULK_BATCH_SIZE = 500
+HILEV_FIELDS = ['sleep_onset', 'sleep_end', 'tib', 'sol', 'waso', 'wasf', 'wb', 'awk5plus']
 
 
 def hilev_all():
     structure = create_structure_all()
-    hilev(structure)
+    return hilev(structure, bulk=True)
 
 
-def hilev(structure):
+def hilev(structure, bulk=False):
+    """
+    Computes the high level features of the nights in the structure and saves them as SleepNight,
+    the binary prediction of each night in bed is saved into the night intervals store of the recording.
+
+    :param structure: list of (subject, csv data, sleep diary day) tuples
+    :param bulk: find the existing nights in one query and save all the nights at once in one transaction
+    :return: True if the features of all the nights were computed and saved
+    """
     res = True
+    start = datetime.now()
+    existing = _prefetch_nights(structure) if bulk else None
+    computed = {}
+    predictions = {}
+    intervals = defaultdict(list)
     for subject, data, day in structure:
         if not isinstance(data, CsvData):
             res = False
@@ -30,70 +50,169 @@ def hilev(structure):
         if not isinstance(day, SleepDiaryDay):
             res = False
             continue
-        if not path.exists(data.cached_prediction_path):
-            df = predict(data)
-        else:
-            df = _get_dataframe(data)
+        # the recording has more nights, so its predictions are loaded once
+        if data.id not in predictions:
+            if not path.exists(data.cached_prediction_path):
+                predictions[data.id] = predict(data)
+            else:
+                predictions[data.id] = _get_dataframe(data)
+        df = predictions[data.id]
         if not isinstance(df, DataFrame):
             res = False
             continue
-        nights = SleepNight.objects.filter(diary_day=day).filter(data=data).filter(subject=subject)
-        if not nights.exists():
-            night = _create_night(data, day, subject)
+        if bulk:
+            key = (day.id, data.id, subject.id)
+            night = existing.get(key)
+            if night is None:
+                night = _create_night(data, day, subject)
+                existing[key] = night
+            else:
+                # the related objects are known already, so they are not queried again
+                night.diary_day, night.data, night.subject = day, data, subject
         else:
-            night = nights.first()
+            nights = SleepNight.objects.filter(diary_day=day).filter(data=data).filter(subject=subject)
+            if not nights.exists():
+                night = _create_night(data, day, subject)
+            else:
+                night = nights.first()
         s = day.t1 - timedelta(minutes=0)
         e = day.t4 + timedelta(minutes=0)
         tib_interval = _ensure_binary_prediction(df.loc[s:e, [prediction_name]])
-        sleep = tib_interval.index[tib_interval[prediction_name] == 1].tolist()
-        if not sleep:
+        runs = NightRuns.from_prediction(tib_interval[prediction_name])
+        if not runs.has_sleep:
             logger.warning(f'No sleep found for {night.subject.code} {night.diary_day.date} {night.data.filename}')
             res = False
             continue
-        sleep_interval = tib_interval.loc[sleep[0]:sleep[-1], [prediction_name]]
-        wake = sleep_interval.index[sleep_interval[prediction_name] == 0].tolist()
-        night.sleep_onset = pytz.timezone("UTC").localize(sleep[0])
-        night.sleep_end = pytz.timezone("UTC").localize(sleep[-1])
-        tst_interval = sleep_interval
-        _count_hilevs(day, night, tst_interval, sleep, wake)
+        night.sleep_onset = pytz.timezone("UTC").localize(runs.sleep_onset)
+        night.sleep_end = pytz.timezone("UTC").localize(runs.sleep_end)
+        _count_hilevs(day, night, runs)
         logger.info(night)
-        try:
-            night.save()
-        except:
-            logger.error(f'Could not save {night}')
-        tib_interval.to_excel(night.name)
-
+        if bulk:
+            computed[key] = night
+        else:
+            try:
+                night.save()
+            except:
+                logger.error(f'Could not save {night}')
+        intervals[data].append(tib_interval.assign(diary_day=day.id))
+
+    if bulk:
+        res = _save_nights(list(computed.values())) and res
+    for data, frames in intervals.items():
+        _save_night_intervals(data, frames)
+    logger.info(f'High level features of {sum(len(f) for f in intervals.values())} nights computed in '
+                f'{datetime.now() - start}')
     return res
 
 
+def load_night_interval(night):
+    """
+    :param night: SleepNight
+    :return: dataframe with the binary prediction of the night in bed, None if it was not computed
+    """
+    store_path = night.data.night_intervals_path
+    if path.exists(store_path):
+        df = cache.load_night_intervals(store_path, night.diary_day_id)
+        if len(df):
+            return df[[prediction_name]]
+    # the nights computed before the night intervals store was introduced
+    if path.exists(night.name):
+        return read_excel(night.name, index_col=0)
+    return None
+
+
+def get_night_excel(night):
+    """
+    Exports the prediction of the night in bed into excel, the export is reused until the nights are computed again.
+
+    :param night: SleepNight
+    :return: path to the excel file, None if the night was not computed
+    """
+    return _export_interval(night.name, night.data.night_intervals_path, lambda: load_night_interval(night))
+
+
+def get_sleeppy_excel(sleeppy_data):
+    """
+    Exports the prediction of the SleepPy rest period into excel, the export is reused until the nights are computed
+    again. The rest period matched to a sleep night is exported as the night in bed like before.
+
+    :param sleeppy_data: SleeppyData
+    :return: path to the excel file, None if there are no predictions
+    """
+    return _export_interval(sleeppy_data.name, sleeppy_data.data.night_intervals_path,
+                            lambda: _load_rest_period(sleeppy_data))
+
+
+def _load_rest_period(sleeppy_data):
+    if sleeppy_data.sleep_night_id is not None:
+        return load_night_interval(sleeppy_data.sleep_night)
+    if not path.exists(sleeppy_data.data.cached_prediction_path):
+        return None
+    s = sleeppy_data.sleep_onset.astimezone(timezone.utc).replace(tzinfo=None)
+    e = sleeppy_data.sleep_end.astimezone(timezone.utc).replace(tzinfo=None)
+    df = cache.load_predictions(sleeppy_data.data.cached_prediction_path, columns=[prediction_name]).loc[s:e]
+    return _ensure_binary_prediction(df) if len(df) else None
+
+
+def _export_interval(excel_path, store_path, load):
+    # the export is older than the night intervals store when the nights were computed again
+    if path.exists(excel_path) and \
+            (not path.exists(store_path) or path.getmtime(excel_path) >= path.getmtime(store_path)):
+        return excel_path
+    df = load()
+    if df is None:
+        return None
+    df.to_excel(excel_path)
+    return excel_path
+
+
+def _prefetch_nights(structure):
+    # the first existing night of each (diary day, data, subject) key, like the query of a single night
+    keys = {(day.id, data.id, subject.id) for subject, data, day in structure
+            if isinstance(data, CsvData) and isinstance(day, SleepDiaryDay)}
+    existing = {}
+    nights = SleepNight.objects.filter(diary_day_id__in={key[0] for key in keys}).order_by('id')
+    for night in nights:
+        key = (night.diary_day_id, night.data_id, night.subject_id)
+        if key in keys and key not in existing:
+            existing[key] = night
+    return existing
+
+
+def _save_nights(nights):
+    new = [night for night in nights if night.pk is None]
+    changed = [night for night in nights if night.pk is not None]
+    try:
+        with transaction.atomic():
+            SleepNight.objects.bulk_create(new, batch_size=BULK_BATCH_SIZE)
+            SleepNight.objects.bulk_update(changed, HILEV_FIELDS, batch_size=BULK_BATCH_SIZE)
+    except Exception as e:
+        logger.error(f'Could not save {len(nights)} nights: {e}')
+        return False
+    logger.info(f'{len(new)} nights created and {len(changed)} nights updated')
+    return True
+
+
+def _save_night_intervals(data, frames):
+    df = pd.concat(frames)
+    store_path = data.night_intervals_path
+    if path.exists(store_path):
+        previous = cache.load_night_intervals(store_path)
+        df = pd.concat([previous[~previous['diary_day'].isin(df['diary_day'].unique())], df])
+    cache.save_night_intervals(df.sort_index(kind='stable'), store_path)
+
+
 def _get_dataframe(data):
-    return cache.load_obj(data.cached_prediction_path)
+    return cache.load_predictions(data.cached_prediction_path, columns=[prediction_name])
 
 
-def _count_hilevs(day, night, tst_interval, sleep, wake):
+def _count_hilevs(day, night, runs):
     night.tib = (day.t4 - day.t1).seconds
-    night.sol = (sleep[0] - day.t1).seconds
-    night.waso = len(wake) * 30
-    night.wasf = (day.t4 - sleep[-1]).seconds
-    night.wb = max(0, int((tst_interval[prediction_name].diff() == -1).sum()) - 1)
-    night.awk5plus = _count_awk5plus(tst_interval)
-
-
-def _count_awk5plus(pred):
-    awk5p = 0
-    wake_counter = 0
-    sleep_counter = 0
-    for v in pred[prediction_name]:
-        if v == 0:  # wake
-            wake_counter += 1
-            if wake_counter == 10 and sleep_counter >= 10:
-                # 10 * 30s = 5minutes -> 5 minutes of wake without short disruption of sleep shorter then 5 minutes
-                awk5p += 1
-                sleep_counter = 0
-        else:  # sleep
-            sleep_counter += 1
-            wake_counter = 0
-    return awk5p
+    night.sol = (runs.sleep_onset - day.t1).seconds
+    night.waso = runs.waso
+    night.wasf = (day.t4 - runs.sleep_end).seconds
+    night.wb = runs.wake_bouts
+    night.awk5plus = runs.awakenings
 
 
 def _count_dtst(day):
@@ -1,6 +1,8 @@
 import logging
 from statistics import variance, stdev, mean, median, mode
 
+import numpy as np
+import pandas as pd
 from numpy import quantile, percentile
 from scipy.stats import iqr, trim_mean, median_abs_deviation, kurtosis, skew
 
@@ -9,6 +11,50 @@ from dashboard.logic.machine_learning.settings import scale_name
 
 logger = logging.getLogger(__name__)
 
+# number of epochs processed by the batch kernel at once, bounds the memory of the 2-D sample arrays
+BATCH_SIZE = 2048
+PERCENTILES = {
+    '1st PERCENTILE': 1,
+    '5th PERCENTILE': 5,
+    '10th PERCENTILE': 10,
+    '20th PERCENTILE': 20,
+    '1st QUARTILE': 25,
+    '30th PERCENTILE': 30,
+    '40th PERCENTILE': 40,
+    '60th PERCENTILE': 60,
+    '70th PERCENTILE': 70,
+    '3th QUARTILE': 75,
+    '80th PERCENTILE': 80,
+    '90th PERCENTILE': 90,
+    '95th PERCENTILE': 95,
+    '99th PERCENTILE': 99,
+}
+TRIMMED_MEANS = {
+    'MEAN EXCLUDING OUTLIERS (10)': 0.1,
+    'MEAN EXCLUDING OUTLIERS (20)': 0.2,
+    'MEAN EXCLUDING OUTLIERS (30)': 0.3,
+    'MEAN EXCLUDING OUTLIERS (40)': 0.4,
+}
+SIGNALS = ('MAGNITUDE', 'Z_ANGLE', 'TEMPERATURE')
+# features of each signal in the order of _get_features_for_vector
+FEATURES = (
+    'MAX', 'MIN', 'RELATIVE POSITION OF MAX', 'RELATIVE POSITION OF MIN', 'RANGE', 'RELATIVE RANGE',
+    'RELATIVE VARIATION RANGE', 'INTERQUARTILE RANGE', 'RELATIVE INTERQUARTILE RANGE', 'INTERDECILE RANGE',
+    'RELATIVE INTERDECILE RANGE', 'INTERPERCENTILE RANGE', 'RELATIVE INTERPERCENTILE RANGE', 'STUDENTIZED RANGE',
+    'MEAN', *TRIMMED_MEANS, 'MEDIAN', 'MODE', 'VARIANCE', 'STANDARD DEVIATION', 'MEDIAN ABSOLUTE DEVIATION',
+    'RELATIVE STANDARD DEVIATION', 'INDEX OF DISPERSION', 'KURTOSIS', 'SKEWNESS', 'PEARSONS 1st SKEWNESS COEFFICIENT',
+    'PEARSONS 2nd SKEWNESS COEFFICIENT', *PERCENTILES,
+)
+# features which need the sorted samples, the others are computed without sorting
+MODE_FEATURES = ('MODE', 'PEARSONS 1st SKEWNESS COEFFICIENT')
+MEDIAN_FEATURES = ('MEDIAN', 'MEDIAN ABSOLUTE DEVIATION', 'PEARSONS 2nd SKEWNESS COEFFICIENT')
+SORTED_FEATURES = (
+    'INTERQUARTILE RANGE', 'RELATIVE INTERQUARTILE RANGE', 'INTERDECILE RANGE', 'RELATIVE INTERDECILE RANGE',
+    'INTERPERCENTILE RANGE', 'RELATIVE INTERPERCENTILE RANGE', *TRIMMED_MEANS, *MODE_FEATURES, *MEDIAN_FEATURES,
+    *PERCENTILES,
+)
+
+
 def _get_features_for_vector(vec, prefix):
     # Prepare frequently used values
     # Be defensive: if the vector is None or too short, return an empty dict
@@ -116,3 +162,189 @@ class DataEntry(object):
         }
         data.update(self.get_features())
         return data
+
+
+def get_feature_names(features=None):
+    """
+    :param features: iterable of the requested feature names, all the features if None
+    :return: list of the feature names in the order of the entries_to_df columns
+    """
+    names = [f'{prefix} | {name}' for prefix in SIGNALS for name in FEATURES]
+    if features is None:
+        return names
+    features = set(features)
+    return [name for name in names if name in features]
+
+
+def entries_to_df(times, acc, acc_z, temp, sleep=None, features=None):
+    """
+    Computes the features of many epochs at once, the batch equivalent of DataEntry.to_dic for a list of entries.
+
+    :param times: list of epoch times
+    :param acc: list of accelerometer magnitude vectors, one per epoch
+    :param acc_z: list of accelerometer z-angle vectors, one per epoch
+    :param temp: list of temperature vectors, one per epoch
+    :param sleep: list of sleep labels, -1 is used if None
+    :param features: iterable of the feature names to compute, all the features if None
+    :return: pandas dataframe indexed by Date with the same columns as DataEntry.to_dic
+    """
+    features = None if features is None else set(features)
+    frames = []
+    for start in range(0, len(times), BATCH_SIZE):
+        batch = slice(start, start + BATCH_SIZE)
+        columns = {scale_name: -1 if sleep is None else list(sleep[batch])}
+        columns.update(get_features_for_epochs(acc[batch], 'MAGNITUDE', features))
+        columns.update(get_features_for_epochs(acc_z[batch], 'Z_ANGLE', features))
+        columns.update(get_features_for_epochs(temp[batch], 'TEMPERATURE', features))
+        frames.append(pd.DataFrame(columns, index=pd.Index(times[batch], name='Date')))
+    if not frames:
+        return pd.DataFrame(columns=[scale_name], index=pd.Index([], name='Date'))
+    return pd.concat(frames)
+
+
+def get_features_for_epochs(epochs, prefix, features=None):
+    """
+    Vectorized equivalent of _get_features_for_vector for many epochs of one signal.
+
+    The epochs are stored as rows of one 2-D array padded by NaN and sorted once,
+    all the order statistics are then taken from the sorted rows.
+    The results equal the per epoch computation up to the floating point rounding.
+    If only some features are requested, just the statistics needed for them are computed.
+
+    :param epochs: list of 1-D vectors, one per epoch
+    :param prefix: prefix of the feature names
+    :param features: set of the feature names to compute, all the features if None
+    :return: dictionary of feature name to numpy array with one value per epoch, NaN for epochs shorter than 2
+    """
+    wanted = [name for name in FEATURES if features is None or f'{prefix} | {name}' in features]
+    if not wanted:
+        return {}
+
+    def needs(*names):
+        return any(name in wanted for name in names)
+
+    lengths = np.array([len(e) for e in epochs], dtype=np.int64)
+    width = max(int(lengths.max(initial=0)), 2)
+    inside = np.arange(width) < lengths[:, None]
+    values = np.full((len(epochs), width), np.nan)
+    if inside.any():
+        values[inside] = np.concatenate([np.asarray(e, dtype=np.float64) for e in epochs])
+    short = lengths <= 1
+    if short.any():
+        logger.warning(f'{short.sum()} wrong or empty vectors - {prefix}')
+    n = np.maximum(lengths, 2)
+    rows = np.arange(len(epochs))
+
+    if needs(*MODE_FEATURES):
+        order = np.argsort(values, axis=1, kind='stable')
+        ordered = np.take_along_axis(values, order, axis=1)
+    elif needs(*SORTED_FEATURES):
+        ordered = np.sort(values, axis=1)
+    if needs(*SORTED_FEATURES):
+        _max = ordered[rows, n - 1]
+        _min = ordered[:, 0]
+    else:
+        _max = np.where(inside, values, -np.inf).max(axis=1)
+        _min = np.where(inside, values, np.inf).min(axis=1)
+    _range = np.abs(_max - _min)
+    # the samples are shifted by the first one, so the constant epochs get exactly zero deviation
+    # like the exact statistics.variance of the per epoch computation
+    first = np.where(lengths > 0, values[:, 0], 0)
+    shifted = np.where(inside, values - first[:, None], 0)
+    shift_mean = shifted.sum(axis=1) / n
+    _mean = first + shift_mean
+    deviation = np.where(inside, shifted - shift_mean[:, None], 0)
+    m2 = (deviation ** 2).sum(axis=1) / n
+    _var = m2 * n / (n - 1)
+    _std = np.sqrt(_var)
+
+    def quantile(q):
+        return _sorted_quantile(ordered, n, q)
+
+    statistics = {
+        'MAX': lambda: _max,
+        'MIN': lambda: _min,
+        'RELATIVE POSITION OF MAX': lambda: _safe_div(np.where(inside, values, -np.inf).argmax(axis=1), lengths),
+        'RELATIVE POSITION OF MIN': lambda: _safe_div(np.where(inside, values, np.inf).argmin(axis=1), lengths),
+        'RANGE': lambda: _range,
+        'RELATIVE RANGE': lambda: _safe_div(_range, _max),
+        'RELATIVE VARIATION RANGE': lambda: _safe_div(_range, _mean),
+        'INTERQUARTILE RANGE': lambda: quantile(0.75) - quantile(0.25),
+        'RELATIVE INTERQUARTILE RANGE': lambda: _safe_div(quantile(0.75) - quantile(0.25), _max),
+        'INTERDECILE RANGE': lambda: quantile(0.9) - quantile(0.1),
+        'RELATIVE INTERDECILE RANGE': lambda: _safe_div(quantile(0.9) - quantile(0.1), _max),
+        'INTERPERCENTILE RANGE': lambda: quantile(0.99) - quantile(0.01),
+        'RELATIVE INTERPERCENTILE RANGE': lambda: _safe_div(quantile(0.99) - quantile(0.01), _max),
+        'STUDENTIZED RANGE': lambda: _safe_div(_range, _var),
+        'MEAN': lambda: _mean,
+        'MEDIAN': lambda: _median,
+        'MODE': lambda: _mode,
+        'VARIANCE': lambda: _var,
+        'STANDARD DEVIATION': lambda: _std,
+        'MEDIAN ABSOLUTE DEVIATION': lambda: _sorted_median(np.sort(np.abs(ordered - _median[:, None]), axis=1), n),
+        'RELATIVE STANDARD DEVIATION': lambda: _safe_div(_std, _mean),
+        'INDEX OF DISPERSION': lambda: _safe_div(_var, _mean),
+        'KURTOSIS': lambda: _moment_ratio(deviation, n, m2, _mean, 4) - 3,
+        'SKEWNESS': lambda: _moment_ratio(deviation, n, m2, _mean, 3),
+        'PEARSONS 1st SKEWNESS COEFFICIENT': lambda: _safe_div(3 * (_mean - _mode), _std),
+        'PEARSONS 2nd SKEWNESS COEFFICIENT': lambda: _safe_div(3 * (_mean - _median), _std),
+    }
+    statistics.update({name: (lambda p=p: quantile(p / 100)) for name, p in PERCENTILES.items()})
+    if needs(*TRIMMED_MEANS):
+        cumulative = np.zeros((len(epochs), width + 1))
+        np.cumsum(np.where(np.isnan(ordered), 0, ordered), axis=1, out=cumulative[:, 1:])
+        for name, proportion in TRIMMED_MEANS.items():
+            cut = (proportion * n).astype(np.int64)
+            statistics[name] = (lambda c=cut: (cumulative[rows, n - c] - cumulative[rows, c]) / (n - 2 * c))
+    if needs(*MEDIAN_FEATURES):
+        _median = _sorted_median(ordered, n)
+    if needs(*MODE_FEATURES):
+        _mode = _sorted_mode(ordered, order, lengths)
+
+    return {f'{prefix} | {name}': np.where(short, np.nan, statistics[name]()) for name in wanted}
+
+
+def _safe_div(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b == 0, np.nan, a / np.where(b == 0, 1, b))
+
+
+def _moment_ratio(deviation, n, m2, _mean, k):
+    # standardized k-th central moment, NaN for the (nearly) constant vectors as scipy returns
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zero = m2 <= (np.finfo(np.float64).resolution * _mean) ** 2
+        return np.where(zero, np.nan, (deviation ** k).sum(axis=1) / n / m2 ** (k / 2))
+
+
+def _sorted_quantile(ordered, n, q):
+    # linear interpolation the same way as numpy.quantile does
+    index = q * (n - 1)
+    below = np.floor(index).astype(np.int64)
+    above = np.minimum(below + 1, n - 1)
+    t = index - below
+    rows = np.arange(len(ordered))
+    a = ordered[rows, below]
+    b = ordered[rows, above]
+    diff = b - a
+    return np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+
+
+def _sorted_median(ordered, n):
+    rows = np.arange(len(ordered))
+    return (ordered[rows, (n - 1) // 2] + ordered[rows, n // 2]) / 2
+
+
+def _sorted_mode(ordered, order, lengths):
+    # the most common value, the ties are resolved by the first occurrence as statistics.mode does
+    inside = np.arange(ordered.shape[1]) < lengths[:, None]
+    rows, columns = np.nonzero(inside)
+    values = ordered[inside]
+    first_index = order[inside]
+    starts = (columns == 0) | (values != np.roll(values, 1))
+    counts = np.diff(np.append(np.flatnonzero(starts), len(values)))
+    run_rows = rows[starts]
+    best = np.lexsort((first_index[starts], -counts, run_rows))
+    first_of_row = np.append(True, run_rows[best][1:] != run_rows[best][:-1])
+    _mode = np.full(len(ordered), np.nan)
+    _mode[run_rows[best][first_of_row]] = values[starts][best][first_of_row]
+    return _mode
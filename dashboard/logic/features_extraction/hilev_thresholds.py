@@ -0,0 +1,168 @@
+import logging
+from datetime import datetime
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from dashboard.logic import cache
+from dashboard.logic.features_extraction.night_runs import EPOCH_SECONDS, AWAKENING_EPOCHS
+from dashboard.logic.machine_learning.settings import prediction_name
+from dashboard.logic.sleep_diary.structure import create_structure_all
+from dashboard.models import CsvData, SleepDiaryDay
+
+logger = logging.getLogger(__name__)
+
+THRESHOLDS = tuple(round(i / 10, 1) for i in range(1, 11))
+DAY_SECONDS = 24 * 60 * 60
+HILEV_COLUMNS = ['threshold', 'sleep_onset', 'sleep_end', 'tib', 'sol', 'waso', 'wasf', 'wb', 'awk5plus', 'tst']
+
+
+def binarize(probabilities, thresholds=THRESHOLDS):
+    """
+    :param probabilities: 1-D array of the sleep probabilities of the epochs
+    :param thresholds: sleep probability thresholds
+    :return: boolean matrix thresholds x epochs, True for sleep
+    """
+    return np.asarray(probabilities, dtype=np.float64)[None, :] >= np.asarray(thresholds, dtype=np.float64)[:, None]
+
+
+def hilev_for_thresholds(prediction, t1, t4, thresholds=THRESHOLDS):
+    """
+    Computes the high level features of one night for the whole grid of thresholds at once,
+    the values equal the ones computed by hilev with SLEEP_PROBABILITY_THRESHOLD set to the threshold.
+
+    :param prediction: series of the sleep probabilities indexed by the epoch time
+    :param t1: time of going to bed
+    :param t4: time of getting up
+    :param thresholds: sleep probability thresholds
+    :return: dataframe with one row per threshold and HILEV_COLUMNS, the features are NaN if there is no sleep
+    """
+    prediction = prediction.loc[t1:t4]
+    times = prediction.index.values.astype('datetime64[ns]')
+    sleep = binarize(prediction.values, thresholds)
+    has_sleep = sleep.any(axis=1)
+    tib = _seconds(np.datetime64(t4, 'ns') - np.datetime64(t1, 'ns'))
+    if not len(times):
+        return _hilev_frame(thresholds, has_sleep, tib)
+    first = np.argmax(sleep, axis=1)
+    last = sleep.shape[1] - 1 - np.argmax(sleep[:, ::-1], axis=1)
+    epochs = np.arange(sleep.shape[1])
+    inside = (epochs >= first[:, None]) & (epochs <= last[:, None])
+    wake = inside & ~sleep
+    return _hilev_frame(
+        thresholds, has_sleep, tib,
+        sleep_onset=times[first],
+        sleep_end=times[last],
+        sol=_seconds(times[first] - np.datetime64(t1, 'ns')),
+        waso=wake.sum(axis=1) * EPOCH_SECONDS,
+        wasf=_seconds(np.datetime64(t4, 'ns') - times[last]),
+        # the wake bouts are the sleep to wake transitions between the sleep onset and the sleep end but the first one
+        wb=np.maximum(0, (sleep[:, :-1] & wake[:, 1:]).sum(axis=1) - 1),
+        awk5plus=_count_awakenings(sleep & inside, wake),
+    )
+
+
+def hilev_threshold_table(structure=None, thresholds=THRESHOLDS):
+    """
+    Computes the high level features of all the nights for the whole grid of thresholds,
+    the tidy table is meant for the threshold calibration.
+
+    :param structure: list of (subject, csv data, sleep diary day) tuples, all the predicted nights if None
+    :param thresholds: sleep probability thresholds
+    :return: dataframe with one row per night and threshold
+    """
+    start = datetime.now()
+    if structure is None:
+        structure = create_structure_all()
+    result = threshold_table(
+        _structure_nights(structure),
+        lambda prediction, day, night_thresholds: hilev_for_thresholds(prediction, day.t1, day.t4, night_thresholds),
+        thresholds,
+    )
+    if result is None:
+        return pd.DataFrame(columns=['subject', 'date', 'data', *HILEV_COLUMNS])
+    logger.info(f'High level features of {len(result) // len(thresholds)} nights for {len(thresholds)} thresholds '
+                f'computed in {datetime.now() - start}')
+    return result
+
+
+def threshold_table(nights, night_table, thresholds=THRESHOLDS):
+    """
+    Computes a table of all the nights for the whole grid of thresholds at once.
+
+    :param nights: iterable of (columns, prediction, sleep diary day) tuples, columns is a dictionary
+                   of the values identifying the night, prediction is the series of the sleep probabilities
+    :param night_table: function of (prediction, day, thresholds) returning a dataframe with one row per threshold,
+                        None to skip the night
+    :param thresholds: sleep probability thresholds
+    :return: dataframe with the identifying columns and one row per night and threshold, None if there is no night
+    """
+    tables = []
+    for columns, prediction, day in nights:
+        table = night_table(prediction, day, thresholds)
+        if table is None:
+            continue
+        for position, (name, value) in enumerate(columns.items()):
+            table.insert(position, name, value)
+        tables.append(table)
+    if not tables:
+        return None
+    return pd.concat(tables, ignore_index=True)
+
+
+def _structure_nights(structure):
+    # the cached predictions of the nights of the validation structure
+    for subject, data, day in structure:
+        if not isinstance(data, CsvData) or not isinstance(day, SleepDiaryDay):
+            continue
+        if not path.exists(data.cached_prediction_path):
+            logger.warning(f'No predictions for {subject.code} {day.date} {data.filename}')
+            continue
+        prediction = cache.load_predictions(data.cached_prediction_path, columns=[prediction_name])[prediction_name]
+        yield {'subject': subject.code, 'date': day.date, 'data': data.filename}, prediction, day
+
+
+def _hilev_frame(thresholds, has_sleep, tib, **features):
+    result = pd.DataFrame({'threshold': list(thresholds)})
+    for name in HILEV_COLUMNS[1:]:
+        if name in ('sleep_onset', 'sleep_end'):
+            values = features.get(name, np.full(len(thresholds), np.datetime64('NaT', 'ns')))
+            result[name] = pd.to_datetime(np.where(has_sleep, values, np.datetime64('NaT', 'ns')))
+        elif name == 'tib':
+            result[name] = np.where(has_sleep, tib, np.nan)
+        elif name == 'tst':
+            result[name] = result['tib'] - (result['sol'] + result['waso'] + result['wasf'])
+        else:
+            result[name] = np.where(has_sleep, features.get(name, 0), np.nan)
+    return result
+
+
+def _seconds(delta):
+    # whole seconds within a day like timedelta.seconds used by hilev
+    return (np.asarray(delta).astype('timedelta64[s]').astype(np.int64)) % DAY_SECONDS
+
+
+def _count_awakenings(sleep, wake):
+    # the wake runs of at least AWAKENING_EPOCHS count when at least AWAKENING_EPOCHS of sleep precede them
+    # since the last counted awakening, the short wake runs do not reset the sleep counter
+    rows, width = wake.shape
+    padded = np.zeros((rows, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = wake
+    changes = np.diff(padded.ravel())
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    long_runs = ends - starts >= AWAKENING_EPOCHS
+    starts = starts[long_runs]
+    run_rows = starts // (width + 2)
+    # sleep epochs before each run start, the run start is a column in the padded row shifted by one
+    sleep_before = np.zeros((rows, width + 1), dtype=np.int64)
+    np.cumsum(sleep, axis=1, out=sleep_before[:, 1:])
+    sleep_counts = sleep_before[run_rows, starts % (width + 2)]
+    awakenings = np.zeros(rows, dtype=np.int64)
+    counted = np.zeros(rows, dtype=np.int64)
+    for row, sleep_count in zip(run_rows, sleep_counts):
+        if sleep_count - counted[row] >= AWAKENING_EPOCHS:
+            awakenings[row] += 1
+            counted[row] = sleep_count
+    return awakenings
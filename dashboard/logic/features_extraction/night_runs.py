@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+WAKE = 0
+SLEEP = 1
+EPOCH_SECONDS = 30
+# 10 * 30s = 5 minutes of wake, after at least 5 minutes of sleep, make one awakening
+AWAKENING_EPOCHS = 10
+
+
+class NightRuns(object):
+    """
+    Run-length encoded sleep/wake prediction of one night in bed.
+
+    The night is stored as the runs of the same state, each run has its first epoch, length and state
+    and the times of its first and last epoch, as the epochs are not exactly 30 s apart.
+    All the high level features are computed from the runs without going through the single epochs.
+    """
+
+    def __init__(self, starts, lengths, states, start_times, end_times, epoch_seconds=EPOCH_SECONDS):
+        """
+        :param starts: int32 array with the first epoch of each run
+        :param lengths: int32 array with the number of epochs of each run
+        :param states: int8 array with the state of each run, WAKE or SLEEP
+        :param start_times: datetime64 array with the time of the first epoch of each run
+        :param end_times: datetime64 array with the time of the last epoch of each run
+        :param epoch_seconds: length of one epoch in seconds
+        """
+        self.starts = starts
+        self.lengths = lengths
+        self.states = states
+        self.start_times = start_times
+        self.end_times = end_times
+        self.epoch_seconds = epoch_seconds
+        sleep_runs = np.flatnonzero(states == SLEEP)
+        # runs from the first to the last sleep run, the total sleep time interval
+        self._first = int(sleep_runs[0]) if len(sleep_runs) else 0
+        self._last = int(sleep_runs[-1]) if len(sleep_runs) else -1
+
+    @classmethod
+    def from_prediction(cls, prediction, epoch_seconds=EPOCH_SECONDS):
+        """
+        :param prediction: series of the binary prediction (1 for sleep) indexed by the epoch time
+        :param epoch_seconds: length of one epoch in seconds
+        :return: NightRuns
+        """
+        states = np.asarray(prediction.values, dtype=np.int8)
+        times = prediction.index.values.astype('datetime64[ns]')
+        starts = np.flatnonzero(np.concatenate(([True], states[1:] != states[:-1]))).astype(np.int32) \
+            if len(states) else np.empty(0, dtype=np.int32)
+        lengths = np.diff(np.append(starts, len(states))).astype(np.int32)
+        return cls(starts, lengths, states[starts], times[starts], times[starts + lengths - 1], epoch_seconds)
+
+    def __len__(self):
+        return int(self.lengths.sum())
+
+    def __str__(self):
+        return f'NightRuns[{len(self)} epochs in {len(self.starts)} runs]'
+
+    @property
+    def has_sleep(self):
+        return self._last >= 0
+
+    @property
+    def sleep_onset(self):
+        """
+        :return: time of the first sleep epoch
+        """
+        return pd.Timestamp(self.start_times[self._first]).to_pydatetime()
+
+    @property
+    def sleep_end(self):
+        """
+        :return: time of the last sleep epoch
+        """
+        return pd.Timestamp(self.end_times[self._last]).to_pydatetime()
+
+    @property
+    def tst_runs(self):
+        """
+        :return: slice of the runs from the sleep onset to the sleep end
+        """
+        return slice(self._first, self._last + 1)
+
+    @property
+    def waso(self):
+        """
+        :return: wake after sleep onset in seconds
+        """
+        runs = self.tst_runs
+        return int(self.lengths[runs][self.states[runs] == WAKE].sum()) * self.epoch_seconds
+
+    @property
+    def wake_bouts(self):
+        """
+        :return: number of the wake runs between the sleep onset and the sleep end but the first one
+        """
+        runs = self.tst_runs
+        return max(0, int((self.states[runs] == WAKE).sum()) - 1)
+
+    @property
+    def awakenings(self):
+        """
+        Counts the wake runs of at least 5 minutes, which follow at least 5 minutes of sleep
+        since the previous counted awakening, the shorter wake runs do not interrupt the sleep.
+
+        :return: number of awakenings longer than 5 minutes
+        """
+        runs = self.tst_runs
+        states = self.states[runs]
+        lengths = self.lengths[runs]
+        sleep = np.where(states == SLEEP, lengths, 0)
+        sleep_before = np.cumsum(sleep) - sleep
+        awakenings = 0
+        counted = 0
+        for sleep_count in sleep_before[(states == WAKE) & (lengths >= AWAKENING_EPOCHS)]:
+            if sleep_count - counted >= AWAKENING_EPOCHS:
+                awakenings += 1
+                counted = sleep_count
+        return awakenings
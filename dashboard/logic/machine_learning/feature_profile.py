@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+
+import xgboost as xgb
+
+from dashboard.logic.features_extraction.data_entry import get_feature_names
+from mysite.settings import TRAINED_MODEL_EXPORT_PATH, COMPACT_MODEL_EXPORT_PATH, INFERENCE_PROFILE
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+FULL_PROFILE = 'full'
+REDUCED_PROFILE = 'reduced'
+
+_manifests = {}
+
+
+def get_manifest_path(model_path=TRAINED_MODEL_EXPORT_PATH):
+    return f'{os.path.splitext(model_path)[0]}_features.json'
+
+
+def build_feature_manifest(booster, names, model_path):
+    """
+    Describes the input of the model, the features used by any split are found from the feature importance.
+
+    :param booster: trained xgboost booster
+    :param names: feature names in the order of the model input columns
+    :param model_path: path to the exported model the manifest belongs to
+    :return: dictionary with the input features, the used features and their gain
+    """
+    if booster.num_features() != len(names):
+        raise ValueError(f'The model has {booster.num_features()} features, but {len(names)} names were given')
+    scores = booster.get_score(importance_type='gain')
+    # the boosters trained on numpy arrays name the features by their position
+    gain = {name: scores.get(name, scores.get(f'f{i}')) for i, name in enumerate(names)}
+    return {
+        'version': MANIFEST_VERSION,
+        'model': os.path.basename(model_path),
+        'model_sha256': _file_hash(model_path),
+        'features': list(names),
+        'used': [name for name in names if gain[name] is not None],
+        'gain': {name: value for name, value in gain.items() if value is not None},
+    }
+
+
+def write_feature_manifest(model_path=TRAINED_MODEL_EXPORT_PATH, names=None):
+    """
+    Saves the feature manifest next to the exported model.
+
+    :param model_path: path to the exported model
+    :param names: feature names in the order of the model input columns, all the epoch features if None
+    :return: the manifest
+    """
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    manifest = build_feature_manifest(booster, get_feature_names() if names is None else names, model_path)
+    manifest_path = get_manifest_path(model_path)
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, manifest_path)
+    logger.info(f'Feature manifest of {os.path.basename(model_path)} with {len(manifest["used"])} of '
+                f'{len(manifest["features"])} features used saved to {manifest_path}')
+    return manifest
+
+
+def load_feature_manifest(model_path=TRAINED_MODEL_EXPORT_PATH):
+    """
+    Loads the feature manifest of the exported model, the manifest of another model file is ignored.
+
+    :param model_path: path to the exported model
+    :return: the manifest, None if it is missing or does not belong to the model
+    """
+    manifest_path = get_manifest_path(model_path)
+    if not os.path.exists(manifest_path) or not os.path.exists(model_path):
+        return None
+    key = (_file_key(model_path), _file_key(manifest_path))
+    cached = _manifests.get(model_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('model_sha256') != _file_hash(model_path):
+        logger.warning(f'Feature manifest {manifest_path} does not belong to the model {model_path}, ignoring it')
+        manifest = None
+    _manifests[model_path] = (key, manifest)
+    return manifest
+
+
+def get_inference_model_path(profile=INFERENCE_PROFILE):
+    """
+    :param profile: full computes all the epoch features, reduced only the features used by the model
+    :return: path to the exported model used by the prediction, the compact model in the reduced profile if trained
+    """
+    if profile == REDUCED_PROFILE and os.path.exists(COMPACT_MODEL_EXPORT_PATH):
+        return COMPACT_MODEL_EXPORT_PATH
+    return TRAINED_MODEL_EXPORT_PATH
+
+
+def get_inference_features(profile=INFERENCE_PROFILE, model_path=None):
+    """
+    :param profile: full computes all the epoch features, reduced only the features used by the model
+    :param model_path: path to the exported model, the model of the profile if None
+    :return: list of the features computed by the prediction-only preprocessing, None for all the features
+    """
+    if profile != REDUCED_PROFILE:
+        return None
+    if model_path is None:
+        model_path = get_inference_model_path(profile)
+    manifest = load_feature_manifest(model_path)
+    if manifest is None and os.path.exists(model_path):
+        manifest = write_feature_manifest(model_path)
+    if manifest is None:
+        logger.warning(f'No model {model_path} to reduce the features, all the features will be computed')
+        return None
+    return manifest['used']
+
+
+def get_features_key(profile=INFERENCE_PROFILE, model_path=None):
+    """
+    Identifies the features computed by the prediction-only preprocessing,
+    the cached features of another key have to be computed again.
+
+    :param profile: full computes all the epoch features, reduced only the features used by the model
+    :param model_path: path to the exported model, the model of the profile if None
+    :return: full for all the features, the hash of the model for its reduced features
+    """
+    if model_path is None:
+        model_path = get_inference_model_path(profile)
+    if get_inference_features(profile, model_path) is None:
+        return FULL_PROFILE
+    return load_feature_manifest(model_path)['model_sha256']
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
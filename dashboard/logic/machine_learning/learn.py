@@ -16,14 +16,16 @@ from sklearn.model_selection import (
     cross_validate,
 )
 
-from dashboard.logic.cache import save_obj, load_obj
+from dashboard.logic.cache import save_obj, load_obj, load_features
 from dashboard.logic.machine_learning.classification_metrics import scoring, sensitivity_score, specificity_score
+from dashboard.logic.machine_learning.feature_profile import load_feature_manifest, write_feature_manifest, \
+    REDUCED_PROFILE
 from dashboard.logic.machine_learning.settings import scale_name, model_params, search_settings, model_name
 from dashboard.logic.machine_learning.visualisation import plot_fi, df_into_to_sting, \
     plot_logloss_and_error, plot_cross_validation, shap_summary_plot, shap_beeswarm_plot
 from dashboard.models import CsvData
 from mysite.settings import ML_DIR, HYPER_PARAMS_PATH, DATASET_PATH, DATASET_PARQUET_PATH, TRAINED_MODEL_PATH, \
-    BEST_ESTIMATOR_PATH, CV_RESULTS_PATH, TRAINED_MODEL_EXPORT_PATH
+    BEST_ESTIMATOR_PATH, CV_RESULTS_PATH, TRAINED_MODEL_EXPORT_PATH, COMPACT_MODEL_EXPORT_PATH, INFERENCE_PROFILE
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +33,8 @@ logger = logging.getLogger(__name__)
 def prepare_model():
     start = datetime.now()
     learn()
+    if INFERENCE_PROFILE == REDUCED_PROFILE:
+        learn_compact_model()
     end = datetime.now()
     logger.info(f'Whole learning process took {end - start}')
     return True
@@ -123,6 +127,7 @@ def learn():
         train_model_test_train_data(model, x_test, x_train, y_test, y_train)
         save_obj(model, TRAINED_MODEL_PATH)
         model.save_model(TRAINED_MODEL_EXPORT_PATH)
+        write_feature_manifest(TRAINED_MODEL_EXPORT_PATH, names)
 
     # Plot the feature importances
     plot_fi(model, names, scale_name, sort=True, save_dir=ML_DIR)
@@ -161,6 +166,36 @@ def learn():
     return model
 
 
+def learn_compact_model():
+    """
+    Trains the compact model on just the features used by the exported model and exports it next to it,
+    the reduced inference profile predicts by the compact model and computes only its features.
+    The full model stays exported in TRAINED_MODEL_EXPORT_PATH and its parameters are reused.
+    The missing values are passed to the booster like at the inference, they are not imputed.
+    """
+    start = datetime.now()
+    manifest = load_feature_manifest(TRAINED_MODEL_EXPORT_PATH)
+    if manifest is None:
+        manifest = write_feature_manifest(TRAINED_MODEL_EXPORT_PATH)
+    x, y, names, groups = load_data()
+    used = manifest['used']
+    x = x[:, [names.index(name) for name in used]].astype(np.float32)
+    y = y.astype(np.int32).ravel()
+    logger.info(f'Compact model will be trained on {len(used)} of {len(names)} features')
+
+    params = load_obj(TRAINED_MODEL_PATH).get_params() if os.path.exists(TRAINED_MODEL_PATH) else dict(model_params)
+    params = _ensure_gpu_params(params)
+    spw = _compute_scale_pos_weight(y)
+    if spw is not None:
+        params["scale_pos_weight"] = spw
+    model = xgb.sklearn.XGBClassifier(**params)
+    model.fit(x, y, verbose=False)
+    model.save_model(COMPACT_MODEL_EXPORT_PATH)
+    write_feature_manifest(COMPACT_MODEL_EXPORT_PATH, used)
+    logger.info(f'Compact model trained and exported in {datetime.now() - start}')
+    return model
+
+
 def log_data_info(y_train):
     y_tmp = y_train.ravel()
     logger.info(f'Data len: {len(y_tmp)}')
@@ -211,7 +246,7 @@ def load_data():
         for d in data:
             # Include both standard training and DREAMT datasets
             if d.training_data and os.path.exists(d.x_data_path):
-                df = pd.read_excel(d.x_data_path, index_col=0)
+                df = load_features(d.x_data_path)
                 # Only use files that contain the required label column
                 if scale_name not in df.columns:
                     logger.info(f'Skipping {d.x_data_path}: missing label column {scale_name}')
@@ -242,7 +277,7 @@ def load_data():
         for d in data:
             # Include both standard training and DREAMT datasets
             if d.training_data and os.path.exists(d.x_data_path):
-                df = pd.read_excel(d.x_data_path, index_col=0)
+                df = load_features(d.x_data_path)
                 if scale_name not in df.columns:
                     logger.info(f'Skipping {d.x_data_path}: missing label column {scale_name}')
                     continue
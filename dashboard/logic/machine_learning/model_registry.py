@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+import xgboost as xgb
+
+from mysite.settings import TRAINED_MODEL_EXPORT_PATH
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_models = {}
+
+
+class LoadedModel(object):
+    """
+    XGBoost booster loaded from the exported model file together with the file state it was loaded from.
+    """
+
+    def __init__(self, path, key, booster):
+        """
+        :param path: path to the exported model
+        :param key: (modification time, size) of the model file
+        :param booster: loaded xgboost booster
+        """
+        self.path = path
+        self.key = key
+        self.booster = booster
+        self.feature_names = booster.feature_names
+        self.num_features = booster.num_features()
+        self.version = '.'.join(str(v) for v in json.loads(booster.save_config()).get('version', []))
+
+    def __str__(self):
+        return f'LoadedModel[{os.path.basename(self.path)}: xgboost {self.version}, {self.num_features} features]'
+
+
+def get_model(path=TRAINED_MODEL_EXPORT_PATH):
+    """
+    Returns the model loaded once per process, the model is loaded again only when its file changes.
+    Safe to be called from more threads, the booster itself is thread safe for prediction.
+
+    :param path: path to the exported model
+    :return: LoadedModel
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    model = _models.get(path)
+    if model is not None and model.key == key:
+        return model
+    with _lock:
+        model = _models.get(path)
+        if model is None or model.key != key:
+            start = datetime.now()
+            booster = xgb.Booster()
+            booster.load_model(path)
+            model = LoadedModel(path, key, booster)
+            _models[path] = model
+            logger.info(f'{model} loaded from {path} in {datetime.now() - start}')
+    return model
+
+
+def get_booster(path=TRAINED_MODEL_EXPORT_PATH):
+    return get_model(path).booster
@@ -2,52 +2,122 @@ import logging
 import os
 from datetime import datetime
 
-import pandas as pd
-
 from dashboard.logic import cache
-from dashboard.logic.machine_learning.predict_core import predict_core
-from dashboard.logic.preprocessing.preprocess_data import preprocess_data
+from dashboard.logic.machine_learning.predict_core import predict_core, predict_batch
+from dashboard.logic.preprocessing.preprocess_data import preprocess_data, update_prediction_data, \
+    prediction_data_outdated
 from dashboard.models import CsvData
 
 logger = logging.getLogger(__name__)
 
+# feature rows of more recordings scored at once in the batched prediction
+BATCH_ROWS = 500_000
+
+
+def predict_all(force=False, batch=True):
+    """
+    Predicts all the csv data, the recordings changed since their prediction get just their new tail predicted.
 
-def predict_all():
+    :param force: predict again even the data with cached predictions, e.g. after the model update
+    :param batch: score the features of many recordings in a single booster call, False predicts them one by one
+    :return: True if all the data were predicted
+    """
     start = datetime.now()
     data = CsvData.objects.all()
     logger.info(f'{len(data)} csv data objects will be used for prediction')
-    result = True
-    for d in data:
-        if predict(d) is None:
-            result = False
+    if batch:
+        result = _predict_all_batched(data, force)
+    else:
+        result = True
+        for d in data:
+            if predict(d, force, incremental=prediction_data_outdated(d)) is None:
+                result = False
     end = datetime.now()
     logger.info(f'Prediction of all the {len(data)} data took {end - start}')
     return result
 
 
-def predict(csv_data, force=False):
+def predict(csv_data, force=False, incremental=False):
+    """
+    Predicts the csv data, the cached predictions are used if they exist.
+    The same frame of the prediction store is returned however the predictions were made.
+
+    :param csv_data: CsvData to predict
+    :param force: predict again even the data with cached predictions
+    :param incremental: predict just the new tail of the prediction recording extended since the last prediction
+    :return: dataframe of the prediction store, the prediction and the scale of the training data indexed by
+             the epoch time, None if the data cannot be predicted
+    """
     if isinstance(csv_data, CsvData):
         start = datetime.now()
 
+        if incremental and not force and not csv_data.training_data and not csv_data.dreamt_data \
+                and os.path.exists(csv_data.x_data_path):
+            logger.info(f'Predictions of {csv_data.filename} will be updated for the new data')
+            if not update_prediction_data(csv_data):
+                logger.warning(f'Data {csv_data.filename} cannot be preprocessed')
+                return None
+            return cache.load_predictions(csv_data.cached_prediction_path)
+
         if os.path.exists(csv_data.cached_prediction_path) and not force:
             logger.info(f'Prediction features data for {csv_data.filename} will be loaded from cache')
-            df = cache.load_obj(csv_data.cached_prediction_path)
+            df = cache.load_predictions(csv_data.cached_prediction_path)
             return df
 
         else:
-            result = preprocess_data(csv_data)
+            result = preprocess_data(csv_data, predict=False)
             if not result:
                 logger.warning(f'Data {csv_data.filename} cannot be preprocessed')
                 return None
 
             logger.info(f'Prediction need to be done for {csv_data.filename}')
-            df = pd.read_excel(csv_data.x_data_path, index_col=0)
+            df = cache.load_features(csv_data.x_data_path)
             predict_core(csv_data, df)
 
             end = datetime.now()
             logger.info(f'Prediction for {csv_data.filename} made in {end - start}')
-            return df
+            return cache.load_predictions(csv_data.cached_prediction_path)
     else:
         return None
 
 
+def get_prediction_excel(csv_data):
+    """
+    Exports the predictions of the csv data into excel, the export is reused until the data are predicted again.
+
+    :param csv_data: CsvData with the predictions
+    :return: path to the excel file, None if the data are not predicted
+    """
+    if not os.path.exists(csv_data.cached_prediction_path):
+        return None
+    if not os.path.exists(csv_data.excel_prediction_path) or \
+            os.path.getmtime(csv_data.excel_prediction_path) < os.path.getmtime(csv_data.cached_prediction_path):
+        start = datetime.now()
+        cache.export_predictions_to_excel(csv_data.cached_prediction_path, csv_data.excel_prediction_path,
+                                          csv_data.x_data_path)
+        logger.info(f'Predictions of {csv_data.filename} exported to excel in {datetime.now() - start}')
+    return csv_data.excel_prediction_path
+
+
+def _predict_all_batched(data, force):
+    result = True
+    batch, rows = [], 0
+    for d in data:
+        if os.path.exists(d.cached_prediction_path) and not force:
+            # the extended recordings are updated one by one, just their new epochs are scored
+            if prediction_data_outdated(d) and predict(d, incremental=True) is None:
+                result = False
+            continue
+        # the new data are scored once by the batch, not by the preprocessing
+        if not preprocess_data(d, predict=False):
+            logger.warning(f'Data {d.filename} cannot be preprocessed')
+            result = False
+            continue
+        df = cache.load_features(d.x_data_path)
+        batch.append((d, df))
+        rows += len(df)
+        if rows >= BATCH_ROWS:
+            predict_batch(batch)
+            batch, rows = [], 0
+    predict_batch(batch)
+    return result
@@ -1,23 +1,91 @@
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
 import xgboost as xgb
 
 from dashboard.logic import cache
+from dashboard.logic.machine_learning.feature_profile import load_feature_manifest, get_inference_model_path
+from dashboard.logic.machine_learning.model_registry import get_booster
 from dashboard.logic.machine_learning.settings import prediction_name, scale_name
-from mysite.settings import TRAINED_MODEL_EXPORT_PATH
+
+logger = logging.getLogger(__name__)
 
 
 def predict_core(csv_data, df):
-    predictions = _predict(df)
-    df[prediction_name] = predictions
-    cache.save_obj(df, csv_data.cached_prediction_path)
-    df.to_excel(csv_data.excel_prediction_path)
-
-
-def _predict(df):
-    x = df[[c for c in df.columns if c != scale_name]].values
-    booster = xgb.Booster()
-    model_path = TRAINED_MODEL_EXPORT_PATH
-    print(f'Loading model from {model_path}')
-    booster.load_model(model_path)
+    predictions = predict_features(df)
+    _save_predictions(csv_data, df, predictions)
+
+
+def append_predictions(csv_data, previous, df):
+    """
+    Predicts just the new epochs and appends them to the previous predictions of the recording,
+    the previous epochs from the first new epoch on are replaced.
+
+    :param csv_data: CsvData of the recording
+    :param previous: dataframe with the previous predictions
+    :param df: features of the new epochs
+    """
+    df[prediction_name] = predict_features(df)
+    _save_predictions(csv_data, pd.concat([previous[previous.index < df.index[0]], df[previous.columns]]))
+
+
+def predict_batch(items):
+    """
+    Predicts the features of many recordings at once, the feature rows are copied into one contiguous float32 matrix
+    scored by a single booster call and the predictions are split back by the offsets of the recordings.
+
+    :param items: list of (csv_data, df) tuples with the features of the recordings
+    """
+    items = [(csv_data, df) for csv_data, df in items if len(df)]
+    if not items:
+        return
+    start = datetime.now()
+    model_path = get_inference_model_path()
+    manifest = load_feature_manifest(model_path)
+    columns = [_feature_columns(df, manifest) for _, df in items]
+    if any(len(c) != len(columns[0]) for c in columns):
+        raise ValueError(f'The recordings have different number of features: {sorted(set(len(c) for c in columns))}')
+    offsets = np.concatenate(([0], np.cumsum([len(df) for _, df in items])))
+    x = np.empty((offsets[-1], len(columns[0])), dtype=np.float32)
+    for (_, df), c, first, last in zip(items, columns, offsets[:-1], offsets[1:]):
+        x[first:last] = df.reindex(columns=c).values
+    predictions = get_booster(model_path).inplace_predict(x)
+    logger.info(f'{len(items)} recordings with {len(x)} epochs scored in {datetime.now() - start}')
+    for (csv_data, df), first, last in zip(items, offsets[:-1], offsets[1:]):
+        _save_predictions(csv_data, df, predictions[first:last])
+
+
+def predict_features(df):
+    """
+    Scores the feature rows by the trained model.
+
+    :param df: dataframe with the features of the epochs
+    :return: array with the prediction of every epoch
+    """
+    model_path = get_inference_model_path()
+    x = df.reindex(columns=_feature_columns(df, load_feature_manifest(model_path))).values
     dmat = xgb.DMatrix(x)
-    preds = booster.predict(dmat)
+    preds = get_booster(model_path).predict(dmat)
     return preds
+
+
+def _feature_columns(df, manifest):
+    # the model input columns, the features not used by the model may be missing in the reduced profile
+    if manifest is None:
+        return [c for c in df.columns if c != scale_name]
+    missing = [c for c in manifest['used'] if c not in df.columns]
+    if missing:
+        logger.warning(f'{len(missing)} features used by the model are missing, the data should be preprocessed again')
+    return manifest['features']
+
+
+def _save_predictions(csv_data, df, predictions=None):
+    if predictions is not None:
+        df[prediction_name] = predictions
+    cache.save_predictions(df, csv_data.cached_prediction_path)
+    # the excel file is exported again from the new predictions once it is requested
+    if os.path.exists(csv_data.excel_prediction_path):
+        os.remove(csv_data.excel_prediction_path)
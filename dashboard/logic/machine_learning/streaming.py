@@ -0,0 +1,132 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from dashboard.logic.features_extraction.data_entry import entries_to_df
+from dashboard.logic.machine_learning.feature_profile import get_inference_features
+from dashboard.logic.machine_learning.predict_core import predict_features
+from dashboard.logic.machine_learning.settings import prediction_name
+from dashboard.logic.preprocessing.csv_epochs import cut_prediction_epochs, epoch_samples, to_signals
+from dashboard.logic.preprocessing.night_intervals import NightIntervals
+from dashboard.logic.preprocessing.preprocess_csv_data import get_frequency_modulo
+from dashboard.logic.preprocessing.raw_store import CHUNK_SIZE
+from dashboard.logic.preprocessing.timestamps import NANOSECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class SleepWakeStream(object):
+    """
+    Classifies the raw GENEActiv samples into sleep and wake while they arrive.
+
+    The samples are cut into the same epochs as by the prediction preprocessing of the whole recording.
+    Only the samples of the unfinished epoch are kept between the chunks,
+    so the memory does not grow with the length of the recording.
+    """
+
+    def __init__(self, frequency, nights=None, callback=None):
+        """
+        :param frequency: measurement frequency from the GENEActiv header, e.g. '25.0 Hz'
+        :param nights: NightIntervals or list of (start, end) datetime tuples, all the samples are classified if None
+        :param callback: function called with the predictions series whenever some epochs are completed
+        """
+        self.frequency_modulo = get_frequency_modulo(frequency)
+        if self.frequency_modulo == 0:
+            raise ValueError(f'Unsupported measurement frequency: {frequency}')
+        if nights is not None and not isinstance(nights, NightIntervals):
+            nights = NightIntervals(nights)
+        self.nights = nights
+        self.callback = callback
+        self.features = get_inference_features()
+        self.epochs = 0
+        self._pending = None
+
+    def __str__(self):
+        return f'SleepWakeStream[{self.epochs} epochs classified]'
+
+    def push(self, timestamps, x, y, z, temperature):
+        """
+        Adds the next chunk of samples, the samples have to follow the previous chunk.
+
+        :param timestamps: datetime64 array or int64 array of nanoseconds since the unix epoch
+        :param x: x axis acceleration
+        :param y: y axis acceleration
+        :param z: z axis acceleration
+        :param temperature: temperature
+        :return: series of the predictions indexed by Date of the epochs completed by the chunk
+        """
+        seconds = _to_seconds(timestamps)
+        rows = to_signals(seconds, *(np.asarray(c, dtype=np.float64) for c in (x, y, z, temperature)))
+        if self._pending is not None:
+            rows = tuple(np.concatenate((p, r)) for p, r in zip(self._pending, rows))
+        seconds = rows[0]
+        inside = np.ones(len(seconds), dtype=bool) if self.nights is None else self.nights.contains(seconds)
+        bounds, pending_anchor = cut_prediction_epochs(seconds, inside)
+        epochs = [epoch_samples(rows, anchor, stop, self.frequency_modulo) for anchor, stop in bounds]
+        # the caller may reuse its buffers, so the unfinished epoch is copied
+        self._pending = None if pending_anchor is None else tuple(r[pending_anchor:].copy() for r in rows)
+        return self._emit(epochs)
+
+    def close(self):
+        """
+        Classifies the epoch left unfinished at the end of the recording.
+
+        :return: series with the prediction of the last epoch, empty if there is no such epoch
+        """
+        pending, self._pending = self._pending, None
+        epochs = []
+        if pending is not None and len(pending[0]) > 1:
+            epochs.append(epoch_samples(pending, 0, len(pending[0]), self.frequency_modulo))
+        return self._emit(epochs)
+
+    def _emit(self, epochs):
+        if not epochs:
+            return pd.Series([], index=pd.DatetimeIndex([], name='Date'), name=prediction_name, dtype=np.float32)
+        times, acc, acc_z, temp = (list(signal) for signal in zip(*epochs))
+        df = entries_to_df(times, acc, acc_z, temp, features=self.features)
+        predictions = pd.Series(predict_features(df), index=df.index, name=prediction_name)
+        self.epochs += len(predictions)
+        if self.callback is not None:
+            self.callback(predictions)
+        return predictions
+
+
+def stream_predictions(chunks, frequency, nights=None):
+    """
+    Classifies the recording chunk by chunk, e.g. from RawStore.iter_slices or a live device reader.
+
+    :param chunks: iterable of (timestamps, x, y, z, temperature) tuples of consecutive samples
+    :param frequency: measurement frequency from the GENEActiv header, e.g. '25.0 Hz'
+    :param nights: NightIntervals or list of (start, end) datetime tuples, all the samples are classified if None
+    :return: generator of the predictions series indexed by Date, one per chunk completing some epochs
+    """
+    stream = SleepWakeStream(frequency, nights)
+    for chunk in chunks:
+        predictions = stream.push(*chunk)
+        if len(predictions):
+            yield predictions
+    predictions = stream.close()
+    if len(predictions):
+        yield predictions
+    logger.info(f'{stream} finished')
+
+
+def stream_store_predictions(store, nights=None, chunk_size=CHUNK_SIZE):
+    """
+    Classifies the samples of the raw store chunk by chunk, no features are cached.
+
+    :param store: RawStore of the recording
+    :param nights: NightIntervals or list of (start, end) datetime tuples, all the samples are classified if None
+    :param chunk_size: number of rows read at once
+    :return: generator of the predictions series indexed by Date
+    """
+    chunks = ((c['time'], c['x'], c['y'], c['z'], c['temperature']) for c in store.iter_slices(0, chunk_size))
+    return stream_predictions(chunks, store.frequency, nights)
+
+
+def _to_seconds(timestamps):
+    timestamps = np.asarray(timestamps)
+    if np.issubdtype(timestamps.dtype, np.datetime64):
+        timestamps = timestamps.astype('datetime64[ns]').view(np.int64)
+    return timestamps.astype(np.int64) // NANOSECONDS
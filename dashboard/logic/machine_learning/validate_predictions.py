@@ -35,25 +35,18 @@ def _load_df_for_csv(csv: CsvData) -> Optional[pd.DataFrame]:
     """Load prediction DataFrame for a given CsvData.
 
     Preference order:
-    - Pickled DataFrame at `cached_prediction_path` (fast, includes predictions)
-    - Excel at `excel_prediction_path` (slower)
-    - Excel at `x_data_path` (features/labels only; may be missing predictions)
+    - Prediction store at `cached_prediction_path` (labels and predictions only)
+    - Feature store at `x_data_path` (features/labels only; may be missing predictions)
     """
     if os.path.exists(csv.cached_prediction_path):
         try:
-            return cache.load_obj(csv.cached_prediction_path)
-        except Exception:
-            pass
-
-    if os.path.exists(csv.excel_prediction_path):
-        try:
-            return pd.read_excel(csv.excel_prediction_path, index_col=0)
+            return cache.load_predictions(csv.cached_prediction_path, columns=[scale_name, prediction_name])
         except Exception:
             pass
 
     if os.path.exists(csv.x_data_path):
         try:
-            return pd.read_excel(csv.x_data_path, index_col=0)
+            return cache.load_features(csv.x_data_path)
         except Exception:
             pass
 
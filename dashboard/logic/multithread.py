@@ -1,4 +1,8 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.db import connections
 
 
 def parallel_for(data, func):
@@ -15,3 +19,24 @@ def parallel_for_with_param(data, func, param):
         for d in data:
             processes.append(executor.submit(func, d, param))
     return as_completed(processes)
+
+
+def process_pool(workers):
+    """
+    Creates a pool of worker processes able to work with Django models.
+
+    The database connections are closed before the processes are started, so no worker shares the parent's
+    connection, each worker opens its own connection on the first query.
+
+    :param workers: number of worker processes
+    :return: process pool executor
+    """
+    connections.close_all()
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+
+def _init_worker():
+    # processes started by spawn have to configure Django again, forked ones just drop the inherited connections
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
@@ -0,0 +1,236 @@
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .night_intervals import NightIntervals
+from .preprocess_csv_data import get_frequency_modulo
+from .raw_store import CHUNK_SIZE
+from .timestamps import NANOSECONDS
+
+logger = logging.getLogger(__name__)
+
+# the epoch starts with the first sample after the anchor sample and ends with the first sample 30 s after it,
+# the epoch itself is labeled by the time in the middle of the window
+EPOCH_LENGTH = 30
+EPOCH_OFFSET = 15
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def iter_store_chunks(store, row=0, chunk_size=CHUNK_SIZE):
+    """
+    Reads the samples of the raw store in chunks of numpy arrays.
+
+    :param store: RawStore of the recording
+    :param row: first row to read
+    :param chunk_size: number of rows read at once
+    :return: generator of (seconds, x, y, z, temperature) tuples
+    """
+    for columns in store.iter_slices(row, chunk_size):
+        yield (
+            columns['time'] // NANOSECONDS,
+            columns['x'].astype(np.float64),
+            columns['y'].astype(np.float64),
+            columns['z'].astype(np.float64),
+            columns['temperature'].astype(np.float64),
+        )
+
+
+def iter_prediction_epochs(store, nights, chunk_size=CHUNK_SIZE, row=None):
+    """
+    Splits the GENEActiv recording into epochs inside the sleep diary nights.
+
+    Each epoch starts after an anchor sample inside some night and takes every n-th sample
+    (according to the measurement frequency) up to and including the first sample at least 30 s after the anchor.
+    The next anchor is the first sample after the epoch which lies inside some night.
+    The parts of the recording between the nights are skipped.
+
+    :param store: RawStore of the recording
+    :param nights: NightIntervals or list of (start, end) datetime tuples, the samples strictly inside are processed
+    :param chunk_size: number of rows read at once
+    :param row: anchor row of the first epoch to resume the processing from, the beginning of the first night if None
+    :return: generator of (time, magnitude, z-angle, temperature, anchor row) tuples
+             with numpy arrays of the epoch samples
+    """
+    frequency_modulo = get_frequency_modulo(store.frequency)
+    if not isinstance(nights, NightIntervals):
+        nights = NightIntervals(nights)
+    if frequency_modulo == 0 or not len(nights):
+        return
+    if row is None:
+        row = _next_row(store, nights, -np.inf) or 0
+
+    pending, pending_row = None, None
+    while row is not None:
+        chunks = iter_store_chunks(store, row, chunk_size)
+        chunk_row = row
+        row = None
+        for seconds, x, y, z, temp in chunks:
+            rows = to_signals(seconds, x, y, z, temp)
+            # store row of the first sample in rows
+            first_row = chunk_row
+            chunk_row += len(seconds)
+            if pending is not None:
+                first_row = pending_row
+                rows = tuple(np.concatenate((p, r)) for p, r in zip(pending, rows))
+            seconds = rows[0]
+            bounds, pending_anchor = cut_prediction_epochs(seconds, nights.contains(seconds))
+            for anchor, stop in bounds:
+                yield _epoch(rows, anchor, stop, frequency_modulo, first_row)
+            pending = None
+            if pending_anchor is not None:
+                pending = tuple(r[pending_anchor:] for r in rows)
+                pending_row = first_row + pending_anchor
+            if pending is None and len(seconds):
+                if seconds[-1] > nights.end:
+                    chunks.close()
+                    return
+                row = _next_row(store, nights, seconds[-1])
+                if row is not None:
+                    # there is no night until the next indexed row, so the rest of the gap is skipped
+                    chunks.close()
+                    break
+
+    # the recording ended in the middle of the epoch
+    if pending is not None and len(pending[0]) > 1:
+        yield _epoch(pending, 0, len(pending[0]), frequency_modulo, pending_row)
+
+
+def cut_prediction_epochs(seconds, inside):
+    """
+    Finds the prediction epochs in the consecutive samples,
+    the samples start with the anchor of the epoch left unfinished by the previous samples if there is any.
+
+    :param seconds: int64 array of the sample times in seconds
+    :param inside: boolean array, True for the samples inside some night
+    :return: list of (anchor, stop) positions of the complete epochs
+             and the anchor of the unfinished epoch at the end of the samples, None if there is no such epoch
+    """
+    anchors = np.flatnonzero(inside)
+    bounds = []
+    position = 0
+    while True:
+        next_anchor = np.searchsorted(anchors, position)
+        if next_anchor == len(anchors):
+            return bounds, None
+        anchor = int(anchors[next_anchor])
+        end = anchor + 1 + int(np.searchsorted(seconds[anchor + 1:], seconds[anchor] + EPOCH_LENGTH))
+        if end >= len(seconds):
+            return bounds, anchor
+        bounds.append((anchor, end + 1))
+        position = end + 1
+
+
+def to_signals(seconds, x, y, z, temp):
+    """
+    :return: (seconds, magnitude, z-angle, temperature) tuple of the samples
+    """
+    return (
+        seconds,
+        np.sqrt(x ** 2 + y ** 2 + z ** 2),
+        np.degrees(np.arctan(z / np.sqrt(x ** 2 + y ** 2))),
+        temp,
+    )
+
+
+def epoch_samples(rows, anchor, stop, frequency_modulo):
+    """
+    :param rows: (seconds, magnitude, z-angle, temperature) tuple of the samples
+    :param anchor: position of the anchor sample of the epoch
+    :param stop: position after the last sample of the epoch
+    :param frequency_modulo: every n-th sample is taken
+    :return: (time, magnitude, z-angle, temperature) tuple of the epoch
+    """
+    seconds, magnitude, z_angle, temp = rows
+    samples = slice(anchor + 1, stop, frequency_modulo)
+    return from_seconds(seconds[anchor] + EPOCH_OFFSET), magnitude[samples], z_angle[samples], temp[samples]
+
+
+def align_training_epochs(store, start, epoch_times, chunk_size=CHUNK_SIZE):
+    """
+    Joins the PSG epochs onto the accelerometer samples of the GENEActiv recording.
+
+    The samples are counted from the beginning of the recording and the first sample at the start or later
+    with the count divisible by n (according to the measurement frequency) is skipped.
+    Each epoch then takes every n-th sample following the previous epoch
+    up to and including the first sample at least 15 s after the PSG epoch time.
+
+    :param store: RawStore of the recording
+    :param start: start of the processing in seconds since the unix epoch
+    :param epoch_times: int64 array of the PSG epoch times in seconds since the unix epoch
+    :param chunk_size: number of rows read at once
+    :return: list of (magnitude, z-angle, temperature) tuples with numpy arrays of the epoch samples,
+             one per PSG epoch until the recording ends
+    """
+    frequency_modulo = get_frequency_modulo(store.frequency)
+    if frequency_modulo == 0 or not len(epoch_times):
+        return []
+    first_row = store.find_row(start)
+    epoch_ends = np.asarray(epoch_times) + EPOCH_OFFSET
+    chunks = iter_store_chunks(store, first_row, chunk_size)
+    parts = []
+    for part in chunks:
+        parts.append(part)
+        if len(part[0]) and part[0][-1] >= epoch_ends.max():
+            # the reading stops once all the epochs end inside of the loaded samples
+            seconds = _concatenate(parts)[0]
+            bounds = _training_epoch_bounds(seconds, first_row, start, epoch_ends, frequency_modulo)
+            if bounds is None or bounds[1][-1] < len(seconds):
+                chunks.close()
+                break
+    if not parts:
+        return []
+    seconds, x, y, z, temp = _concatenate(parts)
+    bounds = _training_epoch_bounds(seconds, first_row, start, epoch_ends, frequency_modulo)
+    if bounds is None:
+        return []
+    _, magnitude, z_angle, temp = to_signals(seconds, x, y, z, temp)
+    epochs = []
+    for epoch_start, epoch_end in zip(*bounds):
+        if epoch_start >= len(seconds):
+            break
+        samples = slice(epoch_start, epoch_end + 1, frequency_modulo)
+        epochs.append((magnitude[samples], z_angle[samples], temp[samples]))
+    return epochs
+
+
+def to_seconds(date):
+    return (date - UNIX_EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return UNIX_EPOCH + timedelta(seconds=int(seconds))
+
+
+def _next_row(store, nights, last_seconds):
+    # indexed row before the next night, None if it is not after the last read row
+    next_start = nights.next_start(last_seconds)
+    if next_start is None:
+        return None
+    position = np.searchsorted(store.index_seconds, next_start, side='right') - 1
+    if position < 0 or store.index_seconds[position] <= last_seconds:
+        return None
+    return int(store.index_rows[position])
+
+
+def _training_epoch_bounds(seconds, first_row, start, epoch_ends, frequency_modulo):
+    # first and last sample of each epoch, the epoch ends at the first sample after the previous epoch
+    # at least at its end time, so j_i = max(end_i, j_(i-1) + 1) is solved by the running maximum of end_i - i
+    counted = (first_row + np.arange(len(seconds))) % frequency_modulo == 0
+    skipped = np.flatnonzero(counted & (seconds >= start))
+    if not len(skipped):
+        return None
+    ends = np.searchsorted(seconds, epoch_ends, side='left')
+    ends[0] = max(ends[0], skipped[0] + 1)
+    shift = np.arange(len(ends))
+    ends = np.maximum.accumulate(ends - shift) + shift
+    starts = np.concatenate(([skipped[0] + 1], ends[:-1] + 1))
+    return starts, ends
+
+
+def _concatenate(parts):
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def _epoch(rows, anchor, stop, frequency_modulo, first_row):
+    return (*epoch_samples(rows, anchor, stop, frequency_modulo), first_row + anchor)
@@ -0,0 +1,82 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class NightIntervals(object):
+    """
+    Sorted and merged open intervals of the sleep diary nights in seconds since the unix epoch.
+
+    The vectorized methods use binary search, the scalar membership test remembers the last position,
+    so it is amortised O(1) when the samples are tested in time order.
+    """
+
+    def __init__(self, nights):
+        """
+        :param nights: list of (start, end) datetime tuples, the times strictly inside are the members
+        """
+        starts, ends = [], []
+        for start, end in sorted((_to_seconds(start), _to_seconds(end)) for start, end in nights):
+            if start >= end:
+                continue
+            # the open intervals have to overlap to be merged, the touching ones keep the common point outside
+            if ends and start < ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts = np.array(starts, dtype=np.float64)
+        self.ends = np.array(ends, dtype=np.float64)
+        self._position = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __str__(self):
+        return f'NightIntervals[{len(self)} intervals]'
+
+    def __contains__(self, seconds):
+        if not len(self):
+            return False
+        if self._position > 0 and seconds < self.ends[self._position - 1]:
+            # the time went back, the position has to be searched again
+            self._position = bisect_right(self.ends, seconds)
+        while self._position < len(self) and self.ends[self._position] <= seconds:
+            self._position += 1
+        return self._position < len(self) and self.starts[self._position] < seconds
+
+    @property
+    def end(self):
+        return self.ends[-1] if len(self) else -np.inf
+
+    def contains(self, seconds):
+        """
+        :param seconds: numpy array of times in seconds
+        :return: boolean mask of the times inside some night
+        """
+        position = np.searchsorted(self.starts, seconds, side='left') - 1
+        return (position >= 0) & (seconds < self.ends[np.maximum(position, 0)] if len(self) else False)
+
+    def before(self, seconds):
+        """
+        :param seconds: time in seconds
+        :return: list of [start, end] of the nights starting before the time, the ends are cut at the time
+        """
+        keep = self.starts < seconds
+        return [[float(start), float(min(end, seconds))] for start, end in zip(self.starts[keep], self.ends[keep])]
+
+    def next_start(self, seconds):
+        """
+        Finds where the reader can jump to, when the time is not inside any night.
+
+        :param seconds: time in seconds
+        :return: start of the next night after the time, None if the time is inside a night or there is no next night
+        """
+        position = np.searchsorted(self.ends, seconds, side='right')
+        if position == len(self) or self.starts[position] < seconds:
+            return None
+        return self.starts[position]
+
+
+def _to_seconds(date):
+    return np.datetime64(date, 'us').astype(np.int64) / 1e6
@@ -1,13 +1,20 @@
-import csv
 import logging
 import os
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from dashboard.models import CsvData
+from .raw_store import get_raw_store
 
 logger = logging.getLogger(__name__)
 CSV_TIMESTAMP_RE = re.compile(r'^\s*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+# every n-th sample is used, so all the frequencies are downsampled to ~25 Hz
+FREQUENCY_MODULO = {
+    '25.0 Hz': 1,
+    '50.0 Hz': 2,
+    '85.7 Hz': 3,
+    '100.0 Hz': 4,
+}
 
 
 def fix_csv_data(csv_data):
@@ -46,16 +53,10 @@ def _fix_csv_data(orig_path, fix_path):
 
 def get_csv_start(csv_data):
     if isinstance(csv_data, CsvData):
-        with open(csv_data.data.path, 'r', encoding='latin-1', errors='ignore', newline='') as csv_file:
-            reader = csv.reader(csv_file, delimiter=',', quotechar='|')
-            for row in reader:
-                # now I care just about data, which starts with timestamp starting with 20 --> begin of year
-                if len(row) > 0 and row[0].startswith('20'):
-                    try:
-                        return convert_csv_time(row)
-                    except ValueError:
-                        continue
-        return None
+        start = get_raw_store(csv_data).start
+        if start is None:
+            return None
+        return datetime(1970, 1, 1) + timedelta(seconds=start)
     return None
 
 
@@ -65,3 +66,10 @@ def convert_csv_time(row):
     if match is None:
         raise ValueError(f'Invalid csv timestamp: {timestamp!r}')
     return datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+
+
+def get_frequency_modulo(frequency):
+    for key, modulo in FREQUENCY_MODULO.items():
+        if key in frequency:
+            return modulo
+    return 0
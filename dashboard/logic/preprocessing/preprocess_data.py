@@ -1,32 +1,64 @@
-import csv
+import json
 import logging
-import math
 import os
+from concurrent.futures import as_completed
 from datetime import timedelta, datetime
 
 import pandas as pd
+from django.db import connections
 
-from dashboard.logic.features_extraction.data_entry import DataEntry
+from dashboard.logic import cache
+from dashboard.logic.features_extraction.data_entry import entries_to_df, get_feature_names
+from dashboard.logic.multithread import process_pool
 from dashboard.models import PsData, CsvData, SleepDiaryDay
-from .preprocess_csv_data import get_csv_start, convert_csv_time
+from mysite.settings import PREPROCESS_WORKERS
+from .csv_epochs import iter_prediction_epochs, align_training_epochs, to_seconds
+from .night_intervals import NightIntervals
+from .preprocess_csv_data import get_csv_start
 from .preprocess_dreamt_data import _proprocess_dreamt_training_data
-from .preprocess_ps_data import get_ps_start, convert_ps_timestamp, convert_sleep
-from ..machine_learning.predict_core import predict_core
+from .preprocess_ps_data import get_ps_start, load_hypnogram
+from .raw_store import get_raw_store
+from .timestamps import NANOSECONDS
+from ..machine_learning.feature_profile import FULL_PROFILE, get_inference_features, get_features_key
+from ..machine_learning.predict_core import predict_core, append_predictions
 
 logger = logging.getLogger(__name__)
 
+PREDICTION_STATE_VERSION = 1
 
-def preprocess_all_data():
+
+def preprocess_all_data(workers=PREPROCESS_WORKERS):
+    """
+    Preprocesses all the csv data, the recordings are processed in parallel worker processes if workers > 1.
+
+    :param workers: number of worker processes
+    :return: True
+    """
     total_start = datetime.now()
     failed = 0
 
     data = CsvData.objects.all()
-    for d in data:
-        try:
-            preprocess_data(d)
-        except Exception:
-            failed += 1
-            logger.exception(f'Preprocessing failed for {d.filename}')
+    if workers > 1:
+        with process_pool(workers) as executor:
+            futures = {executor.submit(_preprocess_data_by_id, d.id): d for d in data}
+            for done, future in enumerate(as_completed(futures), start=1):
+                try:
+                    result, duration = future.result()
+                    logger.info(f'[{done}/{len(futures)}] {futures[future].filename} preprocessed in {duration} '
+                                f'with result {result}')
+                except Exception:
+                    failed += 1
+                    logger.exception(f'[{done}/{len(futures)}] Preprocessing failed for {futures[future].filename}')
+    else:
+        for done, d in enumerate(data, start=1):
+            start = datetime.now()
+            try:
+                result = preprocess_data(d)
+                logger.info(f'[{done}/{len(data)}] {d.filename} preprocessed in {datetime.now() - start} '
+                            f'with result {result}')
+            except Exception:
+                failed += 1
+                logger.exception(f'[{done}/{len(data)}] Preprocessing failed for {d.filename}')
     logger.info(
         f'{len(data)} training csv data objects processed in {datetime.now() - total_start} '
         f'with {failed} failures'
@@ -34,15 +66,41 @@ def preprocess_all_data():
     return True
 
 
-def preprocess_data(csv_object):
+def _preprocess_data_by_id(csv_data_id):
+    # runs in the worker process, the exceptions are passed to the parent by the future
+    start = datetime.now()
+    try:
+        result = preprocess_data(CsvData.objects.get(pk=csv_data_id))
+    finally:
+        connections.close_all()
+    return result, datetime.now() - start
+
+
+def preprocess_data(csv_object, predict=True):
+    """
+    Preprocesses the csv data into the cached features, the new prediction data are predicted too.
+
+    :param csv_object: CsvData to preprocess
+    :param predict: predict the newly preprocessed prediction data, off when the caller scores the features itself
+    :return: True if the features are cached
+    """
     if isinstance(csv_object, CsvData):
         if os.path.exists(csv_object.x_data_path):
+            if csv_object.training_data or csv_object.dreamt_data or _features_match(csv_object):
+                return True
+            logger.info(f'Cached features of {csv_object.filename} were computed for another model, '
+                        f'they will be preprocessed again')
+            return _preprocess_prediction_data(csv_object, predict)
+        elif os.path.exists(csv_object.x_data_excel_path):
+            # features preprocessed before the columnar cache was introduced
+            logger.info(f'Features of {csv_object.filename} will be converted from excel')
+            cache.save_features(cache.load_features(csv_object.x_data_excel_path), csv_object.x_data_path)
             return True
         elif csv_object.training_data and not csv_object.dreamt_data:
             return _preprocess_training_data(csv_object)
         elif csv_object.dreamt_data:
             return _proprocess_dreamt_training_data(csv_object)
-        return _preprocess_prediction_data(csv_object)
+        return _preprocess_prediction_data(csv_object, predict)
 
     else:
         logger.warning(f'Wrong data type {type(csv_object)} was passed into preprocessing method.')
@@ -56,108 +114,21 @@ def _preprocess_training_data(csv_object):
         return False
     else:
         start_time = datetime.now()
-        start = _find_start(csv_object, ps_object)
-        data_list = []
-        with open(ps_object.data.path, 'r', encoding='latin-1', errors='ignore', newline='') as ps_file:
-            ps_reader = csv.reader(ps_file, delimiter='\t', quotechar='|')
-
-            frequency_modulo = 0
-            modulo_reminder = 0
-
-            with open(csv_object.data.path, 'r', encoding='latin-1', errors='ignore', newline='') as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=',', quotechar='|')
-
-                header_end = False
-                after_midnight = False
-
-                for csv_row in csv_reader:
-                    if frequency_modulo == 0:
-                        frequency_modulo = _assign_frequency_modulo(csv_row)
-                    # now I care just about data, which starts with timestamp starting with 20 --> begin of year
-                    if len(csv_row) > 0 and csv_row[0].startswith('20'):
-                        try:
-                            csv_date = convert_csv_time(csv_row)
-                        except ValueError:
-                            logger.warning(f'Skipping malformed csv row in {csv_object.filename}: {csv_row[:2]}')
-                            continue
-                        if modulo_reminder == 0:
-                            if csv_date >= start:
-                                break
-                        modulo_reminder = (modulo_reminder + 1) % frequency_modulo
-
-                for ps_row in ps_reader:
-                    if header_end and ps_row != []:
-                        if ps_row[2].startswith('00'):
-                            after_midnight = True
-                        if convert_ps_timestamp(date, ps_row[2], after_midnight) >= start - timedelta(seconds=15):
-                            time = convert_ps_timestamp(date, ps_row[2], after_midnight)
-                            end = time + timedelta(seconds=15)
-                            magnitude_data, z_angle_data, temp = _process_csv_data_core(csv_reader,
-                                                                                        end,
-                                                                                        frequency_modulo,
-                                                                                        modulo_reminder)
-                            if not magnitude_data:
-                                break
-                            entry = DataEntry(
-                                time=time,
-                                sleep=convert_sleep(ps_row[0]),
-                                acc=magnitude_data,
-                                acc_z=z_angle_data,
-                                temp=temp
-                            )
-                            data_list.append(entry.to_dic())
-                    if ps_row == ['Sleep Stage', 'Position', 'Time [hh:mm:ss]', 'Event', 'Duration[s]']:
-                        header_end = True
-                    if next(iter(ps_row or []), None) == 'Recording Date:':
-                        date = ps_row[1].split()[0]
-        df = pd.DataFrame.from_dict(data_list, orient='columns')
-        df = df.set_index('Date')
-        df.to_excel(csv_object.x_data_path)
+        start = to_seconds(_find_start(csv_object, ps_object))
+        epoch_times, sleep = load_hypnogram(ps_object)
+        labelled = epoch_times >= start - 15
+        epoch_times, sleep = epoch_times[labelled], sleep[labelled]
+        epochs = align_training_epochs(get_raw_store(csv_object), start, epoch_times)
+        acc, acc_z, temps = zip(*epochs) if epochs else ([], [], [])
+        df = entries_to_df(
+            epoch_times[:len(epochs)].astype('datetime64[s]'), acc, acc_z, temps, sleep[:len(epochs)]
+        )
+        cache.save_features(df, csv_object.x_data_path)
         end_time = datetime.now()
         logger.info(f'Data {csv_object.filename} preprocessed in {end_time - start_time}')
     return True
 
 
-def _assign_frequency_modulo(csv_row):
-    frequency_modulo = 0
-    if len(csv_row) > 0 and csv_row[0].startswith('Measurement Frequency'):
-        frequency = csv_row[1]
-        if '25.0 Hz' in frequency:
-            frequency_modulo = 1
-        elif '50.0 Hz' in frequency:
-            frequency_modulo = 2
-        elif '85.7 Hz' in frequency:
-            frequency_modulo = 3
-        elif '100.0 Hz' in frequency:
-            frequency_modulo = 4
-    return frequency_modulo
-
-
-def _process_csv_data_core(csv_reader, end, frequency_modulo, modulo_reminder):
-    magnitude_data = []
-    z_angle_data = []
-    temp = []
-    for csv_row in csv_reader:
-        if len(csv_row) > 0 and csv_row[0].startswith('20'):
-            try:
-                csv_date = convert_csv_time(csv_row)
-            except ValueError:
-                continue
-            if modulo_reminder == 0:
-                acc_magnitude = math.sqrt(
-                    float(csv_row[1]) ** 2 + float(csv_row[2]) ** 2 + float(csv_row[3]) ** 2)
-                acc_z_angle = math.degrees(
-                    math.atan(float(csv_row[3]) / (
-                            (float(csv_row[1]) ** 2 + float(csv_row[2]) ** 2) ** 0.5)))
-                magnitude_data.append(acc_magnitude)
-                z_angle_data.append(acc_z_angle)
-                temp.append(float(csv_row[6]))
-            modulo_reminder = (modulo_reminder + 1) % frequency_modulo
-            if csv_date >= end:
-                break
-    return magnitude_data, z_angle_data, temp
-
-
 def _find_start(csv_object, ps_object):
     if isinstance(ps_object, PsData) and isinstance(csv_object, CsvData):
         ps_start = get_ps_start(ps_object) - timedelta(seconds=15)
@@ -170,71 +141,141 @@ def _find_start(csv_object, ps_object):
 
 def _preprocess_prediction_data(csv_object, predict=True):
     logger.info(f'Data will be preprocessed for {csv_object.filename}')
-    data_list = []
     start_time = datetime.now()
     nights = _get_diary_nights(csv_object)
-    if nights:
-        total_end = max(night[1] for night in nights)
-    with open(csv_object.data.path, 'r', encoding='latin-1', errors='ignore', newline='') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',', quotechar='|')
-
-        frequency_modulo = 0
-        modulo_reminder = 0
-        for csv_row in csv_reader:
-            if frequency_modulo == 0:
-                frequency_modulo = _assign_frequency_modulo(csv_row)
-            # now I care just about data, which starts with timestamp starting with 20 --> begin of year
-            if len(csv_row) > 0 and csv_row[0].startswith('20') and frequency_modulo != 0:
-                try:
-                    csv_date = convert_csv_time(csv_row)
-                except ValueError:
-                    logger.warning(f'Skipping malformed csv row in {csv_object.filename}: {csv_row[:2]}')
-                    continue
-                if not _is_in_any_range(csv_date, nights):
-                    if csv_date > total_end:
-                        break
-                    else:
-                        continue
-                time = csv_date + timedelta(seconds=15)
-                end = csv_date + timedelta(seconds=30)
-                magnitude_data, z_angle_data, temp = _process_csv_data_core(csv_reader,
-                                                                            end,
-                                                                            frequency_modulo,
-                                                                            modulo_reminder)
-                if not magnitude_data:
-                    break
-                data_list.append(
-                    DataEntry(
-                        time=time,
-                        acc=magnitude_data,
-                        acc_z=z_angle_data,
-                        temp=temp
-                    ).to_dic()
-                )
-        if not data_list:
-            logger.warning(f'No data to preprocess {csv_object.filename}')
-            return False
-        df = pd.DataFrame.from_dict(data_list, orient='columns')
-        df = df.set_index('Date')
-        df.to_excel(csv_object.x_data_path)
-        end_time = datetime.now()
-        logger.info(f'Data {csv_object.filename} preprocessed in {end_time - start_time}')
-        if predict:
-            predict_core(csv_object, df)
-        return True
+    store = get_raw_store(csv_object)
+    df, last_row = _prediction_features(store, nights)
+    if df is None:
+        logger.warning(f'No data to preprocess {csv_object.filename}')
+        return False
+    cache.save_features(df, csv_object.x_data_path)
+    _save_prediction_state(csv_object, store, nights, last_row)
+    end_time = datetime.now()
+    logger.info(f'Data {csv_object.filename} preprocessed in {end_time - start_time}')
+    if predict:
+        predict_core(csv_object, df)
+    return True
 
 
-def _is_in_any_range(csv_date, nights):
-    for night in nights:
-        if night[0] < csv_date < night[1]:
-            return True
-    return False
+def update_prediction_data(csv_object):
+    """
+    Preprocesses and predicts just the new tail of the extended recording (new days added or the end date moved).
+    The processing resumes from the anchor of the last processed epoch, which is computed again
+    because the file could end in the middle of it, and the new epochs are appended to the stored ones.
+    The recording is processed from scratch if the already processed part or its nights have changed.
+
+    :param csv_object: CsvData of the prediction recording
+    :return: True if the features and predictions are up to date
+    """
+    if csv_object.training_data or csv_object.dreamt_data:
+        return preprocess_data(csv_object)
+    start_time = datetime.now()
+    state = _load_prediction_state(csv_object)
+    if state is None or not os.path.exists(csv_object.x_data_path) \
+            or not os.path.exists(csv_object.cached_prediction_path):
+        return _preprocess_prediction_data(csv_object)
+    if not _features_match(csv_object):
+        logger.info(f'Cached features of {csv_object.filename} were computed for another model, '
+                    f'it will be processed from scratch')
+        return _preprocess_prediction_data(csv_object)
+    nights = _get_diary_nights(csv_object)
+    store = get_raw_store(csv_object)
+    row = state['row']
+    if row >= len(store) or int(store.column('time')[row]) != state['time'] \
+            or nights.before(state['time'] // NANOSECONDS) != state['nights']:
+        logger.info(f'Processed part of {csv_object.filename} has changed, it will be processed from scratch')
+        return _preprocess_prediction_data(csv_object)
+
+    tail, last_row = _prediction_features(store, nights, row)
+    features = cache.load_features(csv_object.x_data_path)
+    if tail is None or list(tail.columns) != list(features.columns) or features.index[-1] != tail.index[0]:
+        logger.info(f'Processed epochs of {csv_object.filename} do not match, it will be processed from scratch')
+        return _preprocess_prediction_data(csv_object)
+    cache.save_features(pd.concat([features.iloc[:-1], tail]), csv_object.x_data_path)
+    _save_prediction_state(csv_object, store, nights, last_row)
+    append_predictions(csv_object, cache.load_predictions(csv_object.cached_prediction_path), tail)
+    logger.info(f'{len(tail) - 1} new epochs of {csv_object.filename} preprocessed and predicted in '
+                f'{datetime.now() - start_time}')
+    return True
+
+
+def prediction_data_outdated(csv_object):
+    """
+    Checks if the prediction recording was changed (e.g. extended by the new days) after it was processed,
+    the processed version of the csv file is saved in the prediction state.
+
+    :param csv_object: CsvData of the recording
+    :return: True if the processed features and predictions can be updated by update_prediction_data
+    """
+    if csv_object.training_data or csv_object.dreamt_data or not os.path.exists(csv_object.cached_prediction_path):
+        return False
+    state = _load_prediction_state(csv_object)
+    if state is None or 'csv' not in state:
+        return False
+    stat = os.stat(csv_object.data.path)
+    return state['csv'] != {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _prediction_features(store, nights, row=None):
+    # features of the epochs inside the nights and the anchor row of the last epoch
+    times, acc, acc_z, temps = [], [], [], []
+    last_row = None
+    for time, magnitude_data, z_angle_data, temp, last_row in iter_prediction_epochs(store, nights, row=row):
+        times.append(time)
+        acc.append(magnitude_data)
+        acc_z.append(z_angle_data)
+        temps.append(temp)
+    if not times:
+        return None, None
+    return entries_to_df(times, acc, acc_z, temps, features=get_inference_features()), last_row
+
+
+def _save_prediction_state(csv_object, store, nights, row):
+    # the last processed epoch is identified by the store row and time of its anchor
+    time = int(store.column('time')[row])
+    state = {
+        'version': PREDICTION_STATE_VERSION,
+        'row': int(row),
+        'time': time,
+        'nights': nights.before(time // NANOSECONDS),
+        'features': get_features_key(),
+        # the version of the csv file the features were computed from
+        'csv': {'size': store.meta['size'], 'mtime': store.meta['mtime']},
+    }
+    tmp_path = f'{csv_object.prediction_state_path}.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, csv_object.prediction_state_path)
+
+
+def _load_prediction_state(csv_object):
+    if not os.path.exists(csv_object.prediction_state_path):
+        return None
+    with open(csv_object.prediction_state_path, 'r') as state_file:
+        state = json.load(state_file)
+    return state if state.get('version') == PREDICTION_STATE_VERSION else None
+
+
+def _features_match(csv_object):
+    # the cached features were computed for the current inference profile and model
+    state = _load_prediction_state(csv_object)
+    if state is not None and 'features' in state:
+        return state['features'] == get_features_key()
+    # the features cached before their key was saved can be trusted only if all of them are present
+    return get_features_key() == FULL_PROFILE and \
+        set(get_feature_names()) <= set(cache.load_feature_columns(csv_object.x_data_path))
+
+
+def get_subject_nights(subject):
+    """
+    :param subject: Subject with the sleep diary
+    :return: NightIntervals of the diary nights extended by 30 minutes, the epochs inside them are predicted
+    """
+    diary = SleepDiaryDay.objects.filter(subject=subject).order_by('date')
+    return NightIntervals(
+        (day.t1 - timedelta(minutes=30), day.t4 + timedelta(minutes=30)) for day in diary
+    )
 
 
 def _get_diary_nights(csv_object):
-    diary = SleepDiaryDay.objects.filter(subject=csv_object.subject).order_by('date')
-    nights = []
-    if diary.exists():
-        for day in diary:
-            nights.append((day.t1 - timedelta(minutes=30), day.t4 + timedelta(minutes=30)))
-    return nights
+    return get_subject_nights(csv_object.subject)
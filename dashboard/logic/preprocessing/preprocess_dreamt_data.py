@@ -1,16 +1,24 @@
 import csv
 import logging
-import math
-from datetime import datetime, timedelta
+from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
-from dashboard.logic.features_extraction.data_entry import DataEntry
+from dashboard.logic import cache
+from dashboard.logic.features_extraction.data_entry import entries_to_df
+from dashboard.logic.preprocessing.csv_epochs import CHUNK_SIZE
+from dashboard.logic.preprocessing.timestamps import parse_timestamps, NANOSECONDS
 
 logger = logging.getLogger(__name__)
 
+# length of the DREAMT epoch in nanoseconds
+EPOCH_LENGTH = 15 * NANOSECONDS
+DREAMT_HEADER = ('processed_time', 'ACC_X_g', 'ACC_Y_g', 'ACC_Z_g', 'TEMP', 'sleep_binary')
+DREAMT_COLUMNS = tuple(name.lower() for name in DREAMT_HEADER)
 
-def _proprocess_dreamt_training_data(csv_object):
+
+def _proprocess_dreamt_training_data(csv_object, chunk_size=CHUNK_SIZE):
     """
     Preprocess DREAMT-format training CSV files.
 
@@ -26,19 +34,14 @@ def _proprocess_dreamt_training_data(csv_object):
     per-sample arrays for each epoch (to match legacy processing), and label each
     epoch by majority vote of sleep_binary within the epoch (ties resolved by 0).
     The epoch "time" stored is the start timestamp of the 15-second window.
+
+    The file is read in chunks of chunk_size rows and the features are computed per chunk,
+    only the last unfinished epoch is carried over to the next chunk.
     """
     logger.info(f'DREAMT data will be preprocessed for {csv_object.filename}')
 
-    data_list = []
     start_time = datetime.now()
 
-    def parse_time(s):
-        try:
-            return datetime.strptime(s, '%Y-%m-%d %H:%M:%S.%f')
-        except ValueError:
-            # fallback if no microseconds
-            return datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
-
     with open(csv_object.data.path, 'r', encoding='latin-1', errors='ignore', newline='') as csv_file:
         reader = csv.reader(csv_file, delimiter=',', quotechar='|')
 
@@ -50,101 +53,111 @@ def _proprocess_dreamt_training_data(csv_object):
         # Map columns by name to indexes to be robust to order
         header_lower = [h.strip() for h in header]
         try:
-            idx_time = header_lower.index('processed_time')
-            idx_x = header_lower.index('acc_x_g')
-            idx_y = header_lower.index('acc_y_g')
-            idx_z = header_lower.index('acc_z_g')
-            idx_temp = header_lower.index('temp')
-            idx_sleep = header_lower.index('sleep_binary')
+            columns = [header_lower.index(name) for name in DREAMT_COLUMNS]
         except ValueError:
             # Try case-sensitive alternative (as provided in the example)
             try:
-                idx_time = header.index('processed_time')
-                idx_x = header.index('ACC_X_g')
-                idx_y = header.index('ACC_Y_g')
-                idx_z = header.index('ACC_Z_g')
-                idx_temp = header.index('TEMP')
-                idx_sleep = header.index('sleep_binary')
-            except ValueError as e:
+                columns = [header.index(name) for name in DREAMT_HEADER]
+            except ValueError:
                 logger.error(f'Unexpected DREAMT CSV header for {csv_object.filename}: {header}')
                 return False
 
-        # Initialize first window
-        first_row = next(reader, None)
-        if not first_row:
-            logger.warning(f'No rows after header in DREAMT CSV: {csv_object.filename}')
-            return False
-
-        current_start = parse_time(first_row[idx_time])
-        current_end = current_start + timedelta(seconds=15)
-
-        acc_mag = []
-        acc_z_angle = []
-        temp = []
-        sleep_flags = []
-
-        def flush_epoch():
-            nonlocal acc_mag, acc_z_angle, temp, sleep_flags, current_start
-            if not acc_mag:
-                return
-            # Majority vote for sleep label (0/1). Tie -> 0 (wake)
-            ones = sum(1 for sleep_flag in sleep_flags if sleep_flag == 1)
-            zeros = len(sleep_flags) - ones
-            sleep = 1 if ones > zeros else 0
-            entry = DataEntry(
-                time=current_start,
-                sleep=sleep,
-                acc=acc_mag,
-                acc_z=acc_z_angle,
-                temp=temp
-            )
-            data_list.append(entry.to_dic())
-            # reset buffers
-            acc_mag = []
-            acc_z_angle = []
-            temp = []
-            sleep_flags = []
-
-        # Process the first row together with the loop
-        rows_iter = [first_row]
-        rows_iter.extend(reader)
-
-        for row in rows_iter:
-            try:
-                ts = parse_time(row[idx_time])
-                x = float(row[idx_x])
-                y = float(row[idx_y])
-                z = float(row[idx_z])
-                t = float(row[idx_temp])
-                s = int(float(row[idx_sleep]))  # robust to '0.0'/'1.0'
-            except Exception as e:
-                logger.warning(f'Skipping malformed row in {csv_object.filename}: {row} | {e}')
+    frames = []
+    pending = None
+    window_start = None
+    for timestamps, x, y, z, temp, sleep in _iter_dreamt_chunks(csv_object, columns, chunk_size):
+        if window_start is None:
+            if not len(timestamps):
                 continue
-
-            # Advance window(s) until the timestamp fits
-            while ts >= current_end:
-                flush_epoch()
-                current_start = current_end
-                current_end = current_start + timedelta(seconds=15)
-
-            # Append sample to current buffers
-            acc_mag.append(math.sqrt(x ** 2 + y ** 2 + z ** 2))
+            # Initialize first window
+            window_start = timestamps[0]
+        # the samples are assigned to the window of the latest sample so far, same as advancing the window
+        # while the timestamp is after its end, so the windows never go back
+        windows = np.maximum.accumulate(np.maximum((timestamps - window_start) // EPOCH_LENGTH, 0))
+        rows = (
+            windows,
+            np.sqrt(x ** 2 + y ** 2 + z ** 2),
             # z-angle computed the same as legacy (_process_csv_data_core)
-            denom = (x ** 2 + y ** 2) ** 0.5
-            acc_z_angle.append(math.degrees(math.atan(z / denom)) if denom != 0 else 0.0)
-            temp.append(t)
-            sleep_flags.append(1 if s >= 1 else 0)
-
+            _z_angle(x, y, z),
+            temp,
+            # robust to '0.0'/'1.0'
+            sleep >= 1,
+        )
+        if pending is not None:
+            rows = tuple(np.concatenate((p, r)) for p, r in zip(pending, rows))
+            rows[0][:] = np.maximum.accumulate(rows[0])
+        # the last window can continue in the next chunk
+        last = np.searchsorted(rows[0], rows[0][-1])
+        pending = tuple(r[last:] for r in rows)
+        if last:
+            frames.append(_epochs_to_df(window_start, *(r[:last] for r in rows)))
+
+    if pending is not None:
         # Flush the last epoch
-        flush_epoch()
+        frames.append(_epochs_to_df(window_start, *pending))
 
-    if not data_list:
+    if not frames:
         logger.warning(f'No data aggregated for DREAMT CSV: {csv_object.filename}')
         return False
 
-    df = pd.DataFrame.from_dict(data_list, orient='columns')
-    df = df.set_index('Date')
-    df.to_excel(csv_object.x_data_path)
+    df = pd.concat(frames)
+    cache.save_features(df, csv_object.x_data_path)
     end_time = datetime.now()
     logger.info(f'DREAMT data {csv_object.filename} preprocessed in {end_time - start_time}')
     return True
+
+
+def _iter_dreamt_chunks(csv_object, columns, chunk_size):
+    """
+    Reads the DREAMT csv file in chunks of numpy arrays, the malformed rows are skipped.
+
+    :param csv_object: CsvData object of the DREAMT file
+    :param columns: indexes of the time, x, y, z, temperature and sleep columns
+    :param chunk_size: number of rows read at once
+    :return: generator of (nanoseconds, x, y, z, temperature, sleep) tuples
+    """
+    reader = pd.read_csv(
+        csv_object.data.path,
+        header=None,
+        skiprows=1,
+        usecols=columns,
+        dtype=str,
+        quotechar='|',
+        encoding='latin-1',
+        on_bad_lines='warn',
+        chunksize=chunk_size,
+    )
+    for chunk in reader:
+        chunk = chunk[columns]
+        timestamps, valid = parse_timestamps(chunk.iloc[:, 0].values)
+        values = [pd.to_numeric(chunk.iloc[:, i], errors='coerce').values.astype(np.float64) for i in range(1, 6)]
+        for value in values:
+            valid &= ~np.isnan(value)
+        if not valid.all():
+            logger.warning(f'Skipping {(~valid).sum()} malformed rows in {csv_object.filename}')
+        yield (timestamps[valid], *(value[valid] for value in values))
+
+
+def _z_angle(x, y, z):
+    denominator = np.sqrt(x ** 2 + y ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_angle = np.degrees(np.arctan(z / denominator))
+    return np.where(denominator != 0, z_angle, 0.0)
+
+
+def _epochs_to_df(window_start, windows, magnitude, z_angle, temp, sleep):
+    # one epoch per consecutive run of the same window, the empty windows have no epoch
+    bounds = np.flatnonzero(np.diff(windows)) + 1
+    starts = np.concatenate(([0], bounds))
+    # Majority vote for sleep label (0/1). Tie -> 0 (wake)
+    ones = np.add.reduceat(sleep.astype(np.int64), starts)
+    counts = np.diff(np.concatenate((starts, [len(windows)])))
+    labels = (ones > counts - ones).astype(int)
+    times = pd.to_datetime(window_start + windows[starts] * EPOCH_LENGTH, unit='ns').to_pydatetime()
+    return entries_to_df(
+        list(times),
+        np.split(magnitude, bounds),
+        np.split(z_angle, bounds),
+        np.split(temp, bounds),
+        labels.tolist(),
+    )
@@ -1,8 +1,14 @@
 import csv
 from datetime import datetime, timedelta
 
+import numpy as np
+import pandas as pd
+
 from dashboard.models import PsData
 
+PS_HEADER = ['Sleep Stage', 'Position', 'Time [hh:mm:ss]', 'Event', 'Duration[s]']
+SLEEP_STAGES = ['R', 'N1', 'N2', 'N3']
+
 
 def get_ps_start(ps_data):
     if isinstance(ps_data, PsData):
@@ -15,7 +21,7 @@ def get_ps_start(ps_data):
                     if not after_midnight and 0 < int(row[2][:2]) < 12:
                         after_midnight = True
                     return convert_ps_timestamp(date, row[2], after_midnight)
-                if row == ['Sleep Stage', 'Position', 'Time [hh:mm:ss]', 'Event', 'Duration[s]']:
+                if row == PS_HEADER:
                     header_end = True
                 if next(iter(row or []), None) == 'Recording Date:':
                     date = row[1].split()[0]
@@ -32,7 +38,38 @@ def convert_ps_timestamp(date, time, after_midnight):
 
 # Sleep status (0 = awake, 1 = sleep)
 def convert_sleep(string):
-    sleep_strings = ['R', 'N1', 'N2', 'N3']
-    if string in sleep_strings:
+    if string in SLEEP_STAGES:
         return 1
     return 0
+
+
+def load_hypnogram(ps_data):
+    """
+    Loads all the scored PSG epochs into arrays.
+
+    The rows after midnight are recognized the same way as during the training data preprocessing,
+    all the rows from the first one starting with hour 00 belong to the next day.
+
+    :param ps_data: PsData object
+    :return: int64 array of the epoch times in seconds since the unix epoch and int8 array of the sleep labels
+    """
+    dates, times, next_day, stages = [], [], [], []
+    with open(ps_data.data.path, 'r', encoding='latin-1', errors='ignore', newline='') as csv_file:
+        reader = csv.reader(csv_file, delimiter='\t', quotechar='|')
+        header_end = False
+        after_midnight = False
+        for row in reader:
+            if header_end and row != []:
+                if row[2].startswith('00'):
+                    after_midnight = True
+                dates.append(date)
+                times.append(row[2])
+                next_day.append(after_midnight)
+                stages.append(row[0])
+            if row == PS_HEADER:
+                header_end = True
+            if next(iter(row or []), None) == 'Recording Date:':
+                date = row[1].split()[0]
+    epochs = pd.to_datetime(pd.Series(dates, dtype=str) + ' ' + pd.Series(times, dtype=str), format='%d/%m/%Y %H:%M:%S')
+    seconds = epochs.values.astype('datetime64[s]').astype(np.int64) + np.array(next_day, dtype=np.int64) * 86400
+    return seconds, np.isin(stages, SLEEP_STAGES).astype(np.int8)
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from .timestamps import parse_timestamps, NANOSECONDS
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+# rows read from the csv file or from the store at once
+CHUNK_SIZE = 1_000_000
+# one indexed row every INDEX_STEP seconds of the recording
+INDEX_STEP = 60
+META_FILE = 'meta.json'
+TIME = 'time'
+# the samples are stored as float32, the same precision as used by SleepPy
+CHANNELS = ('x', 'y', 'z', 'lux', 'temperature')
+DTYPES = {TIME: np.int64, **{channel: np.float32 for channel in CHANNELS}}
+CALIBRATION_KEYS = ('x gain', 'x offset', 'y gain', 'y offset', 'z gain', 'z offset', 'Volts', 'Lux')
+# the data rows start with the year 20xx
+YEAR_2000 = 946684800
+YEAR_2100 = 4102444800
+
+
+class RawStore(object):
+    """
+    Memory-mapped samples of one GENEActiv recording, one binary file per column
+    and the header metadata with the sparse time to row index in the json sidecar.
+
+    All the readers get zero-copy slices of the same files, so the pages are shared through the OS cache.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the store directory
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as meta_file:
+            self.meta = json.load(meta_file)
+        self.index_seconds = np.array(self.meta['index']['seconds'], dtype=np.int64)
+        self.index_rows = np.array(self.meta['index']['rows'], dtype=np.int64)
+        self._columns = {}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __str__(self):
+        return f'RawStore[{os.path.basename(self.path)}: {len(self)} rows]'
+
+    @property
+    def header(self):
+        return self.meta['header']
+
+    @property
+    def frequency(self):
+        return self.meta['frequency']
+
+    @property
+    def start(self):
+        return self.meta['start']
+
+    @property
+    def end(self):
+        return self.meta['end']
+
+    def column(self, name):
+        """
+        :param name: time or one of the channels
+        :return: read-only memory-mapped numpy array of the whole column
+        """
+        if name not in self._columns:
+            if len(self):
+                self._columns[name] = np.memmap(_column_path(self.path, name), dtype=DTYPES[name], mode='r',
+                                                shape=(len(self),))
+            else:
+                self._columns[name] = np.empty(0, dtype=DTYPES[name])
+        return self._columns[name]
+
+    def find_row(self, seconds):
+        """
+        Finds the indexed row, where the reading has to start to get all the rows from the given time.
+
+        :param seconds: time in seconds since the unix epoch
+        :return: number of the row
+        """
+        position = np.searchsorted(self.index_seconds, seconds, side='right') - 1
+        if position < 0:
+            return 0
+        return int(self.index_rows[position])
+
+    def iter_slices(self, row=0, chunk_size=CHUNK_SIZE):
+        """
+        :param row: first row to read
+        :param chunk_size: number of rows read at once
+        :return: generator of dictionaries with the time in nanoseconds and the channels, the values are memory views
+        """
+        for start in range(row, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            yield {name: self.column(name)[start:stop] for name in DTYPES}
+
+
+def get_raw_store(csv_data):
+    return load_raw_store(csv_data.data.path, csv_data.raw_store_path)
+
+
+def load_raw_store(path, store_path):
+    """
+    Opens the raw sample store of the GENEActiv csv file,
+    the csv file is ingested into the store if it is missing or the csv file has changed.
+
+    :param path: path to the csv file
+    :param store_path: path to the store directory
+    :return: RawStore
+    """
+    stat = os.stat(path)
+    meta_path = os.path.join(store_path, META_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('version') == STORE_VERSION and meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime:
+            return RawStore(store_path)
+    start = datetime.now()
+    tmp_path = f'{store_path}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    build_raw_store(path, tmp_path)
+    shutil.rmtree(store_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, store_path)
+    except OSError:
+        # the store was ingested by another worker in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    store = RawStore(store_path)
+    logger.info(f'Csv file {os.path.basename(path)} with {len(store)} rows ingested in {datetime.now() - start}')
+    return store
+
+
+def build_raw_store(path, store_path, chunk_size=CHUNK_SIZE, step=INDEX_STEP):
+    """
+    Parses the GENEActiv csv file once and writes its samples into the store directory.
+
+    :param path: path to the csv file
+    :param store_path: path to the new store directory
+    :param chunk_size: number of rows parsed at once
+    :param step: number of seconds between the indexed rows
+    """
+    stat = os.stat(path)
+    header, data_offset = read_csv_header(path)
+    meta = {
+        'version': STORE_VERSION,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'header': header,
+        'frequency': header.get('Measurement Frequency', ''),
+        'calibration': {key: header[key] for key in CALIBRATION_KEYS if key in header},
+        'start': None,
+        'end': None,
+        'rows': 0,
+        'index': {'step': step, 'seconds': [], 'rows': []},
+    }
+    os.makedirs(store_path)
+    last_bucket = -1
+    files = {name: open(_column_path(store_path, name), 'wb') for name in DTYPES}
+    try:
+        for columns in _iter_csv_rows(path, data_offset, chunk_size):
+            seconds = columns[TIME] // NANOSECONDS
+            if not len(seconds):
+                continue
+            buckets = seconds // step
+            previous = np.maximum.accumulate(np.concatenate(([last_bucket], buckets[:-1])))
+            new = np.flatnonzero(buckets > previous)
+            meta['index']['seconds'].extend(seconds[new].tolist())
+            meta['index']['rows'].extend((meta['rows'] + new).tolist())
+            last_bucket = max(last_bucket, int(buckets.max()))
+            if meta['start'] is None:
+                meta['start'] = int(seconds[0])
+            meta['end'] = int(seconds.max()) if meta['end'] is None else max(meta['end'], int(seconds.max()))
+            meta['rows'] += len(seconds)
+            for name, values in columns.items():
+                files[name].write(values.astype(DTYPES[name]).tobytes())
+    finally:
+        for column_file in files.values():
+            column_file.close()
+    with open(os.path.join(store_path, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+
+def read_csv_header(path):
+    """
+    Reads the header of the GENEActiv csv file.
+
+    :param path: path to the csv file
+    :return: dictionary with the header values and the byte offset of the first data row
+    """
+    header = {}
+    offset = 0
+    with open(path, 'rb') as csv_file:
+        for line in csv_file:
+            # now I care just about data, which starts with timestamp starting with 20 --> begin of year
+            if line.startswith(b'20'):
+                break
+            row = line.decode('latin-1').rstrip('\r\n').split(',')
+            if len(row) > 1 and row[0] and row[0] not in header:
+                header[row[0]] = row[1]
+            offset += len(line)
+    return header, offset
+
+
+def _iter_csv_rows(path, offset, chunk_size):
+    # the button column is missing in some exports, the temperature is the last column then
+    with open(path, 'rb') as csv_file:
+        csv_file.seek(offset)
+        temperature = 6 if csv_file.readline().count(b',') >= 6 else 5
+        csv_file.seek(offset)
+        reader = pd.read_csv(
+            csv_file,
+            header=None,
+            usecols=[0, 1, 2, 3, 4, temperature],
+            dtype={0: str},
+            encoding='latin-1',
+            chunksize=chunk_size,
+        )
+        for chunk in reader:
+            timestamps = chunk[0]
+            if timestamps.str.contains('\x00', regex=False).any():
+                timestamps = timestamps.str.replace('\x00', '', regex=False)
+            nanoseconds, valid = parse_timestamps(timestamps.values)
+            valid &= (nanoseconds >= YEAR_2000 * NANOSECONDS) & (nanoseconds < YEAR_2100 * NANOSECONDS)
+            if not valid.all():
+                logger.warning(f'Skipping {(~valid).sum()} malformed csv rows in {path}')
+            columns = {TIME: nanoseconds[valid]}
+            for channel, column in zip(CHANNELS, [1, 2, 3, 4, temperature]):
+                columns[channel] = pd.to_numeric(chunk[column], errors='coerce').values[valid]
+            yield columns
+
+
+def _column_path(store_path, name):
+    return os.path.join(store_path, f'{name}.bin')
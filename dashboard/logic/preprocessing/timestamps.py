@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+# YYYY-MM-DD HH:MM:SS followed by optional :fff (GENEActiv) or .ffffff (DREAMT) fraction of second
+TIMESTAMP_WIDTH = 29
+SEPARATORS = {4: b'-', 7: b'-', 10: b' ', 13: b':', 16: b':'}
+FRACTION_SEPARATORS = (b':', b'.')
+FRACTION_START = 20
+FRACTION_DIGITS = 9
+DAYS_IN_MONTH = np.array([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+NANOSECONDS = 1_000_000_000
+
+
+def parse_timestamps(timestamps):
+    """
+    Converts the fixed format timestamps into nanoseconds since the unix epoch,
+    the digits are read from the fixed byte positions of all the rows at once.
+
+    :param timestamps: array like of str or bytes in the format YYYY-MM-DD HH:MM:SS[:fff|.ffffff]
+    :return: int64 array of nanoseconds and boolean mask of valid rows, the invalid rows have 0 nanoseconds
+    """
+    raw, too_long = _to_bytes(timestamps)
+    raw = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(len(raw), TIMESTAMP_WIDTH)
+    digits = raw.astype(np.int64) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+
+    valid = ~too_long
+    for position, separator in SEPARATORS.items():
+        valid &= raw[:, position] == ord(separator)
+    date_digits = [i for i in range(19) if i not in SEPARATORS]
+    valid &= is_digit[:, date_digits].all(axis=1)
+
+    year = _number(digits, 0, 4)
+    month = _number(digits, 5, 7)
+    day = _number(digits, 8, 10)
+    hour = _number(digits, 11, 13)
+    minute = _number(digits, 14, 16)
+    second = _number(digits, 17, 19)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & (minute < 60) & (second < 60)
+    valid &= (day <= DAYS_IN_MONTH[np.clip(month, 0, 12)]) & ((month != 2) | (day <= 28) | leap)
+
+    # the fraction has at least one and up to nanoseconds digits, as with strptime nothing may follow the row
+    has_fraction = np.isin(raw[:, FRACTION_START - 1], [ord(s) for s in FRACTION_SEPARATORS])
+    fraction_digits = np.cumprod(is_digit[:, FRACTION_START:], axis=1).astype(bool) & has_fraction[:, None]
+    valid &= np.where(has_fraction, fraction_digits[:, 0], raw[:, FRACTION_START - 1] == 0)
+    valid &= (fraction_digits | (raw[:, FRACTION_START:] == 0)).all(axis=1)
+    scale = 10 ** np.arange(FRACTION_DIGITS - 1, -1, -1, dtype=np.int64)
+    fraction = (np.where(fraction_digits, digits[:, FRACTION_START:], 0) * scale).sum(axis=1)
+
+    seconds = ((_days_from_civil(year, month, day) * 24 + hour) * 60 + minute) * 60 + second
+    nanoseconds = np.where(valid, seconds * NANOSECONDS + fraction, 0)
+    return nanoseconds, valid
+
+
+def to_datetime_index(nanoseconds, valid):
+    """
+    :param nanoseconds: int64 array from parse_timestamps
+    :param valid: boolean mask from parse_timestamps
+    :return: pandas DatetimeIndex with NaT in place of the invalid rows
+    """
+    return pd.DatetimeIndex(np.where(valid, nanoseconds, np.iinfo(np.int64).min).astype('datetime64[ns]'))
+
+
+def _to_bytes(timestamps):
+    # the longer rows would be cut to the width, they are returned as malformed instead
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == 'S':
+        return timestamps.astype(f'S{TIMESTAMP_WIDTH}'), np.char.str_len(timestamps) > TIMESTAMP_WIDTH
+    timestamps = pd.Series(timestamps, dtype=object).fillna('').astype(str)
+    too_long = (timestamps.str.len() > TIMESTAMP_WIDTH).values
+    try:
+        return timestamps.values.astype(f'S{TIMESTAMP_WIDTH}'), too_long
+    except UnicodeEncodeError:
+        # the rows with other than ascii characters are malformed anyway
+        return timestamps.str.encode('ascii', errors='replace').values.astype(f'S{TIMESTAMP_WIDTH}'), too_long
+
+
+def _number(digits, start, stop):
+    number = np.zeros(len(digits), dtype=np.int64)
+    for position in range(start, stop):
+        number = number * 10 + digits[:, position]
+    return number
+
+
+def _days_from_civil(year, month, day):
+    # days since 1970-01-01 of the proleptic gregorian calendar
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
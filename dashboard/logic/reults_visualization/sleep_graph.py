@@ -1,7 +1,8 @@
 import plotly.graph_objs as go
-from pandas import read_excel
+from pandas import DataFrame
 from plotly.offline import plot
 
+from dashboard.logic.features_extraction.count_hilev import load_night_interval
 from dashboard.logic.machine_learning.predict import predict
 from dashboard.logic.machine_learning.settings import scale_name, prediction_name
 from dashboard.models import SleepNight, CsvData
@@ -86,7 +87,9 @@ def _sleep_data_from_data_frame(df, column, name, color):
 
 
 def _sleep_data_from_sleep_night(sleep_night, column, name, color):
-    df = read_excel(sleep_night.name, index_col=0)
+    df = load_night_interval(sleep_night)
+    if df is None:
+        df = DataFrame(columns=[column])
     x = df.index
     map_values = {1: 'Sleep', 0: 'Wake'}
     y = df[column].astype(int).map(map_values)
@@ -1,6 +1,8 @@
 import logging
 import os.path
 
+import numpy as np
+
 from dashboard.logic import cache
 from dashboard.models import SleepDiaryDay, CsvData, Subject
 
@@ -23,30 +25,39 @@ def create_structure(subject):
 def _structure_for_subject(structure, subject):
     sleep_days = SleepDiaryDay.objects.filter(subject=subject)
     if sleep_days.exists():
+        data = list(CsvData.objects.filter(subject=subject))
+        if not data:  # no CSV data
+            logger.warning(f'Missing csv data for subject {subject} with {len(sleep_days)} sleep diary days')
+            return
+        # the data need to be found by the time covered by their predictions
+        coverage = {d.id: _load_coverage(d) for d in data} if len(data) > 1 else None
         for sleep_day in sleep_days:
             assert isinstance(sleep_day, SleepDiaryDay)
-            data = CsvData.objects.filter(subject=subject)
-            if not data.exists():  # no CSV data
-                logger.warning(
-                    f'Missing csv data for subject {subject} with {len(sleep_days)} sleep diary days')
+            matching_data = None
+            if len(data) == 1:  # single CSV data file
+                matching_data = data[0]
             else:
-                matching_data = None
-                if len(data) == 1:  # single CSV data file
-                    matching_data = data.first()
-                else:  # data need to be found
-                    s = sleep_day.t1
-                    e = sleep_day.t4
-                    for d in data:
-                        assert isinstance(d, CsvData)
-                        if not os.path.exists(d.cached_prediction_path):
-                            continue
-                        pred = cache.load_obj(d.cached_prediction_path)
-                        interval = pred[s:e]
-                        if len(interval) > 0:  # matchin data found
-                            matching_data = d
-                            break
-                if matching_data is None:
-                    continue
-                structure.append((subject, matching_data, sleep_day))
-                logger.debug(
-                    f'{subject.code} - {data.first().filename} - {sleep_day.date} added to validation structure ')
+                for d in data:
+                    if _covers(coverage[d.id], sleep_day.t1, sleep_day.t4):  # matchin data found
+                        matching_data = d
+                        break
+            if matching_data is None:
+                continue
+            structure.append((subject, matching_data, sleep_day))
+            logger.debug(
+                f'{subject.code} - {data[0].filename} - {sleep_day.date} added to validation structure ')
+
+
+def _load_coverage(data):
+    if not os.path.exists(data.cached_prediction_path):
+        return None
+    return cache.load_coverage(data.cached_prediction_path)
+
+
+def _covers(coverage, start, end):
+    # some predicted epoch lies between the start and the end
+    if coverage is None:
+        return False
+    starts, ends = coverage
+    position = np.searchsorted(ends, np.datetime64(start, 'ns'), side='left')
+    return position < len(starts) and starts[position] <= np.datetime64(end, 'ns')
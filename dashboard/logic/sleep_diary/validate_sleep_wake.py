@@ -1,9 +1,13 @@
 import logging
 import os.path
 
+import numpy as np
 import pandas as pd
 
 from dashboard.logic import cache
+from dashboard.logic.features_extraction.count_hilev import load_night_interval
+from dashboard.logic.features_extraction.hilev_thresholds import THRESHOLDS, binarize, threshold_table, \
+    hilev_threshold_table
 from dashboard.logic.features_extraction.utils import safe_div
 from dashboard.logic.machine_learning.settings import prediction_name
 from dashboard.models import SleepDiaryDay, WakeInterval, SleepNight, Subject, CsvData
@@ -11,8 +15,6 @@ from mysite.settings import BASE_DIR
 
 logger = logging.getLogger(__name__)
 
-THRESHOLDS = [round(th, 1) for th in [i / 10 for i in range(1, 11)]]
-
 
 def validate_sleep_wake():
     nights = SleepNight.objects.all()
@@ -34,9 +36,13 @@ def validate_sleep_wake():
         logger.warning('No nights available for sleep/wake validation.')
         return None
 
+    night_counts = _count_nights(validation_entries)
+    if night_counts is None:
+        logger.warning('No epochs in bed available for sleep/wake validation.')
+        return None
     results = []
-    for threshold in THRESHOLDS:
-        metrics = _evaluate_threshold(validation_entries, threshold)
+    for index, threshold in enumerate(THRESHOLDS):
+        metrics = _evaluate_threshold(night_counts, index)
         if metrics['evaluated_nights'] == 0:
             logger.warning(f'Unable to evaluate threshold {threshold:.1f}: no matching diary data.')
             continue
@@ -70,6 +76,10 @@ def validate_sleep_wake():
     output_path = os.path.join(BASE_DIR, 'threshold_against_sleep_diary.xlsx')
     result_table.to_excel(output_path, index=False)
     logger.info(f'Threshold comparison exported to {output_path}')
+    # the high level features of the nights for the same thresholds to calibrate them
+    hilev_path = os.path.join(BASE_DIR, 'hilev_for_thresholds.xlsx')
+    hilev_threshold_table().to_excel(hilev_path, index=False)
+    logger.info(f'High level features for the thresholds exported to {hilev_path}')
 
     best_result = max(results, key=lambda res: res['accuracy'])
     logger.info(
@@ -77,63 +87,70 @@ def validate_sleep_wake():
         f'SEN: {best_result["sensitivity"]:.2f}% | SPE: {best_result["specificity"]:.2f}% | '
         f'Nights evaluated: {best_result["evaluated_nights"]}')
 
-    _evaluate_threshold(validation_entries, best_result['threshold'], log_details=True)
+    _evaluate_threshold(night_counts, THRESHOLDS.index(best_result['threshold']), log_details=True)
     _report_subject_night_counts()
 
     return best_result
 
 
-def _evaluate_threshold(entries, threshold, log_details=False):
-    map_values = {1: 'S', 0: 'W'}
+def _count_nights(entries):
+    """
+    Counts the confusion matrix of every night for all the thresholds at once.
+
+    The epochs in bed before the sleep, during the wake intervals and in bed after the wake up
+    are expected to be wake, the rest of the night is expected to be sleep.
+
+    :param entries: list of (night, day, predictions dataframe) tuples
+    :return: dataframe with the date, the threshold and the TP, FP, TN and FN counts of every night and threshold,
+             None if no night has epochs in bed
+    """
+    return threshold_table(
+        (({'date': day.date}, df[prediction_name], day) for night, day, df in entries), _night_counts, THRESHOLDS)
+
+
+def _night_counts(prediction, day, thresholds):
+    # the confusion matrix of the night for all the thresholds, None if there are no epochs in bed
+    prediction = prediction.loc[day.t1:day.t4]
+    if prediction.empty:
+        return None
+    times = prediction.index
+    # an epoch on the border of the interval is counted in the interval, but it is not removed from the night
+    expected_wake = np.zeros(len(times), dtype=np.int64)
+    removed = np.zeros(len(times), dtype=bool)
+    intervals = [(day.t1, day.t2)]
+    for wake_interval in WakeInterval.objects.filter(sleep_diary_day=day).all():
+        assert isinstance(wake_interval, WakeInterval)
+        intervals.append((wake_interval.start_with_date, wake_interval.end_with_date))
+    intervals.append((day.t3, day.t4))
+    for start, end in intervals:
+        expected_wake += (times >= start) & (times <= end) & ~removed
+        removed |= (times > start) & (times < end)
+    expected_sleep = ~removed
+
+    sleep = binarize(prediction.values, thresholds)
+    return pd.DataFrame({
+        'threshold': list(thresholds),
+        'TP': (sleep & expected_sleep).sum(axis=1),
+        'FP': (sleep * expected_wake).sum(axis=1),
+        'TN': (~sleep * expected_wake).sum(axis=1),
+        'FN': (~sleep & expected_sleep).sum(axis=1),
+    })
+
+
+def _evaluate_threshold(night_counts, index, log_details=False):
+    threshold = THRESHOLDS[index]
     total_TP = 0
     total_FP = 0
     total_TN = 0
     total_FN = 0
     evaluated_nights = 0
 
-    for night, day, df in entries:
-        s = day.t1
-        e = day.t4
-        prediction = df.loc[s:e, [prediction_name]].copy()
-        if prediction.empty:
-            continue
-
-        labelled_prediction = prediction.copy()
-        labelled_prediction[prediction_name] = (
-            (prediction[prediction_name] >= threshold).astype(int).map(map_values)
-        )
-
-        TP = TN = FP = FN = 0
-
-        # in bed before sleep: sleep_time -> sleep_duration
-        sleep, remaining_values = _select_interval(labelled_prediction, s, day.t2)
-        TN += sleep.count('W')
-        FP += sleep.count('S')
-
-        # wakeup intervals during night
-        for wake_interval in WakeInterval.objects.filter(sleep_diary_day=day).all():
-            assert isinstance(wake_interval, WakeInterval)
-            sleep, remaining_values = _select_interval(
-                remaining_values,
-                wake_interval.start_with_date,
-                wake_interval.end_with_date
-            )
-            TN += sleep.count('W')
-            FP += sleep.count('S')
-
-        # after wake in bed: wake_time -> get_up_time
-        sleep, remaining_values = _select_interval(remaining_values, day.t3, day.t4)
-        TN += sleep.count('W')
-        FP += sleep.count('S')
-
-        # the rest of the night, so the sleep time
-        sleep, remaining_values = _select_interval(remaining_values, s, e)
-        TP += sleep.count('S')
-        FN += sleep.count('W')
+    for row in night_counts[night_counts['threshold'] == threshold].itertuples():
+        TP, FP, TN, FN = int(row.TP), int(row.FP), int(row.TN), int(row.FN)
 
         if log_details:
             logger.info(
-                f'Day {day.date} (threshold {threshold:.1f}) || TP: {TP} | FN: {FN} | FP: {FP} | TN: {TN} || '
+                f'Day {row.date} (threshold {threshold:.1f}) || TP: {TP} | FN: {FN} | FP: {FP} | TN: {TN} || '
                 f'ACC: {safe_div(TN + TP, TP + TN + FP + FN) * 100:.2f}% | '
                 f'SEN: {safe_div(TP, TP + FN) * 100:.2f}% | '
                 f'SPE: {safe_div(TN, TN + FP) * 100:.2f}%'
@@ -188,19 +205,9 @@ def _report_subject_night_counts():
 
 
 def _get_df(night):
-    if os.path.exists(night.name):
-        return pd.read_excel(night.name, index_col=0)
-    if not os.path.exists(night.data.excel_prediction_path):
-        if os.path.exists(night.data.cached_prediction_path):
-            df = cache.load_obj(night.data.cached_prediction_path)
-            df.to_excel(night.data.excel_prediction_path)
-            _get_df(night)
+    df = load_night_interval(night)
+    if df is not None:
+        return df
+    if not os.path.exists(night.data.cached_prediction_path):
         return None
-    return pd.read_excel(night.data.excel_prediction_path, index_col=0, usecols='A,EE')
-
-
-def _select_interval(prediction, start, end):
-    sleep_time_duration = prediction[start:end]
-    remaining_values = pd.concat([prediction[:start], prediction[end:]])
-    sleep = sleep_time_duration[prediction_name].values.tolist()
-    return sleep, remaining_values
+    return cache.load_predictions(night.data.cached_prediction_path, columns=[prediction_name])
@@ -50,7 +50,8 @@ def sleeppy(csv_data, force=False):
                     input_file=csv_data.data.path,
                     results_directory=csv_data.sleeppy_dir,
                     sampling_frequency=25,
-                    verbose=True
+                    verbose=True,
+                    store_path=csv_data.raw_store_path
                 )
             else:
                 logger.info(f'Working with end date {csv_data.end_date}')
@@ -59,6 +60,7 @@ def sleeppy(csv_data, force=False):
                     results_directory=csv_data.sleeppy_dir,
                     sampling_frequency=25,
                     verbose=True,
+                    store_path=csv_data.raw_store_path,
                     stop_time=csv_data.end_date.strftime("%Y-%m-%d %H:%M:%S:%f")
                 )
             sleepy.run_config = 0
@@ -15,13 +15,31 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import seaborn as sns
 import struct
+import warnings
 from bitstring import BitArray
 from scipy import signal
 from shutil import copy, rmtree
 
+from dashboard.logic.preprocessing.raw_store import load_raw_store
+from dashboard.logic.preprocessing.timestamps import parse_timestamps, to_datetime_index
+
 sns.set()
-pd.options.mode.chained_assignment = None
-__all__ = ["SleepPy", "ColeKripke", "band_pass_filter", "activity_index", "bin2df"]
+__all__ = [
+    "SleepPy",
+    "ColeKripke",
+    "band_pass_filter",
+    "activity_index",
+    "activity_index_windows",
+    "rolling_median",
+    "rolling_block_std",
+    "rolling_block_range",
+    "run_lengths",
+    "major_rest_block",
+    "bin2df",
+]
+
+# csv column names of the raw store channels
+STORE_CHANNELS = {"X": "x", "Y": "y", "Z": "z", "LUX": "lux", "T": "temperature"}
 
 
 class SleepPy:
@@ -86,6 +104,8 @@ class SleepPy:
             clear_intermediate_data=False,
             aws_object=None,
             verbose=False,
+            store_path=None,
+            activity_index_parity=True,
     ):
         """
         Class initialization.
@@ -107,6 +127,10 @@ class SleepPy:
         :param clear_intermediate_data: boolean flag to clear all intermediate data
         :param aws_object: data object to be processed from aws (in place of source file path
         :param verbose: boolean for printing status
+        :param store_path: full path to the raw sample store of the csv file, read instead of parsing the csv file
+        :param activity_index_parity: boolean flag to band pass filter each activity index window on its own
+                                      like the original per window results, False filters the whole day at once
+                                      which is faster but changes the activity index near the window edges
         """
         if aws_object is not None:
             self.src = aws_object
@@ -136,6 +160,8 @@ class SleepPy:
         self.minimum_hours = minimum_hours
         self.clear = clear_intermediate_data
         self.verbose = verbose
+        self.store_path = store_path
+        self.activity_index_parity = activity_index_parity
         self.run()  # run the package
 
     def run(self):
@@ -224,7 +250,7 @@ class SleepPy:
             "T": np.float32,
         }
 
-        def chunk_iter():
+        def read_csv_chunks():
             try:
                 return pd.read_csv(
                     names=["Time", "X", "Y", "Z", "LUX", "Button", "T"],
@@ -257,6 +283,22 @@ class SleepPy:
             )
         start_buffer = pd.Timedelta(self.start_buffer)
 
+        def chunk_iter():
+            if self.store_path:
+                # the samples are read from the shared raw store instead of parsing the csv file again
+                store = load_raw_store(self.src, self.store_path)
+                row = 0 if start_limit is None else store.find_row(start_limit.timestamp())
+                for columns in store.iter_slices(row, base_kwargs["chunksize"]):
+                    yield pd.DataFrame(
+                        {name: columns[channel] for name, channel in STORE_CHANNELS.items()},
+                        index=pd.DatetimeIndex(columns["time"].astype("datetime64[ns]"), name="Time"),
+                    )
+                return
+            for chunk in read_csv_chunks():
+                timestamps = pd.Index(chunk.index.astype(str)).str.replace("\x00", "", regex=False)
+                chunk.index = to_datetime_index(*parse_timestamps(timestamps)).rename(chunk.index.name)
+                yield chunk[~chunk.index.isna()]
+
         count = 0
         current_day_key = None
         current_day_parts = []
@@ -280,16 +322,6 @@ class SleepPy:
             if chunk.empty:
                 continue
 
-            timestamps = pd.Index(chunk.index.astype(str)).str.replace("\x00", "", regex=False)
-            chunk.index = pd.to_datetime(
-                timestamps,
-                format="%Y-%m-%d %H:%M:%S:%f",
-                errors="coerce",
-            )
-            chunk = chunk[~chunk.index.isna()]
-            if chunk.empty:
-                continue
-
             if start_limit is None:
                 start_limit = chunk.index[0] + start_buffer
 
@@ -402,37 +434,25 @@ class SleepPy:
 
             # load data
             df = pd.read_hdf(day)
-            activity = []
-            header = ["Time", "activity_index"]
-            idx = 0
             window = int(self.window_size * self.fs)
-            incrementer = int(self.window_size * self.fs)
-
-            # iterate through windows
-            while idx < len(df) - incrementer:
-                # preprocessing: BP Filter
-                temp = df[["X", "Y", "Z"]].iloc[idx: idx + window]
-                start_time = temp.index[0]
-                temp.index = range(len(temp.index))  # reset index
-                temp = band_pass_filter(
-                    temp, self.fs, bp_cutoff=self.band_pass_cutoff, order=3
-                )
 
-                # activity index extraction
-                bp_channels = [
-                    i for i in temp.columns.values[1:] if "bp" in i
-                ]  # band pass filtered channels
-                activity.append(
-                    [
-                        start_time,
-                        activity_index(temp, channels=bp_channels).values[0][0],
-                    ]
-                )
-                idx += incrementer
+            # activity index of all the windows at once, each window starts at its first sample
+            count_windows = max(0, -(-(len(df) - window) // window))
+            activity = pd.DataFrame(
+                {
+                    "Time": df.index[: count_windows * window: window],
+                    "activity_index": activity_index_windows(
+                        df[["X", "Y", "Z"]].values[: count_windows * window],
+                        self.fs,
+                        window,
+                        bp_cutoff=self.band_pass_cutoff,
+                        order=3,
+                        parity=self.activity_index_parity,
+                    ),
+                }
+            )
 
             # save data
-            activity = pd.DataFrame(activity)
-            activity.columns = header
             activity.set_index("Time", inplace=True)
             dst = "/activity_index_days/{}_activity_index_day_{}.h5".format(
                 self.src_name, str(count).zfill(2)
@@ -465,24 +485,19 @@ class SleepPy:
             df = pd.read_hdf(day)[["X", "Y", "Z"]]
             count += 1
 
-            # get std based classification criteria
+            # get std based classification criteria, number of axes over the threshold
             df_std = self.roll_std_60_minute(df)
-            df_std[df_std >= 0.013] = 1
-            df_std[df_std < 0.013] = 0
-            df_std = df_std.sum(axis=1)
+            std_axes = (df_std.values >= 0.013).sum(axis=1)
 
-            # get range based classification criteria
+            # get range based classification criteria, number of axes over the threshold
             df_range = self.roll_max_range_60_minute(df)
-            df_range[df_range >= 0.15] = 1
-            df_range[df_range < 0.15] = 0
-            df_range = df_range.sum(axis=1)
+            range_axes = (df_range.values >= 0.15).sum(axis=1)
 
-            # classify
-            df_wear = pd.DataFrame(df_std.copy()) * 0 + 1
-            df_wear.columns = ["wear"]
-            for i in range(len(df_wear)):
-                if df_range.iloc[i] <= 1 or df_std.iloc[i] <= 1:
-                    df_wear.iloc[i] = 0
+            # classify, non wear if at most one axis passes either criteria
+            df_wear = pd.DataFrame(
+                {"wear": np.where((range_axes <= 1) | (std_axes <= 1), 0.0, 1.0)},
+                index=df_std.index,
+            )
 
             # save before rescoring
             df_wear.to_hdf(
@@ -577,50 +592,24 @@ class SleepPy:
                     self.maximum_rest_threshold,
                 ]
             )
-            df_angle.Data[df_angle.Data < thresh] = 0  # apply threshold
-            df_angle.Data[df_angle.Data >= thresh] = 1  # apply threshold
+            data = df_angle.Data.values
+            data = np.where(data < thresh, 0.0, np.where(data >= thresh, 1.0, data))  # apply threshold
 
             # drop rest periods where temperature is below the temp threshold
-            df_angle.Data[df_temp.Data <= self.min_t] = 1
-            df = df_angle
-
-            # drop rest blocks < minimum_rest_block minutes (except first and last)
-            df["block"] = (df.Data.diff().ne(0)).cumsum()
-            groups, iter_count = df.groupby(by="block"), 0
-            for group in groups:
-                iter_count += 1
-                if iter_count == 1 or iter_count == len(groups):
-                    continue
-                if (
-                        group[1]["Data"].sum() == 0
-                        and len(group[1]) < 12 * self.minimum_rest_block
-                ):
-                    df.Data[group[1].index[0]: group[1].index[-1]] = 1
-
-            # drop active blocks < allowed_rest_break minutes (except first and last)
-            df["block"] = (df.Data.diff().ne(0)).cumsum()
-            groups, iter_count = df.groupby(by="block"), 0
-            for group in groups:
-                iter_count += 1
-                if iter_count == 1 or iter_count == len(groups):
-                    continue
-                if (
-                        len(group[1]) == group[1]["Data"].sum()
-                        and len(group[1]) < 12 * self.allowed_rest_break
-                ):
-                    df.Data[group[1].index[0]: group[1].index[-1]] = 0
-
-            # get longest block
-            df["block"] = (df.Data.diff().ne(0)).cumsum()
-            best = 0
-            mrp = []
-            for group in df.groupby(by="block"):
-                if group[1]["Data"].sum() == 0 and len(group[1]) > best:
-                    best = len(group[1])
-                    mrp = [group[1].index[0], group[1].index[-1] + pd.Timedelta("5m")]
+            data[df_temp.Data.values <= self.min_t] = 1
+
+            # drop short rest and active blocks and find the longest rest block
+            data, longest = major_rest_block(
+                data, 12 * self.minimum_rest_block, 12 * self.allowed_rest_break
+            )
+            df = pd.DataFrame({"Data": data}, index=df_angle.index)
+            mrp = (
+                []
+                if longest is None
+                else [df.index[longest[0]], df.index[longest[1]] + pd.Timedelta("5m")]
+            )
 
             # save predictions
-            df.drop(columns=["block"], inplace=True)
             df.to_hdf(
                 self.sub_dst
                 + "/major_rest_period/rest_periods_day_{}.h5".format(
@@ -782,18 +771,12 @@ class SleepPy:
         :return: pandas dataframe containing the rolling median values.
         """
 
-        # initialize indexer and rolling median list
-        idx = 0
-        med = []
-        while idx < len(df) - num_samples:
-            med.append(
-                [df.index[idx], df.iloc[idx: idx + num_samples].median()]
-            )  # get start index, std value
-            idx += 1
-        # format data frame
-        df = pd.DataFrame(med, columns=["Time", "Data"])
-        df.set_index(df.Time, inplace=True)
-        df.drop(inplace=True, columns="Time")
+        # windows start at each sample and end before the last num_samples samples
+        df = pd.DataFrame(
+            {"Data": rolling_median(df.values, num_samples)},
+            index=df.index[: max(0, len(df) - num_samples)],
+        )
+        df.index.name = "Time"
         return df
 
     def roll_std_60_minute(self, df):
@@ -803,25 +786,8 @@ class SleepPy:
         :param df: pandas dataframe
         :return: pandas dataframe containing the rolling std values
         """
-        # initialize indexer and rolling std list
-        idx = 0
-        rstd = []
-
-        # calculate std for all windows
-        while idx < len(df) - int(900 * self.fs):  # run until we reach the end
-            xyz = (
-                df.iloc[idx: idx + int(3600 * self.fs)].std().values
-            )  # save std in x y and z
-            rstd.append(
-                [df.index[idx], xyz[0], xyz[1], xyz[2]]
-            )  # get start index of window, std values
-            idx += int(900 * self.fs)  # increment indexer by 15 minutes
-
-        # format dataframe
-        df = pd.DataFrame(rstd, columns=["Time", "X", "Y", "Z"])
-        df.set_index(df.Time, inplace=True)
-        df.drop(inplace=True, columns="Time")
-        return df
+        # 60 minute windows starting every 15 minutes, combined from 4 blocks of 15 minutes
+        return self._roll_60_minute(df, rolling_block_std)
 
     def roll_max_range_60_minute(self, df):
         """
@@ -830,25 +796,16 @@ class SleepPy:
         :param df: pandas dataframe
         :return: pandas dataframe containing the rolling std values.
         """
-        # initialize indexer and rolling range list
-        idx = 0
-        rr = []
-
-        # calculate range for all windows
-        while idx < len(df) - int(900 * self.fs):  # run until we reach the end
-            xyz = (
-                    df.iloc[idx: idx + int(3600 * self.fs)].max().values
-                    - df.iloc[idx: idx + int(3600 * self.fs)].min().values
-            )  # save range in x y z
-            rr.append(
-                [df.index[idx], xyz[0], xyz[1], xyz[2]]
-            )  # get start index of window, range values
-            idx += int(900 * self.fs)  # increment indexer by 15 minutes
-
-        # format dataframe
-        df = pd.DataFrame(rr, columns=["Time", "X", "Y", "Z"])
-        df.set_index(df.Time, inplace=True)
-        df.drop(inplace=True, columns="Time")
+        # 60 minute windows starting every 15 minutes, combined from 4 blocks of 15 minutes
+        return self._roll_60_minute(df, rolling_block_range)
+
+    def _roll_60_minute(self, df, rolling_block):
+        block = int(900 * self.fs)
+        if int(3600 * self.fs) != 4 * block:
+            raise ValueError(f"Sampling frequency {self.fs} does not split 60 minutes into 4 equal blocks")
+        values = rolling_block(df.values, block, 4)
+        df = pd.DataFrame(values, index=df.index[: len(values) * block: block], columns=["X", "Y", "Z"])
+        df.index.name = "Time"
         return df
 
     def visualize_results(self):
@@ -1174,32 +1131,21 @@ class SleepPy:
         :return: rescored pandas dataframe of wear/nonwear predictions
         """
         # group classifications into wear and nonwear blocks
-        df["block"] = (df.wear.diff().ne(0)).cumsum()
-        blocks = list(df.groupby("block"))
-
-        # iterate through blocks
-        for i in range(1, len(blocks) - 1):
-            wear = blocks[i][1]["wear"].values[
-                0
-            ]  # get whether or not the block is wear
-            if wear:
-                # get hour lengths of the previous, current, and next blocks
-                prev, current, post = (
-                    len(blocks[i - 1][1]) * 0.25,
-                    len(blocks[i][1]) * 0.25,
-                    len(blocks[i + 1][1]) * 0.25,
-                )
-                # if the current block is less than 3 hours and the ratio to previous and post blocks is less than 80%
-                if current < 3 and current / (prev + post) < 0.8:
-                    df["wear"][
-                        df.block == blocks[i][0]
-                        ] = 0  # rescore the wear period as non wear
-                # if the current block is less than 6 hours and the ratio to previous and post blocks is less than 30%
-                elif current < 6 and current / (prev + post) < 0.3:
-                    df["wear"][
-                        df.block == blocks[i][0]
-                        ] = 0  # rescore the wear period as non wear
-        df.drop(columns=["block"], inplace=True)
+        wear = df["wear"].values.copy()
+        starts, lengths, states = run_lengths(wear)
+        hours = lengths * 0.25
+
+        # inner wear blocks with the hour lengths of the previous, current, and next blocks
+        blocks = np.arange(1, len(starts) - 1)
+        blocks = blocks[states[blocks] != 0]
+        current = hours[blocks]
+        ratio = current / (hours[blocks - 1] + hours[blocks + 1])
+
+        # rescore as non wear if the current block is less than 3 hours and the ratio to previous and post blocks
+        # is less than 80% or if it is less than 6 hours and the ratio is less than 30%
+        rescored = blocks[((current < 3) & (ratio < 0.8)) | ((current < 6) & (ratio < 0.3))]
+        wear[_expand_runs(rescored, starts, lengths)] = 0
+        df["wear"] = wear
         return df
 
     def rescore_last_day(self, df):
@@ -1211,28 +1157,20 @@ class SleepPy:
         :return: rescored pandas dataframe of wear/nonwear predictions
         """
         # group classifications into wear and nonwear blocks
-        df["block"] = (df.wear.diff().ne(0)).cumsum()
-        blocks = list(df.groupby("block"))
+        wear = df["wear"].values.copy()
+        starts, lengths, states = run_lengths(wear)
+        hours = lengths * 0.25
 
         # get the start index of the last day
         last_day_index = df.index[-1] - pd.to_timedelta("24h")
 
-        # iterate through blocks
-        for i in range(1, len(blocks)):
-            wear = blocks[i][1]["wear"].values[
-                0
-            ]  # get whether or not the block is wear
-            if (
-                    wear and blocks[i][1].index[0] > last_day_index
-            ):  # if wear, and it's the last day
-                # get hour lengths of the previous and current blocks
-                prev, current = len(blocks[i - 1][1]) * 0.25, len(blocks[i][1]) * 0.25
-                # if the current block is less than 3 hours and the previous block is greater or equal to 1 hour
-                if current < 3 and prev >= 1:
-                    df["wear"][
-                        df.block == blocks[i][0]
-                        ] = 0  # rescore the wear period as non wear
-        df.drop(columns=["block"], inplace=True)
+        # wear blocks starting on the last day, rescored as non wear if the current block is less than 3 hours
+        # and the previous block is greater or equal to 1 hour
+        blocks = np.arange(1, len(starts))
+        blocks = blocks[(states[blocks] != 0) & (df.index[starts[blocks]] > last_day_index)]
+        rescored = blocks[(hours[blocks] < 3) & (hours[blocks - 1] >= 1)]
+        wear[_expand_runs(rescored, starts, lengths)] = 0
+        df["wear"] = wear
         return df
 
     def aggregate_results(self):
@@ -1417,6 +1355,209 @@ def activity_index(signal_df, channels=["X", "Y", "Z"]):
     return ai_df
 
 
+def activity_index_windows(data, sampling_rate, window, bp_cutoff, order, parity=True):
+    """
+    Compute activity index of consecutive windows of sensor signals with a single filter design.
+
+    :param data: array samples x channels, the number of samples is a multiple of the window
+    :param sampling_rate: sampling rate of signal
+    :param window: number of samples in a window
+    :param bp_cutoff: filter cutoffs
+    :param order: filter order
+    :param parity: filter each window on its own like band_pass_filter, otherwise filter the whole signal at once
+    :return: array with the activity index of each window
+    """
+    count_windows = len(data) // window
+    if count_windows == 0:
+        return np.empty(0)
+    critical_frequency = [
+        bp_cutoff[0] * 2.0 / sampling_rate,
+        bp_cutoff[1] * 2.0 / sampling_rate,
+    ]
+    [b, a] = signal.butter(
+        N=order, Wn=critical_frequency, btype="bandpass", analog=False
+    )
+    windows = np.asarray(data[: count_windows * window], dtype=np.float64).reshape(
+        count_windows, window, -1
+    )
+    if parity:
+        # windows x samples x channels, filtered along the samples of each window
+        filtered = signal.filtfilt(b, a, windows, padlen=10, axis=1)
+    else:
+        # the whole signal is filtered once, so only its two ends carry the edge transients
+        filtered = signal.filtfilt(
+            b, a, windows.reshape(count_windows * window, -1), axis=0
+        ).reshape(windows.shape)
+    return np.var(filtered, axis=1).mean(axis=1) ** 0.5
+
+
+def rolling_median(values, window):
+    """
+    Compute the median of the windows starting at each sample, the missing values are skipped like by pandas.
+
+    :param values: 1-D array of the signal
+    :param window: number of samples in a window
+    :return: array with the median of the windows starting at the samples 0 .. len(values) - window - 1
+    """
+    values = np.asarray(values, dtype=np.float64)
+    count_windows = len(values) - window
+    if count_windows <= 0:
+        return np.empty(0)
+    # read-only strided view windows x samples, the median sorts a copy of the view
+    windows = np.lib.stride_tricks.sliding_window_view(values[: count_windows + window - 1], window)
+    med = np.median(windows, axis=1)
+    missing = np.flatnonzero(np.isnan(med))
+    if len(missing):
+        with warnings.catch_warnings():
+            # the windows of only missing values stay missing
+            warnings.simplefilter("ignore", RuntimeWarning)
+            med[missing] = np.nanmedian(windows[missing], axis=1)
+    return med
+
+
+def rolling_block_std(values, block, count_blocks):
+    """
+    Compute the standard deviation of the windows of count_blocks blocks starting at each block but the last one,
+    the windows at the end are shortened like by iloc. Each block is reduced once and the blocks of a window
+    are combined by the parallel variance formula, the missing values are skipped like by pandas.
+
+    :param values: array samples x channels
+    :param block: number of samples in a block, the step between the windows
+    :param count_blocks: number of blocks in a window
+    :return: array windows x channels with the sample standard deviation of each window
+    """
+    counts, means, m2 = (np.concatenate(m) for m in zip(*map(_block_moments, _split_blocks(values, block))))
+    count_windows = len(counts) - 1
+    if count_windows <= 0:
+        return np.empty((0, np.shape(values)[1]))
+    counts, means, m2 = (_sliding_blocks(m, count_blocks, count_windows) for m in (counts, means, m2))
+    n = counts.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (counts * means).sum(axis=1) / n
+        m2 = m2.sum(axis=1) + (counts * (means - mean[:, None, :]) ** 2).sum(axis=1)
+        return np.where(n > 1, np.sqrt(m2 / (n - 1)), np.nan)
+
+
+def rolling_block_range(values, block, count_blocks):
+    """
+    Compute the range of the windows of count_blocks blocks starting at each block but the last one,
+    the windows at the end are shortened like by iloc. Each block is reduced once, the missing values are skipped.
+
+    :param values: array samples x channels
+    :param block: number of samples in a block, the step between the windows
+    :param count_blocks: number of blocks in a window
+    :return: array windows x channels with the max - min of each window
+    """
+    parts = _split_blocks(values, block)
+    count_windows = sum(len(p) for p in parts) - 1
+    if count_windows <= 0:
+        return np.empty((0, np.shape(values)[1]))
+    maximum = _sliding_blocks(np.concatenate([_block_reduce(p, np.max, np.fmax) for p in parts]),
+                              count_blocks, count_windows, np.nan)
+    minimum = _sliding_blocks(np.concatenate([_block_reduce(p, np.min, np.fmin) for p in parts]),
+                              count_blocks, count_windows, np.nan)
+    return np.fmax.reduce(maximum, axis=1) - np.fmin.reduce(minimum, axis=1)
+
+
+def _split_blocks(values, block):
+    # blocks x samples x channels views of the full blocks and of the shorter last block
+    values = np.asarray(values, dtype=np.float64)
+    full = len(values) // block
+    parts = [values[: full * block].reshape(full, block, values.shape[1])]
+    if len(values) % block:
+        parts.append(values[full * block:][None])
+    return parts
+
+
+def _block_moments(blocks):
+    # count, mean and sum of squared deviations of each block and channel
+    means = blocks.mean(axis=1)
+    counts = np.full(means.shape, blocks.shape[1])
+    m2 = ((blocks - means[:, None, :]) ** 2).sum(axis=1)
+    missing = np.flatnonzero(np.isnan(means).any(axis=1))
+    if len(missing):
+        # only the blocks with missing values go through the slower nan aware reductions
+        with np.errstate(invalid="ignore", divide="ignore"):
+            counts[missing] = np.sum(~np.isnan(blocks[missing]), axis=1)
+            means[missing] = np.nansum(blocks[missing], axis=1) / counts[missing]
+            m2[missing] = np.nansum((blocks[missing] - means[missing][:, None, :]) ** 2, axis=1)
+        means[counts == 0] = 0.0
+    return counts, means, m2
+
+
+def _block_reduce(blocks, reduce, nan_reduce):
+    result = reduce(blocks, axis=1)
+    missing = np.flatnonzero(np.isnan(result).any(axis=1))
+    if len(missing):
+        result[missing] = nan_reduce.reduce(blocks[missing], axis=1)
+    return result
+
+
+def _sliding_blocks(blocks, count_blocks, count_windows, empty=0):
+    # windows x count_blocks x channels of the reduced blocks, the blocks after the end are filled by empty
+    padded = np.concatenate((blocks, np.full((count_blocks - 1,) + blocks.shape[1:], empty, dtype=blocks.dtype)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, count_blocks, axis=0)
+    return windows.transpose(0, 2, 1)[:count_windows]
+
+
+def run_lengths(values):
+    """
+    Run length encode a signal into the blocks of equal consecutive values.
+
+    :param values: 1-D array of the signal
+    :return: tuple of arrays with the first index, the length and the value of each block
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), values[:0]
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    lengths = np.diff(np.append(starts, len(values)))
+    return starts, lengths, values[starts]
+
+
+def major_rest_block(data, minimum_rest_block, allowed_rest_break):
+    """
+    Find the major rest period of a day in the rest (0) / active (1) series by run length encoded blocks.
+    The inner rest blocks shorter than minimum_rest_block are made active, then the inner active blocks
+    shorter than allowed_rest_break are made rest, the first and the last block are kept. The missing values
+    count as rest blocks of their own.
+
+    :param data: 1-D array of the rest / active series
+    :param minimum_rest_block: number of samples required to keep a rest block
+    :param allowed_rest_break: number of samples of an active block allowed to interrupt a rest block
+    :return: tuple of the series after the rules and the (first, last) index of the longest rest block,
+             the first one of equally long blocks, None if there is no rest block
+    """
+    data = np.array(data, dtype=np.float64)
+
+    # drop rest blocks < minimum_rest_block (except first and last)
+    starts, lengths, states = run_lengths(data)
+    blocks = np.arange(1, len(starts) - 1)
+    short = blocks[(states[blocks] != 1) & (lengths[blocks] < minimum_rest_block)]
+    data[_expand_runs(short, starts, lengths)] = 1
+
+    # drop active blocks < allowed_rest_break (except first and last)
+    starts, lengths, states = run_lengths(data)
+    blocks = np.arange(1, len(starts) - 1)
+    short = blocks[(states[blocks] == 1) & (lengths[blocks] < allowed_rest_break)]
+    data[_expand_runs(short, starts, lengths)] = 0
+
+    # get longest block
+    starts, lengths, states = run_lengths(data)
+    rest = np.flatnonzero(states != 1)
+    if len(rest) == 0:
+        return data, None
+    longest = rest[np.argmax(lengths[rest])]
+    return data, (int(starts[longest]), int(starts[longest] + lengths[longest] - 1))
+
+
+def _expand_runs(blocks, starts, lengths):
+    # boolean mask of the samples of the selected blocks
+    selected = np.zeros(len(starts), dtype=bool)
+    selected[blocks] = True
+    return np.repeat(selected, lengths)
+
+
 def bin2df(full_path):
     """
 
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.logic.machine_learning.settings import prediction_name
+from dashboard.logic.machine_learning.streaming import stream_store_predictions
+from dashboard.logic.preprocessing.preprocess_data import get_subject_nights
+from dashboard.logic.preprocessing.raw_store import CHUNK_SIZE, load_raw_store
+from dashboard.models import Subject
+
+
+class Command(BaseCommand):
+    help = "Classify a GENEActiv csv file into sleep and wake chunk by chunk, without caching its features."
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_path", help="Path to the GENEActiv csv file.")
+        parser.add_argument(
+            "--output",
+            dest="output_path",
+            required=True,
+            help="Path to the csv file with the predictions of the epochs.",
+        )
+        parser.add_argument(
+            "--subject",
+            dest="subject_code",
+            default=None,
+            help="Code of the subject whose sleep diary nights are classified, all the samples if omitted.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            dest="chunk_size",
+            type=int,
+            default=CHUNK_SIZE,
+            help="Number of samples classified at once.",
+        )
+
+    def handle(self, *args, **options):
+        csv_path = Path(options["csv_path"]).expanduser()
+        if not csv_path.exists():
+            raise CommandError(f"Csv file not found: {csv_path}")
+
+        nights = None
+        if options["subject_code"] is not None:
+            subject = Subject.objects.filter(code=options["subject_code"]).first()
+            if subject is None:
+                raise CommandError(f"Subject not found: {options['subject_code']}")
+            nights = get_subject_nights(subject)
+
+        # the raw store is needed just for the reading, it is not kept
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = load_raw_store(str(csv_path), str(Path(tmp_dir) / "store"))
+            predictions = list(stream_store_predictions(store, nights, options["chunk_size"]))
+
+        if not predictions:
+            self.stdout.write(self.style.WARNING("No epochs to classify."))
+            return
+        predictions = pd.concat(predictions)
+        predictions.to_frame(prediction_name).to_csv(options["output_path"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Classified {len(predictions)} epochs into {options['output_path']}")
+        )
@@ -14,6 +14,7 @@ from pathlib import Path
 import pytz
 from django.core.validators import FileExtensionValidator
 from django.db import models
+from django.urls import reverse
 
 from dashboard.logic.features_extraction.norms import sol, awk5plus, waso, se
 from dashboard.logic.features_extraction.utils import safe_div
@@ -89,15 +90,43 @@ class CsvData(models.Model):
         data_path = Path(self.data.path).resolve()
         folder = data_path.parent.parent / 'predictions'
         folder.mkdir(exist_ok=True)
-        return str(folder / f'{data_path.name}.pkl')
+        return str(folder / f'{data_path.name}.parquet')
 
     @property
     def x_data_path(self):
+        data_path = Path(self.data.path).resolve()
+        folder = data_path.parent.parent / 'cache'
+        folder.mkdir(exist_ok=True)
+        return str(folder / f'{data_path.name}.parquet')
+
+    @property
+    def x_data_excel_path(self):
         data_path = Path(self.data.path).resolve()
         folder = data_path.parent.parent / 'cache'
         folder.mkdir(exist_ok=True)
         return str(folder / f'{data_path.name}.xlsx')
 
+    @property
+    def prediction_state_path(self):
+        data_path = Path(self.data.path).resolve()
+        folder = data_path.parent.parent / 'cache'
+        folder.mkdir(exist_ok=True)
+        return str(folder / f'{data_path.name}.state.json')
+
+    @property
+    def raw_store_path(self):
+        data_path = Path(self.data.path).resolve()
+        folder = data_path.parent.parent / 'raw-store'
+        folder.mkdir(exist_ok=True)
+        return str(folder / data_path.name)
+
+    @property
+    def night_intervals_path(self):
+        data_path = Path(self.data.path).resolve()
+        folder = data_path.parent.parent / 'predictions-fin'
+        folder.mkdir(exist_ok=True)
+        return str(folder / f'{data_path.name}.parquet')
+
     @property
     def excel_prediction_path(self):
         data_path = Path(self.data.path).resolve()
@@ -107,8 +136,9 @@ class CsvData(models.Model):
 
     @property
     def excel_prediction_url(self):
-        if path.exists(self.excel_prediction_path):
-            return self.data.storage.url(self.excel_prediction_path)
+        # the excel file is exported from the prediction store on the first download
+        if path.exists(self.cached_prediction_path):
+            return reverse('dashboard:prediction_excel', args=[self.id])
         else:
             return ''
 
@@ -401,7 +431,8 @@ class SleepNight(models.Model):
 
     @property
     def name_url(self):
-        return self.data.data.storage.url(self.name)
+        # the excel file is exported from the night intervals store on the first download
+        return reverse('dashboard:night_excel', args=[self.id])
 
     @property
     def sol_norm(self):
@@ -482,7 +513,8 @@ class SleeppyData(models.Model):
 
     @property
     def name_url(self):
-        return self.data.data.storage.url(self.name)
+        # the excel file is exported from the predictions of the rest period on the first download
+        return reverse('dashboard:sleeppy_excel', args=[self.id])
 
     @property
     def sol_norm(self):
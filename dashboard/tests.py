@@ -1,15 +1,42 @@
+import json
+import os
+import tempfile
 import unittest
+from datetime import datetime, timedelta, timezone
 from os import path
+from types import SimpleNamespace
+from unittest import mock
 
+import numpy
 import pandas
 import xgboost as xgb
 from parameterized import parameterized
 from sklearn.metrics import accuracy_score, f1_score, matthews_corrcoef, confusion_matrix, classification_report
 
 from dashboard.logic import cache
+from dashboard.logic.features_extraction.count_hilev import get_night_excel, get_sleeppy_excel
+from dashboard.logic.features_extraction.data_entry import DataEntry, entries_to_df, get_feature_names
+from dashboard.logic.features_extraction.hilev_thresholds import hilev_for_thresholds, THRESHOLDS
+from dashboard.logic.features_extraction.night_runs import NightRuns
+from dashboard.logic.machine_learning.feature_profile import FULL_PROFILE, REDUCED_PROFILE, \
+    get_inference_model_path
+from dashboard.logic.machine_learning import feature_profile, predict_core, streaming
 from dashboard.logic.machine_learning.learn import load_data, results_to_print_cv
-from dashboard.logic.machine_learning.settings import scale_name
+from dashboard.logic.machine_learning.settings import scale_name, prediction_name
+from dashboard.logic.machine_learning.streaming import stream_store_predictions
 from dashboard.logic.machine_learning.visualisation import plot_logloss_and_error, plot_fi, plot_cross_validation
+from dashboard.logic.preprocessing import preprocess_data
+from dashboard.logic.preprocessing.csv_epochs import to_seconds, align_training_epochs, iter_prediction_epochs
+from dashboard.logic.preprocessing.night_intervals import NightIntervals
+from dashboard.logic.preprocessing.preprocess_ps_data import PS_HEADER, load_hypnogram, convert_ps_timestamp, \
+    convert_sleep
+from dashboard.logic.preprocessing.raw_store import load_raw_store
+from dashboard.logic.preprocessing.timestamps import parse_timestamps, to_datetime_index
+from dashboard.logic.sleep_diary import validate_sleep_wake
+from dashboard.logic.sleep_diary.structure import _covers
+from dashboard.logic.sleeppy.sleeppy_core import SleepPy, band_pass_filter, activity_index, \
+    major_rest_block
+from dashboard.models import WakeInterval
 from mysite.settings import BASE_DIR, TRAINED_MODEL_PATH, TRAINED_MODEL_EXPORT_PATH
 
 
@@ -29,7 +56,7 @@ class ModelTest(unittest.TestCase):
         ]
     )
     def test_model_accuracy(self, data_path):
-        df = pandas.read_excel(data_path, index_col=0)
+        df = cache.load_features(data_path)
         x = df[[c for c in df.columns if c != scale_name]].values
         predictions = self.model.predict(x)
         y_test = df[scale_name].values
@@ -62,6 +89,502 @@ class ModelTest(unittest.TestCase):
         self.assertTrue(1 > r_wake > 0)
 
 
+class FeatureCacheTest(unittest.TestCase):
+    def test_features_round_trip(self):
+        df = pandas.DataFrame(
+            {'acc_mean': [0.5, 1.25, 2.0], scale_name: [0, 1, 1]},
+            index=pandas.date_range('2020-01-01 22:00:15', periods=3, freq='30s', name='Date'),
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_path = path.join(tmp_dir, 'features.parquet')
+            cache.save_features(df, data_path)
+            loaded = cache.load_features(data_path)
+            self.assertEqual(str(loaded['acc_mean'].dtype), 'float32')
+            self.assertListEqual(list(loaded.columns), list(df.columns))
+            self.assertListEqual(list(loaded.index), list(df.index))
+            self.assertListEqual(loaded[scale_name].tolist(), [0, 1, 1])
+            self.assertListEqual(list(cache.load_features(data_path, columns=['acc_mean']).columns), ['acc_mean'])
+
+    def test_predictions_store(self):
+        df = pandas.DataFrame(
+            {'acc_mean': [0.5, 1.25, 2.0], scale_name: [-1, -1, -1], prediction_name: [0.1, 0.7, 0.9]},
+            index=pandas.date_range('2020-01-01 22:00:15', periods=3, freq='30s', name='Date'),
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            predictions_path = path.join(tmp_dir, 'predictions.parquet')
+            excel_path = path.join(tmp_dir, 'predictions.xlsx')
+            cache.save_predictions(df, predictions_path)
+            self.assertListEqual(list(cache.load_predictions(predictions_path).columns), [scale_name, prediction_name])
+            loaded = cache.load_predictions(predictions_path, columns=[prediction_name])
+            self.assertListEqual(list(loaded.index), list(df.index))
+            self.assertTrue(numpy.allclose(loaded[prediction_name], df[prediction_name]))
+            cache.export_predictions_to_excel(predictions_path, excel_path)
+            self.assertListEqual(list(pandas.read_excel(excel_path, index_col=0).columns), [scale_name, prediction_name])
+
+    def test_features_key(self):
+        df = pandas.DataFrame(
+            {name: [0.5] for name in get_feature_names()[:3]},
+            index=pandas.date_range('2020-01-01 22:00:15', periods=1, freq='30s', name='Date'),
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_data = SimpleNamespace(x_data_path=path.join(tmp_dir, 'features.parquet'),
+                                       prediction_state_path=path.join(tmp_dir, 'state.json'))
+            cache.save_features(df, csv_data.x_data_path)
+            self.assertListEqual(cache.load_feature_columns(csv_data.x_data_path), list(df.columns))
+            # the features cached without a key are trusted only if all of them are present
+            with mock.patch.object(preprocess_data, 'get_features_key', return_value=FULL_PROFILE):
+                self.assertFalse(preprocess_data._features_match(csv_data))
+            with open(csv_data.prediction_state_path, 'w') as state_file:
+                json.dump({'version': preprocess_data.PREDICTION_STATE_VERSION, 'features': 'model-a'}, state_file)
+            with mock.patch.object(preprocess_data, 'get_features_key', return_value='model-a'):
+                self.assertTrue(preprocess_data._features_match(csv_data))
+            with mock.patch.object(preprocess_data, 'get_features_key', return_value='model-b'):
+                self.assertFalse(preprocess_data._features_match(csv_data))
+
+    def test_inference_model_path(self):
+        # the reduced profile predicts by the compact model once it is trained
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compact_path = path.join(tmp_dir, 'compact_export.json')
+            with mock.patch.object(feature_profile, 'COMPACT_MODEL_EXPORT_PATH', compact_path):
+                self.assertEqual(get_inference_model_path(REDUCED_PROFILE), TRAINED_MODEL_EXPORT_PATH)
+                open(compact_path, 'w').close()
+                self.assertEqual(get_inference_model_path(REDUCED_PROFILE), compact_path)
+                self.assertEqual(get_inference_model_path(FULL_PROFILE), TRAINED_MODEL_EXPORT_PATH)
+
+
+class RawStoreTest(unittest.TestCase):
+    def test_csv_ingest(self):
+        times = pandas.date_range('2020-01-01 23:59:30', periods=2500, freq='40ms')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = path.join(tmp_dir, 'recording.csv')
+            _write_geneactiv_csv(csv_path, times)
+            store = load_raw_store(csv_path, path.join(tmp_dir, 'recording'))
+            self.assertEqual(len(store), len(times))
+            self.assertEqual(store.frequency, '25.0 Hz')
+            self.assertDictEqual(store.meta['calibration'], {'x gain': '25548'})
+            self.assertListEqual(list(store.column('time').astype('datetime64[ns]')), list(times.values))
+            self.assertEqual(store.column('temperature').dtype, numpy.float32)
+            # the rows are indexed at the start of every minute
+            self.assertEqual(store.find_row(store.start + 10), 0)
+            self.assertEqual(store.find_row(store.start + 40), 750)
+
+
+class PredictionEpochsTest(unittest.TestCase):
+    def test_store_epochs_equal_csv_loop(self):
+        # 10 minutes at 50 Hz with two nights, the gap between them is longer than the store index step
+        times = pandas.date_range('2020-01-01 23:59:30', periods=30000, freq='20ms')
+        nights = [(datetime(2020, 1, 2, 0, 0, 40), datetime(2020, 1, 2, 0, 2, 10)),
+                  (datetime(2020, 1, 2, 0, 5, 0), datetime(2020, 1, 2, 0, 12, 0))]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = path.join(tmp_dir, 'recording.csv')
+            _write_geneactiv_csv(csv_path, times, frequency='50.0 Hz')
+            store = load_raw_store(csv_path, path.join(tmp_dir, 'recording'))
+            epochs = list(iter_prediction_epochs(store, nights, chunk_size=1000))
+        seconds = times.values.astype('datetime64[s]').astype(numpy.int64)
+        expected = _csv_loop_prediction_epochs(seconds, [(to_seconds(s), to_seconds(e)) for s, e in nights], 2)
+        self.assertListEqual([(t, temp.astype(int).tolist()) for t, _, _, temp, _ in epochs], expected)
+        # the last epoch is cut by the end of the recording
+        self.assertLess(len(expected[-1][1]), len(expected[-2][1]))
+
+
+class IncrementalPredictionTest(unittest.TestCase):
+    def test_appended_tail_equals_full_run(self):
+        times = pandas.date_range('2020-01-01 22:00:00', periods=25 * 60 * 12, freq='40ms')
+        nights = NightIntervals([(datetime(2020, 1, 1, 21), datetime(2020, 1, 2, 6))])
+        # the first version of the recording ends in the middle of an epoch
+        old_end = 25 * (7 * 60 + 10)
+        score = mock.Mock(side_effect=lambda df: df['TEMPERATURE | MEAN'].values)
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(preprocess_data, '_get_diary_nights', return_value=nights), \
+                mock.patch.object(predict_core, 'predict_features', score):
+            extended, full = _prediction_recording(tmp_dir, 'extended'), _prediction_recording(tmp_dir, 'full')
+            _write_geneactiv_csv(extended.data.path, times[:old_end])
+            self.assertTrue(preprocess_data._preprocess_prediction_data(extended))
+            before = cache.load_predictions(extended.cached_prediction_path)
+            self.assertFalse(preprocess_data.prediction_data_outdated(extended))
+            _write_geneactiv_csv(extended.data.path, times)
+            _write_geneactiv_csv(full.data.path, times)
+            self.assertTrue(preprocess_data.prediction_data_outdated(extended))
+            self.assertTrue(preprocess_data.update_prediction_data(extended))
+            # the processed version of the csv file is saved with the state
+            self.assertFalse(preprocess_data.prediction_data_outdated(extended))
+            self.assertTrue(preprocess_data._preprocess_prediction_data(full))
+            after = cache.load_predictions(extended.cached_prediction_path)
+            expected = cache.load_predictions(full.cached_prediction_path)
+        self.assertGreater(len(after), len(before))
+        self.assertListEqual(list(after.index), list(expected.index))
+        self.assertTrue(numpy.allclose(after[prediction_name], expected[prediction_name]))
+        # the epoch crossing the old end was predicted again from all its samples
+        crossing = before.index[-1]
+        self.assertNotEqual(before.loc[crossing, prediction_name], after.loc[crossing, prediction_name])
+
+
+class SleepWakeStreamTest(unittest.TestCase):
+    def test_stream_equals_prediction(self):
+        times = pandas.date_range('2020-01-01 21:59:30', periods=25 * 60 * 8, freq='40ms')
+        nights = [(datetime(2020, 1, 1, 22, 0, 40), datetime(2020, 1, 1, 22, 3, 10)),
+                  (datetime(2020, 1, 1, 22, 5, 0), datetime(2020, 1, 2, 6))]
+        score = mock.Mock(side_effect=lambda df: df['TEMPERATURE | MEAN'].values)
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(preprocess_data, '_get_diary_nights', return_value=NightIntervals(nights)), \
+                mock.patch.object(predict_core, 'predict_features', score), \
+                mock.patch.object(streaming, 'predict_features', score):
+            recording = _prediction_recording(tmp_dir, 'recording')
+            _write_geneactiv_csv(recording.data.path, times)
+            self.assertTrue(preprocess_data._preprocess_prediction_data(recording))
+            expected = cache.load_predictions(recording.cached_prediction_path)[prediction_name]
+            store = load_raw_store(recording.data.path, recording.raw_store_path)
+            # the chunks end in the middle of the epochs and of the gap between the nights
+            predictions = pandas.concat(list(stream_store_predictions(store, nights, chunk_size=777)))
+        self.assertListEqual(list(predictions.index), list(expected.index))
+        self.assertTrue(numpy.allclose(predictions.values, expected.values))
+
+
+class CoverageTest(unittest.TestCase):
+    def test_covers_equals_prediction_slices(self):
+        # two nights of epochs, the second with a gap longer than the coverage gap
+        index = pandas.DatetimeIndex([*pandas.date_range('2020-01-01 22:00:15', periods=40, freq='30s'),
+                                      *pandas.date_range('2020-01-02 22:00:15', periods=20, freq='30s'),
+                                      *pandas.date_range('2020-01-02 22:15:15', periods=20, freq='30s')], name='Date')
+        df = pandas.DataFrame({prediction_name: numpy.linspace(0, 1, len(index), dtype=numpy.float32)}, index=index)
+        # the diary nights are longer than the coverage gap, so they cannot fall between two covered epochs
+        windows = [(index[0] + timedelta(seconds=step), index[0] + timedelta(seconds=step + length))
+                   for step in range(-600, 26 * 3600, 37) for length in (60, 95, 1500)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prediction_path = path.join(tmp_dir, 'recording.parquet')
+            cache.save_predictions(df, prediction_path)
+            predictions = cache.load_predictions(prediction_path, columns=[prediction_name])
+            coverage = cache.load_coverage(prediction_path)
+            # the coverage of the predictions saved without the sidecar is built from the store
+            os.remove(cache.get_coverage_path(prediction_path))
+            rebuilt = cache.load_coverage(prediction_path)
+        for s, e in windows:
+            expected = len(predictions[s:e]) > 0
+            self.assertEqual(_covers(coverage, s, e), expected, (s, e))
+            self.assertEqual(_covers(rebuilt, s, e), expected, (s, e))
+        self.assertFalse(_covers(None, index[0], index[-1]))
+
+
+class NightExcelTest(unittest.TestCase):
+    def test_night_excel_from_store(self):
+        index = pandas.date_range('2020-01-01 22:00:00', periods=6, freq='30s', name='Date')
+        df = pandas.DataFrame({prediction_name: [0, 1, 1, 0, 1, 1], 'diary_day': [7, 7, 7, 8, 8, 8]}, index=index)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_path = path.join(tmp_dir, 'nights.parquet')
+            cache.save_night_intervals(df, store_path)
+            night = SimpleNamespace(diary_day_id=8, name=path.join(tmp_dir, 'night.xlsx'),
+                                    data=SimpleNamespace(night_intervals_path=store_path))
+            self.assertEqual(get_night_excel(night), night.name)
+            exported = pandas.read_excel(night.name, index_col=0)
+            # the export is reused until the nights are saved again
+            self.assertEqual(get_night_excel(night), night.name)
+        self.assertListEqual(list(exported.index), list(index[3:]))
+        self.assertListEqual(list(exported[prediction_name]), [0, 1, 1])
+
+    def test_sleeppy_excel_from_predictions(self):
+        index = pandas.date_range('2020-01-01 22:00:15', periods=6, freq='30s', name='Date')
+        df = pandas.DataFrame({prediction_name: [0.1, 0.8, 0.6, 0.2, 0.9, 0.7]}, index=index)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prediction_path = path.join(tmp_dir, 'predictions.parquet')
+            cache.save_predictions(df, prediction_path)
+            # the rest period without a sleep night is cut from the predictions, the times are saved in utc
+            sleeppy_data = SimpleNamespace(
+                sleep_night_id=None, name=path.join(tmp_dir, 'sleeppy.xlsx'),
+                sleep_onset=datetime(2020, 1, 1, 23, 1, tzinfo=timezone(timedelta(hours=1))),
+                sleep_end=datetime(2020, 1, 1, 22, 2, 30, tzinfo=timezone.utc),
+                data=SimpleNamespace(night_intervals_path=path.join(tmp_dir, 'nights.parquet'),
+                                     cached_prediction_path=prediction_path))
+            self.assertEqual(get_sleeppy_excel(sleeppy_data), sleeppy_data.name)
+            exported = pandas.read_excel(sleeppy_data.name, index_col=0)
+        self.assertListEqual(list(exported.index), list(index[2:5]))
+        self.assertListEqual(list(exported[prediction_name]), [1, 0, 1])
+
+
+class TrainingEpochsTest(unittest.TestCase):
+    def test_align_equals_csv_loop(self):
+        # 50 Hz takes every 2nd sample, some samples are missing, the temperature holds the row number
+        times = pandas.date_range('2020-01-01 23:59:30', periods=5000, freq='20ms').delete(range(2100, 2163))
+        start = to_seconds(datetime(2020, 1, 2, 0, 0, 5))
+        epoch_times = numpy.array([to_seconds(datetime(2020, 1, 2, 0, 0, 0)) + 30 * i for i in range(4)], numpy.int64)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = path.join(tmp_dir, 'recording.csv')
+            _write_geneactiv_csv(csv_path, times, frequency='50.0 Hz')
+            store = load_raw_store(csv_path, path.join(tmp_dir, 'recording'))
+            epochs = align_training_epochs(store, start, epoch_times, chunk_size=333)
+            nanoseconds = times.values.astype('datetime64[ns]').astype(numpy.int64)
+            expected = _csv_loop_training_epochs(nanoseconds, store.find_row(start), start, epoch_times + 15, 2)
+        self.assertEqual(len(epochs), 3)
+        self.assertListEqual([temp.astype(int).tolist() for _, _, temp in epochs], expected)
+
+    def test_hypnogram_equals_row_conversion(self):
+        rows = [('W', '23:59:00'), ('N1', '23:59:30'), ('N2', '00:00:00'), ('R', '00:00:30'), ('W', '11:00:00')]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ps_path = path.join(tmp_dir, 'hypnogram.txt')
+            with open(ps_path, 'w', encoding='latin-1') as ps_file:
+                ps_file.write('Recording Date:\t01/01/2020 22:00\n\n' + '\t'.join(PS_HEADER) + '\n')
+                ps_file.writelines(f'{stage}\tSupine\t{time}\tSLEEP-S\t30\n' for stage, time in rows)
+            epoch_times, sleep = load_hypnogram(SimpleNamespace(data=SimpleNamespace(path=ps_path)))
+        # the conversion of the rows by the training data preprocessing before the hypnogram arrays
+        after_midnight = numpy.cumsum([time.startswith('00') for _, time in rows]) > 0
+        expected = [to_seconds(convert_ps_timestamp('01/01/2020', time, next_day))
+                    for (_, time), next_day in zip(rows, after_midnight)]
+        self.assertListEqual(epoch_times.tolist(), expected)
+        self.assertListEqual(sleep.tolist(), [convert_sleep(stage) for stage, _ in rows])
+
+
+class TimestampsTest(unittest.TestCase):
+    def test_parse_equals_pandas_and_strptime(self):
+        geneactiv = ['2020-01-01 23:59:59:960', '2020-02-29 00:00:00:000', '1999-12-31 12:30:05:007',
+                     '2021-02-29 00:00:00:000', '2020-13-01 00:00:00:000', '2020-01-01 24:00:00:000',
+                     '2020-01-01T00:00:00:000', 'Temperature,25.5', '']
+        # the GENEActiv timestamps as parsed by the csv chunk reader before
+        expected = pandas.to_datetime(pandas.Series(geneactiv), format='%Y-%m-%d %H:%M:%S:%f', errors='coerce')
+        nanoseconds, valid = parse_timestamps(geneactiv)
+        self.assertListEqual(valid.tolist(), expected.notna().tolist())
+        self.assertListEqual(nanoseconds[valid].tolist(),
+                             expected[valid].values.astype('datetime64[ns]').astype(numpy.int64).tolist())
+
+        dreamt = ['2020-01-01 23:59:59.123456', '2020-01-01 23:59:59.5', '2020-01-01 23:59:59']
+        # the DREAMT timestamps as parsed by strptime with the fallback without the fraction
+        expected = [datetime.strptime(t, '%Y-%m-%d %H:%M:%S.%f' if '.' in t else '%Y-%m-%d %H:%M:%S') for t in dreamt]
+        nanoseconds, valid = parse_timestamps(dreamt)
+        self.assertTrue(valid.all())
+        self.assertListEqual(to_datetime_index(nanoseconds, valid).to_pydatetime().tolist(), expected)
+
+    def test_malformed_rows(self):
+        malformed = ['2020-01-01 00:00:00.000garbage', '2020-01-01 00:00:00:000 ', '2020-01-01 00:00:00:',
+                     '2020-01-01 00:00:00x', '2020-01-01 00:00:00.1234567890', b'2020-01-01 00:00:00:000000000000']
+        for timestamp in malformed:
+            with self.assertRaises(ValueError):
+                datetime.strptime(timestamp if isinstance(timestamp, str) else timestamp.decode(),
+                                  '%Y-%m-%d %H:%M:%S.%f' if '.' in str(timestamp) else '%Y-%m-%d %H:%M:%S:%f')
+            _, valid = parse_timestamps(numpy.array([timestamp]))
+            self.assertFalse(valid.any(), timestamp)
+
+
+class NightIntervalsTest(unittest.TestCase):
+    def test_membership_equals_nights(self):
+        day = datetime(2020, 1, 1)
+        nights = [
+            (day + timedelta(hours=22), day + timedelta(hours=23)),
+            (day + timedelta(hours=22, minutes=30), day + timedelta(hours=23, minutes=30)),
+            (day + timedelta(hours=23, minutes=30), day + timedelta(hours=23, minutes=45)),
+            (day + timedelta(hours=25), day + timedelta(hours=25)),
+            (day + timedelta(hours=24, minutes=30), day + timedelta(hours=25)),
+        ]
+        intervals = NightIntervals(nights)
+        # the overlapping nights are merged, the touching ones and the empty one are not
+        self.assertEqual(len(intervals), 3)
+        seconds = numpy.arange(to_seconds(day + timedelta(hours=21, minutes=59)),
+                               to_seconds(day + timedelta(hours=26)), 15)
+        # the mask of every night separately as the epochs were selected before
+        expected = numpy.zeros(len(seconds), dtype=bool)
+        for start, end in nights:
+            expected |= (seconds > to_seconds(start)) & (seconds < to_seconds(end))
+        self.assertListEqual(intervals.contains(seconds).tolist(), expected.tolist())
+        self.assertListEqual([s in intervals for s in seconds], expected.tolist())
+        self.assertListEqual([s in intervals for s in seconds[::-7]], expected[::-7].tolist())
+        self.assertEqual(intervals.next_start(to_seconds(day + timedelta(hours=23, minutes=50))),
+                         to_seconds(day + timedelta(hours=24, minutes=30)))
+        self.assertIsNone(intervals.next_start(to_seconds(day + timedelta(hours=22, minutes=10))))
+        self.assertIsNone(intervals.next_start(to_seconds(day + timedelta(hours=25))))
+
+
+class BatchFeaturesTest(unittest.TestCase):
+    def test_batch_features_equal_data_entry(self):
+        rng = numpy.random.default_rng(42)
+        lengths = [0, 1, 2, 5, 750, 749, 300]
+        times = list(pandas.date_range('2020-01-01 22:00:15', periods=len(lengths), freq='30s'))
+        acc = [rng.normal(1, 0.05, n) for n in lengths]
+        acc_z = [numpy.round(rng.normal(0, 30, n)) for n in lengths]
+        temp = [numpy.full(n, 30.5) for n in lengths]
+        expected = pandas.DataFrame.from_dict([
+            DataEntry(t, a.tolist(), z.tolist(), tt.tolist()).to_dic() for t, a, z, tt in zip(times, acc, acc_z, temp)
+        ]).set_index('Date')
+        df = entries_to_df(times, acc, acc_z, temp)
+        self.assertListEqual(list(df.columns), list(expected.columns))
+        self.assertTrue(numpy.allclose(df.values.astype(float), expected.values.astype(float), equal_nan=True))
+
+    def test_batch_features_constant_epochs(self):
+        # the constants are not exactly representable, their variance and skewness must still be exact zero / NaN
+        temp = [numpy.full(750, 28.05), numpy.full(750, 30.1), numpy.full(3, 0.1)]
+        df = entries_to_df(list(pandas.date_range('2020-01-01', periods=3, freq='30s')), temp, temp, temp)
+        self.assertTrue((df['TEMPERATURE | VARIANCE'] == 0).all())
+        for name in ('STUDENTIZED RANGE', 'SKEWNESS', 'KURTOSIS', 'PEARSONS 1st SKEWNESS COEFFICIENT',
+                     'PEARSONS 2nd SKEWNESS COEFFICIENT'):
+            self.assertTrue(df[f'TEMPERATURE | {name}'].isna().all(), name)
+
+    def test_batch_features_random_epochs(self):
+        rng = numpy.random.default_rng(7)
+        lengths = rng.integers(2, 800, 400)
+        times = list(pandas.date_range('2020-01-01 22:00:15', periods=len(lengths), freq='30s'))
+        acc = [rng.normal(1, 0.05, n) for n in lengths]
+        acc_z = [numpy.round(rng.normal(0, 30, n)) for n in lengths]
+        # the temperature is mostly constant within an epoch with a step of 0.05 degree
+        temp = [numpy.round(rng.uniform(20, 35) + numpy.cumsum(rng.random(n) < 0.002) * 0.05, 2) for n in lengths]
+        expected = pandas.DataFrame.from_dict([
+            DataEntry(t, a.tolist(), z.tolist(), tt.tolist()).to_dic() for t, a, z, tt in zip(times, acc, acc_z, temp)
+        ]).set_index('Date')
+        df = entries_to_df(times, acc, acc_z, temp)
+        # scipy decides the skewness and kurtosis of the constant epochs by a version dependent threshold,
+        # they are checked by test_batch_features_constant_epochs
+        constant = numpy.array([len(set(t)) == 1 for t in temp])
+        expected.loc[constant, ['TEMPERATURE | SKEWNESS', 'TEMPERATURE | KURTOSIS']] = numpy.nan
+        self.assertTrue(numpy.array_equal(df.isna().values, expected.isna().values))
+        self.assertTrue(numpy.allclose(df.values.astype(float), expected.values.astype(float), equal_nan=True))
+
+
+class HilevThresholdsTest(unittest.TestCase):
+    def test_hilev_for_thresholds(self):
+        probabilities = [0.2] * 2 + [0.9] * 12 + [0.3] * 11 + [0.9] * 3 + [0.2] * 2
+        prediction = pandas.Series(
+            probabilities, index=pandas.date_range('2020-01-01 21:00:15', periods=len(probabilities), freq='30s'))
+        t1 = datetime(2020, 1, 1, 21, 0, 0)
+        df = hilev_for_thresholds(prediction, t1, t1 + timedelta(minutes=15), [0.25, 0.5, 1.0])
+        self.assertListEqual(df.loc[1, ['tib', 'sol', 'waso', 'wasf', 'wb', 'awk5plus', 'tst']].tolist(),
+                             [900, 75, 330, 75, 0, 1, 420])
+        self.assertListEqual(df.loc[0, ['waso', 'awk5plus', 'tst']].tolist(), [0, 0, 750])
+        self.assertEqual(df.loc[1, 'sleep_onset'], pandas.Timestamp('2020-01-01 21:01:15'))
+        self.assertTrue(df.loc[2, ['tib', 'sleep_onset']].isna().all())
+
+    def test_count_nights(self):
+        # 2 minutes in bed before the sleep and after the wake up are expected to be wake, 6 minutes to be sleep
+        t1 = datetime(2020, 1, 1, 22, 0, 0)
+        day = SimpleNamespace(date=t1.date(), t1=t1, t2=t1 + timedelta(minutes=2), t3=t1 + timedelta(minutes=8),
+                              t4=t1 + timedelta(minutes=10))
+        probabilities = [0.2] * 4 + [0.9] * 5 + [0.3] * 2 + [0.9] * 5 + [0.7] + [0.2] * 3
+        df = pandas.DataFrame({prediction_name: probabilities}, index=pandas.date_range(
+            '2020-01-01 22:00:15', periods=len(probabilities), freq='30s'))
+        with mock.patch.object(WakeInterval.objects, 'filter', return_value=mock.Mock(all=lambda: [])):
+            counts = validate_sleep_wake._count_nights([(None, day, df)])
+        self.assertListEqual(list(counts.columns), ['date', 'threshold', 'TP', 'FP', 'TN', 'FN'])
+        self.assertListEqual(counts.loc[counts['threshold'] == 0.5, ['TP', 'FP', 'TN', 'FN']].values[0].tolist(),
+                             [10, 1, 7, 2])
+        self.assertListEqual(counts.loc[counts['threshold'] == 0.1, ['TP', 'FP', 'TN', 'FN']].values[0].tolist(),
+                             [12, 8, 0, 0])
+        metrics = validate_sleep_wake._evaluate_threshold(counts, THRESHOLDS.index(0.5))
+        self.assertEqual((metrics['TP'], metrics['TN'], metrics['evaluated_nights']), (10, 7, 1))
+
+    def test_night_runs(self):
+        states = [0] * 2 + [1] * 12 + [0] * 11 + [1] * 3 + [0] + [1] + [0] * 2
+        runs = NightRuns.from_prediction(pandas.Series(
+            states, index=pandas.date_range('2020-01-01 21:00:15', periods=len(states), freq='30s')))
+        self.assertListEqual(runs.lengths.tolist(), [2, 12, 11, 3, 1, 1, 2])
+        self.assertEqual(runs.sleep_onset, datetime(2020, 1, 1, 21, 1, 15))
+        self.assertEqual(runs.sleep_end, datetime(2020, 1, 1, 21, 14, 45))
+        self.assertEqual(runs.waso, 360)
+        self.assertEqual(runs.wake_bouts, 1)
+        self.assertEqual(runs.awakenings, 1)
+
+
+class SleepPyTest(unittest.TestCase):
+    def test_activity_index_parity_equals_window_loop(self):
+        fs = 25
+        index = pandas.date_range('2020-01-01 22:00:00', periods=1500 * 5 + 400, freq='40ms')
+        rng = numpy.random.default_rng(21)
+        df = pandas.DataFrame(rng.normal(0, 0.3, (len(index), 3)), index=index, columns=['X', 'Y', 'Z'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sleeppy = _sleeppy(tmp_dir, fs)
+            df.to_hdf(path.join(sleeppy.sub_dst, 'raw_days', 'day_01.h5'), key='raw_data_24hr', mode='w')
+            sleeppy.extract_activity_index()
+            activity = pandas.read_hdf(path.join(sleeppy.sub_dst, 'activity_index_days',
+                                                 'recording_activity_index_day_01.h5'))
+        # the windows filtered one by one as before
+        expected = []
+        idx, window = 0, 60 * fs
+        while idx < len(df) - window:
+            temp = df[['X', 'Y', 'Z']].iloc[idx: idx + window]
+            start_time = temp.index[0]
+            temp.index = range(len(temp.index))
+            temp = band_pass_filter(temp, fs, bp_cutoff=sleeppy.band_pass_cutoff, order=3)
+            bp_channels = [i for i in temp.columns.values[1:] if 'bp' in i]
+            expected.append((start_time, activity_index(temp, channels=bp_channels).values[0][0]))
+            idx += window
+        self.assertListEqual(list(activity.index), [t for t, _ in expected])
+        self.assertTrue(numpy.allclose(activity['activity_index'].values, [a for _, a in expected]))
+
+
+    def test_roll_med_equals_iloc_loop(self):
+        index = pandas.date_range('2020-01-01 22:00:00', periods=300, freq='5s')
+        values = numpy.random.default_rng(22).normal(0, 1, len(index))
+        # the missing first difference, a window of only missing values and some scattered ones
+        values[0] = numpy.nan
+        values[100:170] = numpy.nan
+        values[[7, 8, 230]] = numpy.nan
+        series = pandas.Series(values, index=index)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = _sleeppy(tmp_dir, 25).roll_med(series, 60)
+        expected = []
+        idx = 0
+        while idx < len(series) - 60:
+            expected.append([series.index[idx], series.iloc[idx: idx + 60].median()])
+            idx += 1
+        expected = pandas.DataFrame(expected, columns=['Time', 'Data']).set_index('Time')
+        pandas.testing.assert_frame_equal(result, expected, check_freq=False)
+
+    def test_roll_60_minute_equals_iloc_loop(self):
+        # 1 Hz with a partial last block, missing values and a block of only missing values on one axis
+        index = pandas.date_range('2020-01-01 12:00:00', periods=900 * 9 + 123, freq='1s')
+        values = numpy.random.default_rng(23).normal(0, 0.05, (len(index), 3))
+        values[10:40, 0] = numpy.nan
+        values[1800:2700, 1] = numpy.nan
+        values[-100:, 2] = numpy.nan
+        df = pandas.DataFrame(values, index=index, columns=['X', 'Y', 'Z'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sleeppy = _sleeppy(tmp_dir, 1)
+            result_std = sleeppy.roll_std_60_minute(df)
+            result_range = sleeppy.roll_max_range_60_minute(df)
+        expected_std, expected_range = [], []
+        idx = 0
+        while idx < len(df) - 900:
+            window = df.iloc[idx: idx + 3600]
+            expected_std.append([df.index[idx], *window.std().values])
+            expected_range.append([df.index[idx], *(window.max().values - window.min().values)])
+            idx += 900
+        for result, expected in ((result_std, expected_std), (result_range, expected_range)):
+            expected = pandas.DataFrame(expected, columns=['Time', 'X', 'Y', 'Z']).set_index('Time')
+            pandas.testing.assert_frame_equal(result, expected, check_freq=False)
+
+    def test_rescore_rules(self):
+        # the old chained assignments did not change the data frame, the expected blocks follow the rules by hand
+        def wear_blocks(*blocks):
+            return numpy.concatenate([numpy.full(length, wear, dtype=numpy.float64) for wear, length in blocks])
+
+        index = pandas.date_range('2020-01-01 00:00:00', periods=144, freq='15min')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sleeppy = _sleeppy(tmp_dir, 1)
+            # 1 h wear between 2 h of non wear goes in the first pass (< 3 h, ratio 0.25),
+            # then 4 h wear between 5 h and 10 h (ratio 0.27) and then 5 h wear between 19 h and 1 h (ratio 0.25)
+            df = pandas.DataFrame({'wear': wear_blocks((0, 8), (1, 4), (0, 8), (1, 16), (0, 40), (1, 20), (0, 4),
+                                                       (1, 40), (0, 4))}, index=index)
+            passes = []
+            for _ in range(3):
+                df = sleeppy.rescore(df)
+                passes.append(df['wear'].values.copy())
+            # on the last day 2 h wear after 10 h of non wear goes, 1 h wear after 0.5 h of non wear stays
+            last_day = pandas.DataFrame({'wear': wear_blocks((1, 60), (0, 40), (1, 8), (0, 2), (1, 4), (0, 30))},
+                                        index=index)
+            last_day = sleeppy.rescore_last_day(last_day)
+        self.assertListEqual(list(passes[0]), list(wear_blocks((0, 20), (1, 16), (0, 40), (1, 20), (0, 4), (1, 40),
+                                                               (0, 4))))
+        self.assertListEqual(list(passes[1]), list(wear_blocks((0, 76), (1, 20), (0, 4), (1, 40), (0, 4))))
+        self.assertListEqual(list(passes[2]), list(wear_blocks((0, 100), (1, 40), (0, 4))))
+        self.assertListEqual(list(last_day['wear']), list(wear_blocks((1, 60), (0, 50), (1, 4), (0, 30))))
+
+    def test_major_rest_block_equals_groupby_rules(self):
+        rng = numpy.random.default_rng(25)
+        index = pandas.date_range('2020-01-01 12:00:00', periods=400, freq='5s')
+        for _ in range(20):
+            # rest and active runs of 1 to 30 samples with a few missing values
+            data = numpy.repeat(numpy.arange(40) % 2, rng.integers(1, 30, 40))[:len(index)].astype(numpy.float64)
+            data[rng.integers(0, len(data), 3)] = numpy.nan
+            result, longest = major_rest_block(data, 12, 8)
+            df = pandas.DataFrame({'Data': data}, index=index[:len(data)])
+            expected, expected_longest = _groupby_major_rest_block(df, 12, 8)
+            numpy.testing.assert_array_equal(result, expected)
+            self.assertEqual(None if longest is None else [index[longest[0]], index[longest[1]]], expected_longest)
+
+
 class ModelTuningsTest(unittest.TestCase):
     @parameterized.expand(
         [
@@ -121,3 +644,105 @@ class SaveModelTest(unittest.TestCase):
             f'ACC: {accuracy_score(y, predict):.2f} | F1: {f1_score(y, predict):.2f} | MCC: {matthews_corrcoef(y, predict)}')
         print(confusion_matrix(y, predict))
         print(classification_report(y, predict))
+
+
+def _groupby_major_rest_block(df, minimum_rest_block, allowed_rest_break):
+    # the block rules of the major rest period as grouped by pandas before, written by loc instead of chained writes
+    df['block'] = (df.Data.diff().ne(0)).cumsum()
+    groups = list(df.groupby(by='block'))
+    for group in groups[1:-1]:
+        if group[1]['Data'].sum() == 0 and len(group[1]) < minimum_rest_block:
+            df.loc[group[1].index[0]: group[1].index[-1], 'Data'] = 1
+    df['block'] = (df.Data.diff().ne(0)).cumsum()
+    groups = list(df.groupby(by='block'))
+    for group in groups[1:-1]:
+        if len(group[1]) == group[1]['Data'].sum() and len(group[1]) < allowed_rest_break:
+            df.loc[group[1].index[0]: group[1].index[-1], 'Data'] = 0
+    df['block'] = (df.Data.diff().ne(0)).cumsum()
+    best, mrp = 0, None
+    for group in df.groupby(by='block'):
+        if group[1]['Data'].sum() == 0 and len(group[1]) > best:
+            best = len(group[1])
+            mrp = [group[1].index[0], group[1].index[-1]]
+    return df['Data'].values, mrp
+
+
+def _sleeppy(tmp_dir, fs, **attributes):
+    # SleepPy with the attributes used by its processing steps, the steps are run by the test, not by the constructor
+    sleeppy = SleepPy.__new__(SleepPy)
+    sleeppy.src_name = 'recording'
+    sleeppy.sub_dst = path.join(tmp_dir, 'recording')
+    sleeppy.fs = fs
+    sleeppy.window_size = 60
+    sleeppy.band_pass_cutoff = (0.25, 12.0)
+    sleeppy.activity_index_parity = True
+    for name, value in attributes.items():
+        setattr(sleeppy, name, value)
+    os.makedirs(path.join(sleeppy.sub_dst, 'raw_days'))
+    return sleeppy
+
+
+def _write_geneactiv_csv(csv_path, times, frequency='25.0 Hz'):
+    # the temperature column holds the row number to identify the samples
+    with open(csv_path, 'w') as csv_file:
+        csv_file.write(f'Device Type,GENEActiv\nMeasurement Frequency,{frequency}\nx gain,25548\n')
+        for row, time in enumerate(times):
+            csv_file.write(f'{time:%Y-%m-%d %H:%M:%S}:{time.microsecond // 1000:03d},0.5,-0.25,1.0,12,0,{row}\n')
+
+
+def _prediction_recording(tmp_dir, name):
+    # the paths of CsvData used by the prediction preprocessing
+    return SimpleNamespace(
+        training_data=False, dreamt_data=False, filename=f'{name}.csv',
+        data=SimpleNamespace(path=path.join(tmp_dir, f'{name}.csv')),
+        raw_store_path=path.join(tmp_dir, name),
+        x_data_path=path.join(tmp_dir, f'{name}.features.parquet'),
+        x_data_excel_path=path.join(tmp_dir, f'{name}.features.xlsx'),
+        cached_prediction_path=path.join(tmp_dir, f'{name}.predictions.parquet'),
+        excel_prediction_path=path.join(tmp_dir, f'{name}.predictions.xlsx'),
+        prediction_state_path=path.join(tmp_dir, f'{name}.state.json'),
+    )
+
+
+def _csv_loop_prediction_epochs(seconds, nights, frequency_modulo):
+    # the time and the rows of each prediction epoch as read row by row from the csv file before the raw store
+    epochs = []
+    row = 0
+    while row < len(seconds):
+        if not any(start < seconds[row] < end for start, end in nights):
+            row += 1
+            continue
+        anchor, row, samples = row, row + 1, []
+        while row < len(seconds):
+            if (row - anchor - 1) % frequency_modulo == 0:
+                samples.append(row)
+            row += 1
+            if seconds[row - 1] >= seconds[anchor] + 30:
+                break
+        if samples:
+            epochs.append((datetime(1970, 1, 1) + timedelta(seconds=int(seconds[anchor]) + 15), samples))
+    return epochs
+
+
+def _csv_loop_training_epochs(nanoseconds, first_row, start, epoch_ends, frequency_modulo):
+    # the rows of each training epoch as read by the csv.reader loops before the raw store
+    row, modulo_reminder = first_row, first_row % frequency_modulo
+    while row < len(nanoseconds):
+        date, row = nanoseconds[row], row + 1
+        if modulo_reminder == 0 and date >= start * 1e9:
+            break
+        modulo_reminder = (modulo_reminder + 1) % frequency_modulo
+    epochs = []
+    for end in epoch_ends:
+        samples, reminder = [], modulo_reminder
+        while row < len(nanoseconds):
+            date, row = nanoseconds[row], row + 1
+            if reminder == 0:
+                samples.append(row - 1)
+            reminder = (reminder + 1) % frequency_modulo
+            if date >= end * 1e9:
+                break
+        if not samples:
+            break
+        epochs.append(samples)
+    return epochs
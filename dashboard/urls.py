@@ -10,6 +10,9 @@ urlpatterns = [
     path('subjects', views.subjects_page, name='subjects'),
     path('utils/', views.utils, name='utils'),
     path('<code>/', views.detail, name='detail'),
+    path('predictions/<int:data_id>/excel', views.prediction_excel, name='prediction_excel'),
+    path('nights/<int:night_id>/excel', views.night_excel, name='night_excel'),
+    path('sleeppy/<int:sleeppy_id>/excel', views.sleeppy_excel, name='sleeppy_excel'),
     path('utils/<action>', views.utils, name='utils'),
     path('<code>/<action>', views.detail_action, name='detail'),
     path('admin/', admin.site.urls),
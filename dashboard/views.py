@@ -21,17 +21,18 @@ from dashboard.logic.covariates import (
     calculate_covariates_dataset_clinical,
     calculate_covariates_dataset_clinical_acc_dreamt,
 )
-from dashboard.logic.features_extraction.count_hilev import hilev_all, hilev
+from dashboard.logic.features_extraction.count_hilev import hilev_all, hilev, get_night_excel, get_sleeppy_excel
 from dashboard.logic.group_data import group_all_covariate_datasets
 from dashboard.logic.preprocessing.preprocess_data import preprocess_all_data
 from .conversion.convert_dreamt import convert_64hz_dreamt
 from .export.export_actions import export_all, export_subject
+from .export.export_features import export_all_x_data
 from .export.export_hilev_avg import export_all_features_avg
 from .export.export_hilev_clinic_data import export_all_features_clinic
 from .export.export_hilev_clinic_data_activity_index import export_all_features_clinic_activity_index
 from .export.export_hilev_clinic_data_activity_index_sleeppy import export_all_features_clinic_activity_index_sleepy
 from .logic.machine_learning.learn import prepare_model
-from .logic.machine_learning.predict import predict_all, predict
+from .logic.machine_learning.predict import predict_all, predict, get_prediction_excel
 from .logic.machine_learning.validate_predictions import validate_dreamt_predictions
 from .logic.parkinson_analysis.train_classifier import train_parkinson_classifier
 from .logic.reults_visualization.sleep_graph import create_graph
@@ -43,7 +44,7 @@ from .logic.sleeppy.sleeppy import sleeppy_all, sleeppy_clean
 from .logic.sleeppy.sleeppy_new_hilevs import sleeppy_new_hilev_all
 from .logic.sleeppy.sleeppy_to_models import sleeppy_to_models
 from .logic.sleeppy.sleeppy_to_models_validation import sleeppy_to_models_validation
-from .models import Subject, CsvData, SleepDiaryDay, RBDSQ, SleepNight
+from .models import Subject, CsvData, SleepDiaryDay, RBDSQ, SleepNight, SleeppyData
 
 logger = logging.getLogger(__name__)
 
@@ -139,6 +140,57 @@ def detail_action(request, code, action):
             return redirect('dashboard:index')
 
 
+@staff_member_required
+def prediction_excel(request, data_id):
+    csv_data = get_object_or_404(CsvData, id=data_id)
+    code = csv_data.subject.code
+    if request.user.get_username() == code or \
+            request.user.is_superuser or \
+            request.user.groups.filter(name='researchers').exists() or \
+            request.user.groups.filter(name='administrators').exists():
+        excel_path = get_prediction_excel(csv_data)
+        if excel_path is not None:
+            return FileResponse(open(excel_path, 'rb'), as_attachment=True)
+        return redirect('dashboard:detail', code=code)
+    else:
+        logger.warning(f'Blocked request to download predictions of subject {code} for user {request.user}')
+        return redirect('dashboard:index')
+
+
+@staff_member_required
+def night_excel(request, night_id):
+    night = get_object_or_404(SleepNight, id=night_id)
+    code = night.subject.code
+    if request.user.get_username() == code or \
+            request.user.is_superuser or \
+            request.user.groups.filter(name='researchers').exists() or \
+            request.user.groups.filter(name='administrators').exists():
+        excel_path = get_night_excel(night)
+        if excel_path is not None:
+            return FileResponse(open(excel_path, 'rb'), as_attachment=True)
+        return redirect('dashboard:detail', code=code)
+    else:
+        logger.warning(f'Blocked request to download night {night_id} of subject {code} for user {request.user}')
+        return redirect('dashboard:index')
+
+
+@staff_member_required
+def sleeppy_excel(request, sleeppy_id):
+    sleeppy_data = get_object_or_404(SleeppyData, id=sleeppy_id)
+    code = sleeppy_data.subject.code
+    if request.user.get_username() == code or \
+            request.user.is_superuser or \
+            request.user.groups.filter(name='researchers').exists() or \
+            request.user.groups.filter(name='administrators').exists():
+        excel_path = get_sleeppy_excel(sleeppy_data)
+        if excel_path is not None:
+            return FileResponse(open(excel_path, 'rb'), as_attachment=True)
+        return redirect('dashboard:detail', code=code)
+    else:
+        logger.warning(f'Blocked request to download SleepPy data of subject {code} for user {request.user}')
+        return redirect('dashboard:index')
+
+
 # Change to be async and show progress bar: https://buildwithdjango.com/blog/post/celery-progress-bars/
 @staff_member_required
 def utils(request, action=None):
@@ -264,6 +316,17 @@ def utils(request, action=None):
                 logger.error('Failed to export dataset')
                 context = {
                     'fail': 'Export of features to dataset failed!'}
+        elif action == 'export_features':
+            logger.info('Export cached features to excel')
+            if export_all_x_data():
+                logger.info('Export completed')
+                context = {
+                    'ok': 'Export completed successfully'
+                }
+            else:
+                logger.error('Failed to export cached features')
+                context = {
+                    'fail': 'Export of cached features failed!'}
         elif action == 'export_dataset_avg':
             logger.info('Export dataset with average for each subject to excel')
             if export_all_features_avg():
@@ -26,6 +26,10 @@ DATASET_PATH = f"{ML_DIR}/dataset.xlsx"
 DATASET_PARQUET_PATH = f"{ML_DIR}/dataset.parquet"
 TRAINED_MODEL_PATH = f"{ML_DIR}/trained_model.pkl"
 TRAINED_MODEL_EXPORT_PATH = f"{ML_DIR}/trained_model_export.json"
+# the model trained on just the features used by the exported model, predicts in the reduced profile
+COMPACT_MODEL_EXPORT_PATH = f"{ML_DIR}/trained_model_compact_export.json"
+# features computed by the prediction-only preprocessing, reduced computes only the features used by the model
+INFERENCE_PROFILE = os.environ.get('INFERENCE_PROFILE', 'full')
 BEST_ESTIMATOR_PATH = f"{ML_DIR}/bst.pkl"
 CV_RESULTS_PATH = f"{ML_DIR}/cv_results.pkl"
 METADATA_PATH = f'{BASE_DIR}/metadata.xlsx'
@@ -33,6 +37,9 @@ METADATA_PARTIAL_PATH = f'{BASE_DIR}/metadata-part.xlsx'
 HILEV_FNUSA = f'{BASE_DIR}/dataset_hilev_all_acc_sleeppy-first_visit.xlsx'
 HILEV_CV_RESULTS_PATH = f"{HILEV_DIR}/cv_results.pkl"
 HILEV_TRAINED_MODEL_PATH = f"{HILEV_DIR}/trained_model.pkl"
+# number of worker processes used to preprocess all the data, 1 means serial processing,
+# the batch runs opt in to more workers, the web requests should not start a process pool
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', 1))
 
 # -------------- DJANGO SETTINGS ----------------------
 # Quick-start development settings - unsuitable for production